@@ -1,15 +1,32 @@
 
+from libc.stdint cimport uint8_t, uint16_t, uint32_t
+
+from basevar.caller.batch cimport BASE_CODE_T
+
 cdef extern from "stdlib.h":
     void *malloc(size_t)
+    void *calloc(size_t, size_t)
+    void *realloc(void *, size_t)
     void *memcpy(void *dst, void *src, size_t length)
     void free(void *)
 
+cdef extern from "string.h":
+    void *memset(void *s, int c, size_t n)
+
+cdef extern from "math.h":
+    double erfc(double)
+    double sqrt(double)
+    double fabs(double)
+
 cdef extern from "include/em.c":
     pass
 
 cdef extern from "include/em.h":
     void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
             double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon)
+    int em_weighted(double *init_allele_freq, double *class_allele_likelihood, double *class_weight,
+                    double *marginal_likelihood, double *expect_allele_prob, int nclass, int ntype,
+                    int iter_num, double epsilon)
 
 cdef extern from "include/ranksumtest.c":
     pass
@@ -26,6 +43,59 @@ cdef void EM(double* init_allele_freq,
              int iter_num,
              double epsilon)
 
-cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *strands, int size)
-cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases, int *info, int data_size)
+cdef int WeightedEM(double* init_allele_freq,
+                    double* class_allele_likelihood,
+                    double* class_weight,
+                    double* marginal_likelihood,
+                    double* expect_allele_prob,
+                    int nclass,
+                    int ntype,
+                    int iter_num,
+                    double epsilon)
+
+# The type of per-sample information in ``BatchInfo``
+ctypedef fused sample_info_t:
+    uint8_t
+    uint16_t
+
+cdef tuple strand_bias(bytes ref_base, list alt_bases, uint8_t *base_codes, char *strands, int size)
+cdef tuple strand_bias_by_counts(int ref_fwd, int ref_rev, int alt_fwd, int alt_rev)
+cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, uint8_t *base_codes, sample_info_t *info,
+                                   int data_size)
+cdef double normal_sf(double x)
+
+# The information for rank sum test in ``SiteAnnotation``
+cdef enum:
+    RANKSUM_MAPQ = 0
+    RANKSUM_BASEQ = 1
+    RANKSUM_READPOS = 2
+
+cdef class SiteAnnotation:
+    cdef uint8_t *base_codes
+    cdef char *strands
+    cdef uint8_t *mapqs
+    cdef uint8_t *base_quals
+    cdef uint16_t *read_pos_rank
+    cdef int size
+
+    # [+, -] of A/C/G/T, index by base code
+    cdef uint32_t strand_counts[(BASE_CODE_T + 1) * 2]
+
+    # Histograms of A/C/G/T for rank sum tests, index by base code
+    cdef bint has_histograms
+    cdef uint32_t *mapq_hist
+    cdef uint32_t *baseq_hist
+    cdef uint32_t *read_pos_hist
+    cdef int read_pos_num
+    cdef int read_pos_capacity
+
+    # The last result of strand bias
+    cdef int sb_counts[4]
+    cdef tuple sb_result
 
+    cdef void reset(self, uint8_t *base_codes, char *strands, uint8_t *mapqs, uint8_t *base_quals,
+                    uint16_t *read_pos_rank, int size)
+    cdef void _build_histograms(self)
+    cdef bytes major_alt_base(self, bytes ref_base)
+    cdef tuple strand_bias(self, bytes ref_base, list alt_bases)
+    cdef double ranksum(self, bytes ref_base, list alt_bases, int info_type)
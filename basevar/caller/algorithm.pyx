@@ -1,13 +1,23 @@
 """
 This module contain some main algorithms of BaseVar
 """
-from scipy.stats.distributions import norm
+import sys
 
+from basevar.log import logger
 from basevar.io.htslibWrapper cimport kt_fisher_exact
+from basevar.caller.batch cimport encode_base, BASE_CODE_N, BASE_CODE_A, BASE_CODE_T, BASE_CODE_INDEL
 
 cdef extern from "math.h":
     double log10(double)
 
+DEF M_SQRT1_2 = 0.70710678118654752440  # 1/sqrt(2)
+DEF HIST_SIZE = 256  # mapping quality and base quality are uint8_t
+DEF INIT_READ_POS_CAPACITY = 512
+
+# The order of the most covered bases when they have the same depth, which is the same
+# as sorting the ``base_depth`` dict of [A, C, G, T] in ``variantcaller._out_cvg_file``.
+cdef list TIE_ORDER_BASES = ['A', 'C', 'T', 'G']
+
 
 cdef void EM(double* init_allele_freq,
              double* ind_allele_likelihood,
@@ -24,37 +34,79 @@ cdef void EM(double* init_allele_freq,
     return
 
 
-cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases, int *info, int data_size):
+cdef int WeightedEM(double* init_allele_freq,
+                    double* class_allele_likelihood,
+                    double* class_weight,
+                    double* marginal_likelihood,
+                    double* expect_allele_prob,
+                    int nclass,
+                    int ntype,
+                    int iter_num,
+                    double epsilon):
+    """The same as ``EM`` but the individuals with the same likelihood are collapsed into
+    ``nclass`` classes, ``class_weight`` is the number of individuals of each class.
+
+    Return the number of EM steps.
+    """
+    return em_weighted(init_allele_freq, class_allele_likelihood, class_weight, marginal_likelihood,
+                       expect_allele_prob, nclass, ntype, iter_num, epsilon)
+
+
+cdef void _set_allele_class(bytes ref_base, list alt_bases, uint8_t *allele_class):
+    """Mark the base codes: 1 for ``ref_base``, 2 for ``alt_bases`` and 0 for the others.
+    Only A/C/G/T could be REF or ALT here, 'N', indels and the other bases are all ignored.
+    """
+    cdef int i
+    for i in range(BASE_CODE_T + 1):
+        allele_class[i] = 0
+
+    cdef uint8_t code
+    for b in alt_bases:
+        code = encode_base(b)
+        if BASE_CODE_A <= code <= BASE_CODE_T:
+            allele_class[code] = 2
+
+    code = encode_base(ref_base)
+    if BASE_CODE_A <= code <= BASE_CODE_T:
+        allele_class[code] = 1
+
+    return
+
+
+cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, uint8_t *base_codes, sample_info_t *info,
+                                   int data_size):
     """Mann-Whitney-Wilcoxon Rank Sum Test for REF and ALT array.
 
-    ``bases`` : A string array
+    ``base_codes`` : A base code array
              A tuple content pair-data for sample_base with other.
              
     ``info`` : A integer array
-        ``info`` is the same size as ``bases`` for record information for bases
-        e.g: ``bases`` = sample_base and ``info`` is mapqs (mapping quality)
+        ``info`` is the same size as ``base_codes`` for record information for bases
+        e.g: ``base_codes`` = sample_base and ``info`` is mapqs (mapping quality)
 
     """
     cdef double* ref = <double*>(malloc(data_size * sizeof(double)))
     cdef double* alt = <double*>(malloc(data_size * sizeof(double)))
 
+    cdef uint8_t allele_class[BASE_CODE_T + 1]
+    _set_allele_class(ref_base, alt_base, allele_class)
+
     cdef int i = 0
     cdef int size_ref = 0
     cdef int size_alt = 0
-    cdef char *b
-    cdef int d
+    cdef uint8_t code
     for i in range(data_size):
 
-        b, d = bases[i], info[i]
-        if b[0] in ['N', '-', '+']:
+        code = base_codes[i]
+        if code > BASE_CODE_T:
             continue
 
-        if b == ref_base:
-            ref[size_ref] = d
+        if allele_class[code] == 1:
+            ref[size_ref] = info[i]
             size_ref += 1
 
-        elif b in alt_base:
-            alt[size_alt] = d
+        elif allele_class[code] == 2:
+            alt[size_alt] = info[i]
             size_alt += 1
 
     if size_ref == 0 or size_alt == 0:
@@ -72,15 +124,9 @@ cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases,
     free(alt)
 
     cdef double z = RankSumTest(x, size_ref, y, size_alt)
-    cdef double pvalue = 2 * norm.sf(abs(z))
+    cdef double pvalue = 2 * normal_sf(fabs(z))
 
-    cdef double phred_scale_value
-    if pvalue == 1.0:
-        phred_scale_value = 0.0
-    elif pvalue > 0:
-        phred_scale_value = -10 * log10(pvalue)
-    else:
-        phred_scale_value = 10000.0
+    cdef double phred_scale_value = _phred_scale(pvalue)
 
     free(x)
     free(y)
@@ -88,7 +134,7 @@ cdef double ref_vs_alt_ranksumtest(bytes ref_base, list alt_base, char **bases,
     return phred_scale_value
 
 
-cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *strands, int size):
+cdef tuple strand_bias(bytes ref_base, list alt_bases, uint8_t *base_codes, char *strands, int size):
     """
     A method for calculating the strand bias of REF_BASE and ALT_BASE
 
@@ -98,42 +144,55 @@ cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *stran
     :param alt_bases: array like, required
         A list of alt bases
 
-    :param sample_base: array-like, required
-        A list of bases cover this position
+    :param base_codes: array-like, required
+        The codes of bases cover this position
 
     :param strands: array-like, equired
-        '+' or '-' strand for each base in ``sample_base``
+        '+' or '-' strand for each base in ``base_codes``
 
     :return: list-like
         FS, ref_fwd, ref_rev, alt_fwd, alt_rev
     """
     cdef int ref_fwd = 0, ref_rev = 0, alt_fwd = 0, alt_rev = 0
 
+    cdef uint8_t allele_class[BASE_CODE_T + 1]
+    _set_allele_class(ref_base, alt_bases, allele_class)
+
     cdef int i = 0
+    cdef uint8_t c
     # for s, b in zip(strands, bases):
     for i in range(size):
 
         # ignore "N" or indels
-        if bases[i][0] in ['N', '-', '+']:
-            # `bases[i]` is char*
+        if base_codes[i] == BASE_CODE_N or base_codes[i] == BASE_CODE_INDEL:
             continue
 
+        c = allele_class[base_codes[i]] if base_codes[i] <= BASE_CODE_T else 0
         if strands[i] == '+':
-            if bases[i] == ref_base:
+            if c == 1:
                 ref_fwd += 1
 
-            elif bases[i] in alt_bases:
+            elif c == 2:
                 alt_fwd += 1
 
         elif strands[i] == '-':
-            if bases[i] == ref_base:
+            if c == 1:
                 ref_rev += 1
-            elif bases[i] in alt_bases:
+            elif c == 2:
                 alt_rev += 1
 
         else:
             raise ValueError('[ERROR] Get strange strand symbol: "%s"' % chr(strands[i]))
 
+    return strand_bias_by_counts(ref_fwd, ref_rev, alt_fwd, alt_rev)
+
+
+cdef tuple strand_bias_by_counts(int ref_fwd, int ref_rev, int alt_fwd, int alt_rev):
+    """FS and SOR of the strand counts of REF and ALT.
+
+    :return: list-like
+        FS, SOR, ref_fwd, ref_rev, alt_fwd, alt_rev
+    """
     cdef double left_p, right_p, twoside_p, fs
 
     # exact_fisher_test from htslib
@@ -149,3 +208,203 @@ cdef tuple strand_bias(bytes ref_base, list alt_bases, char **bases, char *stran
     # https://software.broadinstitute.org/gatk/documentation/tooldocs/current/org_broadinstitute_gatk_tools_walkers_annotator_StrandOddsRatio.php
     cdef double sor = float(ref_fwd * alt_rev) / (ref_rev * alt_fwd) if ref_rev * alt_fwd > 0 else 10000.0
     return (fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev)
+
+
+cdef double normal_sf(double x):
+    """Survival function (1 - cdf) of the standard normal distribution."""
+    return 0.5 * erfc(x * M_SQRT1_2)
+
+
+cdef double _phred_scale(double pvalue):
+    if pvalue == 1.0:
+        return 0.0
+    elif pvalue > 0:
+        return -10 * log10(pvalue)
+    else:
+        return 10000.0
+
+
+cdef double _ranksum_by_histograms(uint32_t *hist, int hist_size, uint8_t *allele_class):
+    """Mann-Whitney-Wilcoxon Rank Sum Test of REF and ALT from the histograms of A/C/G/T,
+    ``hist[code * hist_size + value]``. The ties are in average rank, the same as
+    ``RankSumTest`` in ranksumtest.c.
+    """
+    cdef double n1 = 0, n2 = 0  # size of REF and ALT
+    cdef double r1 = 0  # sum of the ranks of REF
+    cdef double cum = 0
+    cdef uint32_t ref_num, alt_num
+    cdef int v, code
+    for v in range(hist_size):
+
+        ref_num, alt_num = 0, 0
+        for code in range(BASE_CODE_A, BASE_CODE_T + 1):
+            if allele_class[code] == 1:
+                ref_num += hist[code * hist_size + v]
+            elif allele_class[code] == 2:
+                alt_num += hist[code * hist_size + v]
+
+        if ref_num + alt_num == 0:
+            continue
+
+        r1 += ref_num * (cum + (ref_num + alt_num + 1) / 2.0)
+        cum += ref_num + alt_num
+        n1 += ref_num
+        n2 += alt_num
+
+    if n1 == 0 or n2 == 0:
+        # -1 represent to None
+        return -1.0
+
+    cdef double z = (r1 - n1 * (n1 + n2 + 1) / 2.0) / sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    return _phred_scale(2 * normal_sf(fabs(z)))
+
+
+cdef class SiteAnnotation:
+    """Strand bias and rank sum tests of a site.
+
+    The strand counts are collected in one pass over the samples by ``reset``, the
+    histograms of mapping quality, base quality and read position are just built for
+    the first rank sum test of the site. All the tests are calculated from the counts.
+    """
+    def __cinit__(self):
+        self.mapq_hist = <uint32_t*>(calloc((BASE_CODE_T + 1) * HIST_SIZE, sizeof(uint32_t)))
+        self.baseq_hist = <uint32_t*>(calloc((BASE_CODE_T + 1) * HIST_SIZE, sizeof(uint32_t)))
+        self.read_pos_capacity = INIT_READ_POS_CAPACITY
+        self.read_pos_hist = <uint32_t*>(calloc((BASE_CODE_T + 1) * self.read_pos_capacity, sizeof(uint32_t)))
+        if self.mapq_hist == NULL or self.baseq_hist == NULL or self.read_pos_hist == NULL:
+            raise StandardError, "Could not allocate memory for SiteAnnotation"
+
+        self.size = 0
+        self.has_histograms = False
+        self.sb_result = None
+
+    def __dealloc__(self):
+        if self.mapq_hist != NULL:
+            free(self.mapq_hist)
+
+        if self.baseq_hist != NULL:
+            free(self.baseq_hist)
+
+        if self.read_pos_hist != NULL:
+            free(self.read_pos_hist)
+
+    cdef void reset(self, uint8_t *base_codes, char *strands, uint8_t *mapqs, uint8_t *base_quals,
+                    uint16_t *read_pos_rank, int size):
+        """Set a new site and count the strands of A/C/G/T."""
+        self.base_codes = base_codes
+        self.strands = strands
+        self.mapqs = mapqs
+        self.base_quals = base_quals
+        self.read_pos_rank = read_pos_rank
+        self.size = size
+
+        self.has_histograms = False
+        self.sb_result = None
+        memset(self.strand_counts, 0, sizeof(self.strand_counts))
+
+        cdef int i
+        cdef uint8_t code
+        for i in range(size):
+            code = base_codes[i]
+            if BASE_CODE_A <= code <= BASE_CODE_T:
+                if strands[i] == '+':
+                    self.strand_counts[2 * code] += 1
+                elif strands[i] == '-':
+                    self.strand_counts[2 * code + 1] += 1
+
+        return
+
+    cdef void _build_histograms(self):
+        """Histograms of A/C/G/T in one pass over the samples."""
+        memset(self.mapq_hist, 0, (BASE_CODE_T + 1) * HIST_SIZE * sizeof(uint32_t))
+        memset(self.baseq_hist, 0, (BASE_CODE_T + 1) * HIST_SIZE * sizeof(uint32_t))
+
+        cdef int i
+        cdef uint8_t code
+        cdef int max_read_pos = 0
+        for i in range(self.size):
+            code = self.base_codes[i]
+            if BASE_CODE_A <= code <= BASE_CODE_T:
+                self.mapq_hist[code * HIST_SIZE + self.mapqs[i]] += 1
+                self.baseq_hist[code * HIST_SIZE + self.base_quals[i]] += 1
+                if self.read_pos_rank[i] > max_read_pos:
+                    max_read_pos = self.read_pos_rank[i]
+
+        # read position is bounded by the read length
+        self.read_pos_num = max_read_pos + 1
+        if self.read_pos_num > self.read_pos_capacity:
+            free(self.read_pos_hist)
+            self.read_pos_capacity = self.read_pos_num
+            self.read_pos_hist = <uint32_t*>(calloc((BASE_CODE_T + 1) * self.read_pos_capacity,
+                                                    sizeof(uint32_t)))
+            if self.read_pos_hist == NULL:
+                logger.error("Could not allocate memory for read position histogram in SiteAnnotation.")
+                sys.exit(1)
+
+        memset(self.read_pos_hist, 0, (BASE_CODE_T + 1) * self.read_pos_num * sizeof(uint32_t))
+        for i in range(self.size):
+            code = self.base_codes[i]
+            if BASE_CODE_A <= code <= BASE_CODE_T:
+                self.read_pos_hist[code * self.read_pos_num + self.read_pos_rank[i]] += 1
+
+        self.has_histograms = True
+        return
+
+    cdef bytes major_alt_base(self, bytes ref_base):
+        """The most covered base which is not ``ref_base``."""
+        cdef bytes b
+        cdef bytes major_base = None
+        cdef uint32_t depth, major_depth = 0
+        cdef uint8_t code
+        for b in TIE_ORDER_BASES:
+            if b == ref_base:
+                continue
+
+            code = encode_base(b)
+            depth = self.strand_counts[2 * code] + self.strand_counts[2 * code + 1]
+            if major_base is None or depth > major_depth:
+                major_base, major_depth = b, depth
+
+        return major_base
+
+    cdef tuple strand_bias(self, bytes ref_base, list alt_bases):
+        """The same as ``strand_bias()`` but from the strand counts, the result is shared
+        by the calls with the same counts of REF and ALT."""
+        cdef uint8_t allele_class[BASE_CODE_T + 1]
+        _set_allele_class(ref_base, alt_bases, allele_class)
+
+        cdef int counts[4]
+        memset(counts, 0, sizeof(counts))
+
+        cdef int code
+        for code in range(BASE_CODE_A, BASE_CODE_T + 1):
+            if allele_class[code] == 1:
+                counts[0] += self.strand_counts[2 * code]
+                counts[1] += self.strand_counts[2 * code + 1]
+            elif allele_class[code] == 2:
+                counts[2] += self.strand_counts[2 * code]
+                counts[3] += self.strand_counts[2 * code + 1]
+
+        if self.sb_result is not None and counts[0] == self.sb_counts[0] and counts[1] == self.sb_counts[1] \
+                and counts[2] == self.sb_counts[2] and counts[3] == self.sb_counts[3]:
+            return self.sb_result
+
+        memcpy(self.sb_counts, counts, sizeof(counts))
+        self.sb_result = strand_bias_by_counts(counts[0], counts[1], counts[2], counts[3])
+        return self.sb_result
+
+    cdef double ranksum(self, bytes ref_base, list alt_bases, int info_type):
+        """Phred scale p-value of the rank sum test of REF and ALT for ``info_type``
+        (``RANKSUM_MAPQ``, ``RANKSUM_BASEQ`` or ``RANKSUM_READPOS``), -1 for None."""
+        if not self.has_histograms:
+            self._build_histograms()
+
+        cdef uint8_t allele_class[BASE_CODE_T + 1]
+        _set_allele_class(ref_base, alt_bases, allele_class)
+
+        if info_type == RANKSUM_MAPQ:
+            return _ranksum_by_histograms(self.mapq_hist, HIST_SIZE, allele_class)
+        elif info_type == RANKSUM_BASEQ:
+            return _ranksum_by_histograms(self.baseq_hist, HIST_SIZE, allele_class)
+        else:
+            return _ranksum_by_histograms(self.read_pos_hist, self.read_pos_num, allele_class)
@@ -1,9 +1,12 @@
 """Header for basetype.pyx
 """
+from libc.stdint cimport uint8_t
+
 cdef extern from "stdlib.h" nogil:
     void *malloc(size_t)
     void *calloc(size_t, size_t)
     void *memcpy(void *dst, void *src, size_t length)
+    void *memset(void *buffer, int ch, size_t size)
     void free(void *)
 
 cdef extern from "math.h" nogil:
@@ -13,6 +16,8 @@ cdef extern from "math.h" nogil:
     double log10(double)
 
 
+cdef double qual_to_pvalue(int qual)
+
 cdef class BaseTuple:
     cdef int combination_num
     cdef int base_num
@@ -29,16 +34,19 @@ cdef class BaseType:
     cdef double total_depth
     cdef double _var_qual
     cdef float min_af
-    cdef double *ind_allele_likelihood
+    cdef int class_num
+    cdef double *class_allele_likelihood  # one row per (base, quality) class
+    cdef double *class_weight  # number of individuals in each class
     cdef double *qual_pvalue
     cdef dict af_by_lrt
     cdef dict depth
 
-    cdef void cinit(self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af)
+    cdef void cinit(self, bytes ref_base, uint8_t *base_codes, uint8_t *quals, int total_sample_size, float min_af)
     cdef bint lrt(self, list specific_base_comb)
-    cdef void _set_init_ind_allele_likelihood(self, char **ind_bases, list base_element, int total_individual_num)
-    cdef double *_set_allele_frequence(self, tuple bases)
+    cdef void _set_init_class_allele_likelihood(self, uint8_t *ind_base_codes, uint8_t *ind_quals,
+                                                int total_individual_num)
     cdef double sum_likelihood(self, double *data, int num, bint is_log)
+    cdef double sum_weighted_log_likelihood(self, double *data, double *weight, int num)
     cdef BaseTuple _f(self, list bases, int n)
     cdef double *calculate_chivalue(self, double lr_alt, double *lr_null, int comb_num)
     cdef int find_argmin(self, double *data, int comb_num)
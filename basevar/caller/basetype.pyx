@@ -5,14 +5,43 @@ This module contain functions of LRT and Base genotype.
 import itertools  # Use the combinations function
 from scipy.stats.distributions import chi2
 
-from basevar.caller.algorithm cimport EM
+from basevar.caller.algorithm cimport WeightedEM
+from basevar.caller.batch cimport BASE_CODE_N, BASE_CODE_A, BASE_CODE_T, BASE_CODE_INDEL, BASE_CODE_OTHER
 
 DEF LRT_THRESHOLD = 24  # 24 corresponding to a chi-pvalue of 10^-6
 DEF QUAL_THRESHOLD = 60  # -10 * lg(10^-6)
 DEF MLN10TO10 = -0.23025850929940458  # log(10)/10
+DEF QUAL_VALUE_NUM = 256  # base qualities are uint8_t
 cdef list BASE = ['A', 'C', 'G', 'T']
 cdef dict BASE2IDX = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
 
+# Statistics of EM in this process, see ``em_statistics``
+DEF EM_RUN = 0
+DEF EM_STEPS = 1
+cdef long int EM_STATISTICS[2]  # zero initialized
+
+
+def em_statistics():
+    """Return the statistics of EM since the last ``reset_em_statistics``.
+
+    ``run``/``steps``: The number of EM runs and EM steps.
+    """
+    return {"run": EM_STATISTICS[EM_RUN],
+            "steps": EM_STATISTICS[EM_STEPS]}
+
+
+def reset_em_statistics():
+    cdef int i
+    for i in range(2):
+        EM_STATISTICS[i] = 0
+
+    return
+
+
+cdef double qual_to_pvalue(int qual):
+    """The probability of the base is right by its phred-scale quality."""
+    return 1.0 - exp(MLN10TO10 * qual)
+
 
 cdef class BaseTuple:
     def __cinit__(self, int combination_num, int base_num, int base_type_num):
@@ -72,7 +101,8 @@ cdef class BaseType:
         # do nothings
         pass
 
-    cdef void cinit (self, bytes ref_base, char **bases, int *quals, int total_sample_size, float min_af):
+    cdef void cinit (self, bytes ref_base, uint8_t *base_codes, uint8_t *quals, int total_sample_size,
+                     float min_af):
         """ Iinitial all the data here.
         
         A class for calculate the base probability
@@ -83,11 +113,11 @@ cdef class BaseType:
         ``ref_base``: A char, required
             The reference base
 
-        ``bases``: A array like, required
-            A list of base for samples.
+        ``base_codes``: A array like, required
+            A list of base code (``BASE_CODE_*`` in batch.pxd) for samples.
 
         ``quals``: An array like, required
-            Base quality for ``bases``. The same size with ``bases``
+            Base quality for ``base_codes``. The same size with ``base_codes``
             Cause: The ``quals`` is an integer array which has be converted
                 by phred-scale
         """
@@ -102,7 +132,7 @@ cdef class BaseType:
         cdef int i = 0
         self.good_individual_num = 0
         for i in range(total_sample_size):
-            if bases[i][0] not in ['N', '-', '+']:
+            if base_codes[i] != BASE_CODE_N and base_codes[i] != BASE_CODE_INDEL:
                 self.good_individual_num += 1
 
         # qual_pvalue has to be for all, because we'll use this outside.
@@ -110,14 +140,14 @@ cdef class BaseType:
         assert self.qual_pvalue != NULL, "Could not allocate memory for qual_pvalue in BaseType"
 
         for i in range(total_sample_size):
-            self.qual_pvalue[i] = 1.0 - exp(MLN10TO10 * quals[i])
-
-        # A big 1-D array
-        self.ind_allele_likelihood = <double*>(calloc(self.good_individual_num * self.base_type_num, sizeof(double)))
-        assert self.ind_allele_likelihood != NULL, "Could not allocate memory for ind_allele_likelihood in BaseType"
-
-        # set allele likelihood for each individual and get depth
-        self._set_init_ind_allele_likelihood(bases, BASE, total_sample_size)
+            self.qual_pvalue[i] = qual_to_pvalue(quals[i])
+
+        # Individuals with the same (base, quality) have the same likelihood, collapse them
+        # into classes, so the cost of EM is independent of the size of cohort.
+        self.class_num = 0
+        self.class_allele_likelihood = NULL
+        self.class_weight = NULL
+        self._set_init_class_allele_likelihood(base_codes, quals, total_sample_size)
         self.total_depth = float(sum(self.depth.values()))
 
         # estimated allele frequency by EM and LRT
@@ -129,55 +159,84 @@ cdef class BaseType:
         """
         Free memory
         """
-        if self.ind_allele_likelihood != NULL:
-            free(self.ind_allele_likelihood)
+        if self.class_allele_likelihood != NULL:
+            free(self.class_allele_likelihood)
+
+        if self.class_weight != NULL:
+            free(self.class_weight)
 
         if self.qual_pvalue != NULL:
             free(self.qual_pvalue)
 
-    cdef void _set_init_ind_allele_likelihood(self, char **ind_bases, list base_element, int total_individual_num):
-
+    cdef void _set_init_class_allele_likelihood(self, uint8_t *ind_base_codes, uint8_t *ind_quals,
+                                                int total_individual_num):
+        """Set the allele likelihood for each (base, quality) class of good individuals
+        and get the depth of [A, C, G, T].
+        """
         cdef int i = 0
         cdef int j = 0
         cdef int k = 0
+        cdef int key
+        cdef uint8_t code
+        cdef int base_count[BASE_CODE_T + 1]
+        for k in range(BASE_CODE_T + 1):
+            base_count[k] = 0
+
+        # The class index of each (base, quality), -1 for not seen yet.
+        cdef int class_index[(BASE_CODE_OTHER + 1) * QUAL_VALUE_NUM]
+        memset(class_index, -1, sizeof(class_index))
+
+        cdef int *ind_class = <int*>(malloc(total_individual_num * sizeof(int)))
+        assert ind_class != NULL, "Could not allocate memory for ind_class in BaseType"
+
         for i in range(total_individual_num):
 
-            # Individual likelihood for [A, C, G, T], one sample per row
             # ignore all the 'N' bases and indels.
-            if ind_bases[i][0] not in ['N', '-', '+']:
+            code = ind_base_codes[i]
+            if code == BASE_CODE_N or code == BASE_CODE_INDEL:
+                ind_class[i] = -1
+                continue
 
-                # Just set allele likelihood for good individual
-                for k in range(self.base_type_num):
-                    if ind_bases[i] == base_element[k]:
-                        self.ind_allele_likelihood[j * self.base_type_num + k] = self.qual_pvalue[i]
-                    else:
-                        self.ind_allele_likelihood[j * self.base_type_num + k] = (1.0 - self.qual_pvalue[i])/3
+            key = code * QUAL_VALUE_NUM + ind_quals[i]
+            if class_index[key] < 0:
+                class_index[key] = self.class_num
+                self.class_num += 1
 
-                # iteration good individual
-                j += 1
+            ind_class[i] = class_index[key]
 
-                # record coverage for [ACGT]
-                if ind_bases[i] in self.depth:
-                    self.depth[ind_bases[i]] += 1
-        return
+            # record coverage for [ACGT]
+            if code <= BASE_CODE_T:
+                base_count[code] += 1
 
-    cdef double* _set_allele_frequence(self, tuple bases):
-        """
-        init the base likelihood by bases
+        for k in range(self.base_type_num):
+            self.depth[BASE[k]] = base_count[BASE_CODE_A + k]
 
-        ``bases``: a list like
-        """
-        # initial [A, C, G, T] to be 0.0
-        cdef double* allele_frequence = <double*>(calloc(self.base_type_num, sizeof(double)))
-        assert allele_frequence != NULL, (
-            "Could not allocate memory for allele_frequence in BaseType._set_allele_frequence")
+        # A big 1-D array, one class per row
+        self.class_allele_likelihood = <double*>(calloc(self.class_num * self.base_type_num, sizeof(double)))
+        self.class_weight = <double*>(calloc(self.class_num, sizeof(double)))
+        assert self.class_num == 0 or (self.class_allele_likelihood != NULL and self.class_weight != NULL), (
+            "Could not allocate memory for class_allele_likelihood in BaseType")
 
-        cdef bytes b
-        if self.total_depth > 0:
-            for b in bases:
-                allele_frequence[BASE2IDX[b]] = self.depth[b] / self.total_depth
+        for i in range(total_individual_num):
 
-        return allele_frequence
+            j = ind_class[i]
+            if j < 0:
+                continue
+
+            if self.class_weight[j] == 0:
+                # Individual likelihood for [A, C, G, T], the order of ``BASE`` is the same
+                # as BASE_CODE_A, BASE_CODE_C, BASE_CODE_G and BASE_CODE_T
+                code = ind_base_codes[i]
+                for k in range(self.base_type_num):
+                    if code == BASE_CODE_A + k:
+                        self.class_allele_likelihood[j * self.base_type_num + k] = self.qual_pvalue[i]
+                    else:
+                        self.class_allele_likelihood[j * self.base_type_num + k] = (1.0 - self.qual_pvalue[i])/3
+
+            self.class_weight[j] += 1
+
+        free(ind_class)
+        return
 
     cdef BaseTuple _f(self, list bases, int n):
         """
@@ -201,53 +260,65 @@ cdef class BaseType:
         >>> bc
         ... [('A', 'C', 'G'), ('A', 'C', 'T'), ('A', 'G', 'T'), ('C', 'G', 'T')]
 
+        Each EM starts from the depth of its own bases. There's no memo of the EM results:
+        the combinations in a call are all different, and ``lrt`` calls it once for each
+        size, so no base combination is fitted twice in one site.
         """
-        cdef double* init_allele_frequecies = NULL
-        cdef double* marginal_likelihood = NULL
+        cdef double* init_allele_frequecies = <double*>(calloc(self.base_type_num, sizeof(double)))
+        cdef double* marginal_likelihood = <double*>(calloc(self.class_num, sizeof(double)))
         cdef double* expect_allele_freq = NULL
+        assert init_allele_frequecies != NULL and marginal_likelihood != NULL, (
+            "Could not allocate memory for EM in BaseType._f")
 
         cdef list base_combs_tuple = [x for x in itertools.combinations(bases, n)]
         cdef int comb_num = len(base_combs_tuple)
 
         cdef BaseTuple base_tuple = BaseTuple(comb_num, n, self.base_type_num)
+        cdef tuple comb
         cdef int bi = 0
         cdef int i = 0
+        cdef int step_num
         for i in range(comb_num):
 
+            comb = base_combs_tuple[i]
+
             # initial the allele frequencies of [A, C, G, T]
-            init_allele_frequecies = self._set_allele_frequence(base_combs_tuple[i])
+            memset(init_allele_frequecies, 0, self.base_type_num * sizeof(double))
+            if self.total_depth > 0:
+                for b in comb:
+                    init_allele_frequecies[BASE2IDX[b]] = self.depth[b] / self.total_depth
+
             if self.sum_likelihood(init_allele_frequecies, self.base_type_num, False) == 0:
-                free(init_allele_frequecies)
                 continue
 
-            # reset every time
-            marginal_likelihood = <double*>(calloc(self.good_individual_num, sizeof(double)))
-            expect_allele_freq = <double*>(calloc(self.base_type_num, sizeof(double)))
-
-            EM(init_allele_frequecies,
-               self.ind_allele_likelihood,
-               marginal_likelihood, # update every loop
-               expect_allele_freq,  # update every loop
-               self.good_individual_num,
-               self.base_type_num,
-               100,  # EM iter_num
-               0.001) # EM epsilon
+            # reset every time, the EM result is written into ``base_tuple`` directly
+            memset(marginal_likelihood, 0, self.class_num * sizeof(double))
+            expect_allele_freq = base_tuple.alleles_freq_list[i]
+            step_num = WeightedEM(init_allele_frequecies,
+                                  self.class_allele_likelihood,
+                                  self.class_weight,
+                                  marginal_likelihood, # update every loop
+                                  expect_allele_freq,  # update every loop
+                                  self.class_num,
+                                  self.base_type_num,
+                                  100,  # EM iter_num
+                                  0.001) # EM epsilon
+
+            EM_STATISTICS[EM_RUN] += 1
+            EM_STATISTICS[EM_STEPS] += step_num
 
             for bi in range(n):
                 # each element is single base
-                base_tuple.base_comb_tuple[i][bi] = ord(base_combs_tuple[i][bi])
+                base_tuple.base_comb_tuple[i][bi] = ord(comb[bi])
 
             # Todo: Should we use log10 function instead of using log or not? check it carefully!
-            # sum the marginal likelihood
-            base_tuple.sum_marginal_likelihood[i] = self.sum_likelihood(
-                marginal_likelihood, self.good_individual_num, True)
-
-            base_tuple.alleles_freq_list[i] = expect_allele_freq
-
-            free(marginal_likelihood)
-            free(init_allele_frequecies)
+            # sum the marginal likelihood of all the good individuals
+            base_tuple.sum_marginal_likelihood[i] = self.sum_weighted_log_likelihood(
+                marginal_likelihood, self.class_weight, self.class_num)
 
         expect_allele_freq = NULL
+        free(marginal_likelihood)
+        free(init_allele_frequecies)
         return base_tuple
 
     cdef double sum_likelihood(self, double* data, int num, bint is_log):
@@ -262,6 +333,14 @@ cdef class BaseType:
         # a double-type value
         return s
 
+    cdef double sum_weighted_log_likelihood(self, double* data, double* weight, int num):
+        cdef double s = 0.0
+        cdef int i = 0
+        for i in range(num):
+            s += weight[i] * log(data[i])
+
+        return s
+
     cdef bint lrt(self, list specific_base_comb):
         """The main function. likelihood ratio test.
 
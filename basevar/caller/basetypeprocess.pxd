@@ -4,6 +4,7 @@ Author: Shujia Huang
 Date: 2019-06-10 09:19:19
 """
 from basevar.io.fasta cimport FastaFile
+from basevar.caller.popgroup cimport PopGroup
 
 cdef class BaseVarProcess:
     cdef list samples
@@ -13,11 +14,21 @@ cdef class BaseVarProcess:
     cdef list regions
     cdef dict dict_regions
     cdef dict popgroup
+    cdef PopGroup sample_group
 
     cdef basestring out_vcf_file
     cdef basestring out_cvg_file
     cdef basestring cache_dir
 
     cdef object options
+    cdef list _regions_in_reference_order(self)
+    cdef object _checkpoint_journal(self)
+    cdef list _output_files(self)
+    cdef list _window_files(self, basestring window)
+    cdef int _finished_windows(self, object journal, list windows)
+    cdef tuple _open_outputs(self, list file_names)
+    cdef void _gather_windows(self, object journal, list windows)
     cdef void run_variant_discovery_in_regions(self)
     cdef void run_variant_discovery_by_batchfiles(self)
+    cdef void run_variant_discovery_from_batch_store(self)
+    cdef void run_coverage_only(self)
@@ -6,19 +6,36 @@ This is a Process module for BaseType by BAM/CRAM
 import os
 import sys
 import time
+import resource
+import multiprocessing
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
-from basevar.io.fasta import FastaFile
+from basevar.io.fasta cimport FastaFile
 
 from basevar.log import logger
 from basevar import utils
+from basevar.io.openfile import Open
+from basevar.utils cimport fast_merge_files
+from basevar.caller.journal import CheckpointJournal, parameter_fingerprint
 
 from basevar.caller.variantcaller import output_header
+from basevar.caller.basetype import em_statistics, reset_em_statistics
+from basevar.io.bam import samfile_pool_statistics, read_statistics, reset_read_statistics
 from basevar.caller.variantcaller cimport variants_discovery
 from basevar.caller.variantcaller cimport variant_discovery_in_regions
-from basevar.caller.batchcaller cimport create_batchfiles_in_regions
+from basevar.caller.batchcaller cimport create_batchfiles_in_regions, stored_batchfiles_in_regions
+from basevar.caller.coverage cimport coverage_in_regions
+from basevar.caller.popgroup cimport PopGroup
 
 cdef bint REMOVE_BATCH_FILE = True
 
+# The batchfiles are created and consumed window by window, and the outputs are recorded
+# in the checkpoint journal window by window if ``smartrerun``.
+cdef long int GENOME_WINDOW_SIZE = 5000000
+
 cdef class BaseVarProcess:
     """
     simple class to repesent a single BaseVar process.
@@ -57,63 +74,228 @@ cdef class BaseVarProcess:
         if options.pop_group_file and len(options.pop_group_file):
             self.popgroup = utils.load_popgroup_info(self.samples, options.pop_group_file)
 
+        # group index of each sample, it's used for all the positions
+        self.sample_group = PopGroup(self.popgroup, len(self.samples))
+
     def run(self):
         # self.run_variant_discovery_in_regions()  # do not create batch files
-        self.run_variant_discovery_by_batchfiles()
+        if self.options.from_batch_store:
+            self.run_variant_discovery_from_batch_store()
+        elif self.out_vcf_file:
+            self.run_variant_discovery_by_batchfiles()
+        else:
+            # Just coverage, we don't need batchfiles
+            self.run_coverage_only()
+
         return
 
-    cdef void run_variant_discovery_by_batchfiles(self):
+    cdef list _regions_in_reference_order(self):
+        """[(chrid, regions), ...] in the order of chromosomes in reference, which is
+        the order of the final CVG and VCF files.
+        """
+        return [(chrid, self.dict_regions[chrid]) for chrid in self.fa_file_hd.refnames
+                if chrid in self.dict_regions]
+
+    cdef object _checkpoint_journal(self):
+        """The ``CheckpointJournal`` in ``cache_dir`` if ``smartrerun``, or None."""
+        if not self.options.smartrerun or not self.cache_dir:
+            return None
+
+        return CheckpointJournal(self.cache_dir, parameter_fingerprint(self.samples, self.align_files,
+                                                                       self.fa_file_hd.filename, self.regions,
+                                                                       self.options))
 
-        VCF = open(self.out_vcf_file, "w") if self.out_vcf_file else None
-        CVG = open(self.out_cvg_file, "w")
+    cdef list _output_files(self):
+        return [self.out_cvg_file, self.out_vcf_file] if self.out_vcf_file else [self.out_cvg_file]
+
+    cdef list _window_files(self, basestring window):
+        """The CVG and VCF of ``window`` (see ``_genome_windows``) in ``cache_dir`` for
+        ``smartrerun``, they're concatenated into the output files when all the windows are done.
+        """
+        return [os.path.join(self.cache_dir, "basevar.%s.%s" % (window.replace(":", "."), os.path.basename(f)))
+                for f in self._output_files()]
+
+    cdef int _finished_windows(self, object journal, list windows):
+        """The number of windows which are finished one by one in the previous run,
+        we resume from the next one.
+        """
+        cdef int n = 0
+        if journal is None:
+            return n
+
+        while n < len(windows) and journal.is_done("window", windows[n], self._window_files(windows[n])):
+            n += 1
+
+        if n > 0:
+            logger.info("%d/%d windows are finished in the checkpoint journal, resume from %s." % (
+                n, len(windows), windows[n] if n < len(windows) else "the end"))
+        return n
+
+    cdef tuple _open_outputs(self, list file_names):
+        """Open the CVG and VCF (None if there's no VCF) and write their headers."""
+        CVG = Open(file_names[0], "wb", tabix=True)
+        VCF = Open(file_names[1], "wb", tabix=True) if len(file_names) > 1 else None
         output_header(self.fa_file_hd.filename, self.samples, self.popgroup, CVG, out_vcf_handle=VCF)
 
-        if self.options.smartrerun:
-            utils.safe_remove(utils.get_last_modification_file(self.cache_dir))
+        # The records start at a new BGZF block, so the outputs could be concatenated block by block.
+        CVG.flush()
+        if VCF:
+            VCF.flush()
+
+        return CVG, VCF
+
+    cdef void _gather_windows(self, object journal, list windows):
+        """Concatenate the outputs of all the windows in ``cache_dir`` into the output files."""
+        cdef list window_files = [self._window_files(w) for w in windows]
+        cdef int i
+        for i, out_file in enumerate(self._output_files()):
+            if window_files:
+                fast_merge_files([f[i] for f in window_files], out_file, False)
+
+        if not window_files:
+            for f in self._open_outputs(self._output_files()):
+                if f:
+                    f.close()
+
+        journal.remove()
+        for file_names in window_files:
+            for f in file_names:
+                utils.safe_remove(f)
+                utils.safe_remove(f + ".tbi")
+
+        return
+
+    cdef void run_coverage_only(self):
+        """Stream the reads into coverage counters and output the CVG file."""
+        cdef object journal = self._checkpoint_journal()
+        cdef list windows = []  # [(chrid, window, regions), ...]
+        for chrid, regions in self._regions_in_reference_order():
+            if journal is None:
+                windows.append((chrid, chrid, sorted(regions)))
+            else:
+                windows.extend([(chrid, w, r) for w, r in _genome_windows(chrid, regions)])
+
+        cdef list window_names = [w[1] for w in windows]
+        cdef int finished_num = self._finished_windows(journal, window_names)
+        if journal is None:
+            CVG, _ = self._open_outputs([self.out_cvg_file])
+
+        cdef bint is_empty = _is_empty_windows(journal, window_names[:finished_num])
+        for chrid, window, regions in windows[finished_num:]:
+
+            if journal is not None:
+                CVG, _ = self._open_outputs(self._window_files(window))
 
-        cdef long int region_boundary_start
-        cdef long int region_boundary_end
-        cdef int sample_num = len(self.samples)
-        cdef list total_batch_files = []
-        cdef bint is_empty = True
-        for chrid, regions in sorted(self.dict_regions.items(), key=lambda x: x[0]):
             start_time = time.time()
+            reset_read_statistics()
+            logger.info("**************** coverage process ****************")
+            try:
+                _is_empty = coverage_in_regions(chrid, regions, self.align_files, self.samples,
+                                                self.fa_file_hd, self.sample_group, CVG, self.options)
+            except Exception, e:
+                logger.error("Coverage process in %s. Error: %s" % (window, e))
+                sys.exit(1)
 
-            tmp_region = []
-            for p in regions:
-                tmp_region.extend(p)
-
-            tmp_region = sorted(tmp_region)
-            # get region boundary and set the coordinate to be 0-base
-            region_boundary_start = max(0, tmp_region[0] - 1)
-            region_boundary_end = min(tmp_region[-1] - 1, self.fa_file_hd.get_reference_length(chrid) - 1)
-
-            # set cache for fa sequence, this could make the program much faster
-            # And remember that ``fa_file_hd`` is 0-base system
-            self.fa_file_hd.set_cache_sequence(
-                chrid,
-                max(0, region_boundary_start - 5 * self.options.r_len),
-                min(region_boundary_end + 5 * self.options.r_len, self.fa_file_hd.get_reference_length(chrid) - 1)
-            )
+            if not _is_empty:
+                is_empty = False
+
+            if journal is not None:
+                CVG.close()
+                journal.done("window", window, self._window_files(window), "empty" if _is_empty else "")
 
-            batchfiles = create_batchfiles_in_regions(chrid,
-                                                      regions,
-                                                      region_boundary_start, # 0-base
-                                                      region_boundary_end, # 0-base
-                                                      self.align_files,
-                                                      self.fa_file_hd,
-                                                      self.samples,
-                                                      self.cache_dir,
-                                                      self.options)
+            _log_samfile_pool_statistics(<bytes>window)
+            _log_read_statistics(<bytes>window, self.options, time.time() - start_time)
+            logger.info("Running coverage process in %s done, %d seconds elapsed.\n" % (
+                window, time.time() - start_time))
 
-            logger.info("Batchfiles in %s:%s-%s for %d samples done, %d seconds elapsed." % (
-                chrid, region_boundary_start+1, region_boundary_end, sample_num, time.time() - start_time))
+        if journal is None:
+            CVG.close()
+        else:
+            self._gather_windows(journal, window_names)
 
+        self.fa_file_hd.close()
+
+        if is_empty:
+            logger.warning("\n***************************************************************************\n"
+                           "[WARNING] No reads are satisfy with the mapping quality (>=%d) in all of your\n"
+                           "input files. We get nothing in %s \n\n" % (self.options.mapq, self.out_cvg_file))
+
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            try:
+                os.removedirs(self.cache_dir)
+            except OSError:
+                logger.warning("Directory not empty: %s, please delete it by yourself\n" % self.cache_dir)
+
+        # double check
+        name = self.out_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY"
+        with open(name, "w") as OUT:
+            OUT.write("The process done.\n")
+
+        return
+
+    cdef void run_variant_discovery_by_batchfiles(self):
+
+        # The finished batchfiles and windows are recorded in the journal if ``smartrerun``,
+        # the outputs of each window are kept in ``cache_dir`` until all of them are done.
+        cdef object journal = self._checkpoint_journal()
+        if journal is None:
+            CVG, VCF = self._open_outputs(self._output_files())
+
+        # The batchfiles are created window by window, so the variants discovery could start
+        # as soon as the first window is done, and the batchfiles of a window are removed
+        # right after its variants discovery.
+        cdef long int region_boundary_start
+        cdef long int region_boundary_end
+        cdef list window_jobs = []  # [(window, (chrid, regions, region_boundary_start, region_boundary_end)), ...]
+        for chrid, regions in self._regions_in_reference_order():
+            for window, window_regions in _genome_windows(chrid, regions):
+                # get region boundary and set the coordinate to be 0-base
+                region_boundary_start = max(0, window_regions[0][0] - 1)
+                region_boundary_end = min(window_regions[-1][1] - 1, self.fa_file_hd.get_reference_length(chrid) - 1)
+                window_jobs.append((window, (chrid, window_regions, region_boundary_start, region_boundary_end)))
+
+        cdef list window_names = [w for w, _ in window_jobs]
+        cdef int finished_num = self._finished_windows(journal, window_names)
+        cdef list batch_jobs = [job for _, job in window_jobs[finished_num:]]
+
+        if self.options.pipeline_depth > 0:
+            # Batchfiles of the next windows are created in a child process while the
+            # variants discovery is running on the current one.
+            batchfile_iterator = _pipelined_batchfiles(batch_jobs,
+                                                       self.fa_file_hd.filename,
+                                                       self.align_files,
+                                                       self.samples,
+                                                       self.cache_dir,
+                                                       self.options,
+                                                       journal)
+        else:
+            batchfile_iterator = _serial_batchfiles(batch_jobs,
+                                                    self.fa_file_hd,
+                                                    self.align_files,
+                                                    self.samples,
+                                                    self.cache_dir,
+                                                    self.options,
+                                                    journal)
+
+        # Remove the batchfiles as soon as possible to cap the disk usage, the finished
+        # windows don't need them any more even if ``smartrerun``. The ones in
+        # ``batch_store`` are kept for the later runs.
+        cdef list total_batch_files = []
+        cdef bint is_empty = _is_empty_windows(journal, window_names[:finished_num])
+        cdef int i
+        for i, ((chrid, regions, region_boundary_start, region_boundary_end), batchfiles) in enumerate(
+                batchfile_iterator, finished_num):
+
+            window = window_names[i]
             start_time = time.time()
             logger.info("**************** variants discovery process ****************")
+            reset_em_statistics()
+            if journal is not None:
+                CVG, VCF = self._open_outputs(self._window_files(window))
+
+            # The batchfiles of the window are only in its regions.
             try:
-                _is_empty = variants_discovery(chrid, batchfiles, self.popgroup, self.options.min_af,
-                                               CVG, VCF)
+                _is_empty = variants_discovery(chrid, batchfiles, self.sample_group, self.options.min_af, CVG, VCF)
             except Exception, e:
                 logger.error("Variants discovery in region %s:%s-%s. Error: %s" % (
                     chrid, region_boundary_start+1, region_boundary_end+1, e))
@@ -122,14 +304,30 @@ cdef class BaseVarProcess:
             if not _is_empty:
                 is_empty = False
 
-            # collect together will be convenient when we want to clear up these temporary files.
-            total_batch_files += batchfiles
+            if journal is not None:
+                CVG.close()
+                if VCF:
+                    VCF.close()
+                journal.done("window", window, self._window_files(window), "empty" if _is_empty else "")
+
+            if REMOVE_BATCH_FILE and not self.options.batch_store:
+                for f in batchfiles:
+                    os.remove(f)
+            elif not self.options.batch_store:
+                # collect together will be convenient when we want to clear up these temporary files.
+                total_batch_files += batchfiles
+
+            em_stat = em_statistics()
+            logger.info("EM in %s: %d runs with %d steps." % (window, em_stat["run"], em_stat["steps"]))
             logger.info("Running variants_discovery in %s:%s-%s done, %d seconds elapsed.\n" % (
-                chrid, region_boundary_start+1, region_boundary_end, time.time() - start_time))
+                chrid, region_boundary_start+1, region_boundary_end+1, time.time() - start_time))
 
-        CVG.close()
-        if VCF:
-            VCF.close()
+        if journal is None:
+            CVG.close()
+            if VCF:
+                VCF.close()
+        else:
+            self._gather_windows(journal, window_names)
 
         self.fa_file_hd.close()
 
@@ -137,14 +335,64 @@ cdef class BaseVarProcess:
             logger.warning("\n***************************************************************************\n"
                            "[WARNING] No reads are satisfy with the mapping quality (>=%d) in all of your\n"
                            "input files. We get nothing in %s \n\n" % (self.options.mapq, self.out_cvg_file))
-            if VCF:
+            if self.out_vcf_file:
                 logger.warning("and %s " % self.out_vcf_file)
 
         if REMOVE_BATCH_FILE:
+            try:
+                os.removedirs(self.cache_dir)
+            except OSError:
+                logger.warning("Directory not empty: %s, please delete it by yourself\n" % self.cache_dir)
+
+        # double check
+        name = self.out_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY"
+        with open(name, "w") as OUT:
+            OUT.write("The process done.\n")
+
+        return
+
+    cdef void run_variant_discovery_from_batch_store(self):
+        """Run variants discovery in the regions directly from the batchfiles in
+        ``options.batch_store``, the batchfiles seek to the regions by their block index
+        and the alignment files are not read at all.
+        """
+        CVG, VCF = self._open_outputs(self._output_files())
 
-            for f in total_batch_files:
-                os.remove(f)
+        cdef bint is_empty = True
+        cdef list regions
+        for chrid, regions in self._regions_in_reference_order():
+
+            start_time = time.time()
+            logger.info("**************** variants discovery process ****************")
+            for sub_regions, batchfiles in stored_batchfiles_in_regions(self.options.batch_store, chrid,
+                                                                        sorted(regions), self.samples,
+                                                                        self.fa_file_hd, self.options):
+                try:
+                    _is_empty = variants_discovery(chrid, batchfiles, self.sample_group, self.options.min_af,
+                                                   CVG, VCF, sub_regions)
+                except Exception, e:
+                    logger.error("Variants discovery in %s:%s-%s from the batch store. Error: %s" % (
+                        chrid, sub_regions[0][0], sub_regions[-1][1], e))
+                    sys.exit(1)
+
+                if not _is_empty:
+                    is_empty = False
+
+            logger.info("Running variants_discovery in %s from the batch store done, %d seconds elapsed.\n" % (
+                chrid, time.time() - start_time))
+
+        CVG.close()
+        if VCF:
+            VCF.close()
+
+        self.fa_file_hd.close()
 
+        if is_empty:
+            logger.warning("\n***************************************************************************\n"
+                           "[WARNING] Nothing is found in the batch store %s for your regions, we get\n"
+                           "nothing in %s \n\n" % (self.options.batch_store, self.out_cvg_file))
+
+        if self.cache_dir and os.path.isdir(self.cache_dir):
             try:
                 os.removedirs(self.cache_dir)
             except OSError:
@@ -195,3 +443,147 @@ cdef class BaseVarProcess:
             OUT.write("The process done.\n")
 
         return
+
+
+cdef list _genome_windows(bytes chrid, list regions):
+    """Split the ``regions`` (1-base) of ``chrid`` into the windows of ``GENOME_WINDOW_SIZE``
+    in the genome: [(window name, [[start, end], ...] in the window), ...].
+    """
+    cdef list merged_regions = []
+    cdef long int start, end, window_end
+    for start, end in sorted(regions):
+        if merged_regions and start <= merged_regions[-1][1] + 1:
+            merged_regions[-1][1] = max(merged_regions[-1][1], end)
+        else:
+            merged_regions.append([start, end])
+
+    cdef list windows = []
+    cdef basestring window
+    for start, end in merged_regions:
+        while start <= end:
+            window_end = ((start - 1) / GENOME_WINDOW_SIZE + 1) * GENOME_WINDOW_SIZE
+            window = "%s:%d-%d" % (chrid, window_end - GENOME_WINDOW_SIZE + 1, window_end)
+            if windows and windows[-1][0] == window:
+                windows[-1][1].append([start, min(end, window_end)])
+            else:
+                windows.append((window, [[start, min(end, window_end)]]))
+
+            start = window_end + 1
+
+    return windows
+
+
+cdef bint _is_empty_windows(object journal, list windows):
+    """Return True if all the ``windows`` in the journal get nothing."""
+    return journal is None or all([journal.value("window", w) == "empty" for w in windows])
+
+
+cdef void _log_read_statistics(bytes chrid, object options, double elapsed):
+    """Memory and throughput of loading reads, we can compare them with and without ``--compress-reads``."""
+    read_stat = read_statistics()
+    logger.info("Reads in %s: %d reads (%.1f reads/s), sequences and qualities take %.1f MB in memory (%.1f MB "
+                "without compression, --compress-reads=%d), %.1f seconds for uncompressing, peak RSS %.1f MB." % (
+        chrid, read_stat["reads"], read_stat["reads"] / elapsed if elapsed > 0 else 0,
+        read_stat["stored_bytes"] / 1048576.0, read_stat["raw_bytes"] / 1048576.0, options.is_compress_read,
+        read_stat["uncompress_seconds"],
+        # ru_maxrss is in kilobytes on Linux
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    return
+
+
+cdef void _log_samfile_pool_statistics(bytes chrid):
+    pool_stat = samfile_pool_statistics()
+    logger.info("Alignment files after %s: %d hits, %d misses and %d evictions in the pool, "
+                "%d file descriptors are opened." % (chrid, pool_stat["hits"], pool_stat["misses"],
+                                                     pool_stat["evictions"], pool_stat["open_files"]))
+    return
+
+
+cdef list _create_window_batchfiles(tuple batch_job, FastaFile fa, list align_files, list samples,
+                                    basestring cache_dir, object options, object journal):
+    """Create the batchfiles of all the samples in one window (see ``_genome_windows``)."""
+    cdef bytes chrid = batch_job[0]
+    cdef list regions = batch_job[1]
+    cdef long int region_boundary_start = batch_job[2]
+    cdef long int region_boundary_end = batch_job[3]
+
+    start_time = time.time()
+    reset_read_statistics()
+
+    # set cache for fa sequence, this could make the program much faster
+    # And remember that ``fa`` is 0-base system and the end of cache is not included, the
+    # cache must cover the last base of contig, or a region at the end will replace it.
+    fa.set_cache_sequence(
+        chrid,
+        max(0, region_boundary_start - 5 * options.r_len),
+        min(region_boundary_end + 5 * options.r_len, fa.get_reference_length(chrid))
+    )
+
+    batchfiles = create_batchfiles_in_regions(chrid,
+                                              regions,
+                                              region_boundary_start, # 0-base
+                                              region_boundary_end, # 0-base
+                                              align_files,
+                                              fa,
+                                              samples,
+                                              cache_dir,
+                                              options,
+                                              journal)
+
+    _log_samfile_pool_statistics(chrid)
+    _log_read_statistics(chrid, options, time.time() - start_time)
+    logger.info("Batchfiles in %s:%s-%s for %d samples done, %d seconds elapsed." % (
+        chrid, region_boundary_start+1, region_boundary_end, len(samples), time.time() - start_time))
+
+    return batchfiles
+
+
+def _serial_batchfiles(batch_jobs, FastaFile fa, align_files, samples, cache_dir, options, journal=None):
+    """Create batchfiles window by window in the current process."""
+    for batch_job in batch_jobs:
+        yield batch_job, _create_window_batchfiles(batch_job, fa, align_files, samples, cache_dir, options, journal)
+
+
+def _batchfiles_producer(batchfile_queue, batch_jobs, ref_file, align_files, samples, cache_dir, options,
+                         journal=None):
+    """Create batchfiles for ``batch_jobs`` in order and put them into ``batchfile_queue``.
+
+    This function is the target of the producer process, ``batchfile_queue.put()`` will
+    block when the queue is full, that's how the disk usage of batchfiles is capped.
+    """
+    # Don't share the file handle of reference with the parent process.
+    cdef FastaFile fa = FastaFile(ref_file, ref_file + ".fai")
+    for batch_job in batch_jobs:
+        batchfile_queue.put(_create_window_batchfiles(batch_job, fa, align_files, samples, cache_dir, options,
+                                                      journal))
+
+    fa.close()
+    return
+
+
+def _pipelined_batchfiles(batch_jobs, ref_file, align_files, samples, cache_dir, options, journal=None):
+    """Yield the batchfiles of ``batch_jobs`` in order, which are created by a producer process
+    at most ``options.pipeline_depth`` windows ahead of the consumer.
+    """
+    batchfile_queue = multiprocessing.Queue(maxsize=options.pipeline_depth)
+    producer = multiprocessing.Process(target=_batchfiles_producer,
+                                       args=(batchfile_queue, batch_jobs, ref_file, align_files,
+                                             samples, cache_dir, options, journal))
+    producer.daemon = True  # Don't leave the producer alone if the consumer is terminated.
+    producer.start()
+
+    for batch_job in batch_jobs:
+        while True:
+            try:
+                batchfiles = batchfile_queue.get(timeout=1)
+                break
+            except Empty:
+                if not producer.is_alive():
+                    logger.error("The process of creating batchfiles is terminated unexpectedly (exitcode: %s) "
+                                 "in %s:%s-%s." % (producer.exitcode, batch_job[0], batch_job[2]+1, batch_job[3]+1))
+                    sys.exit(1)
+
+        yield batch_job, batchfiles
+
+    producer.join()
+    return
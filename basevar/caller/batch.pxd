@@ -3,6 +3,8 @@
 Author: Shujia Huang
 Date: 2019-06-05 10:28:22
 """
+from libc.stdint cimport uint8_t, uint16_t
+
 from basevar.io.fasta cimport FastaFile
 from basevar.io.read cimport cAlignedRead
 
@@ -13,15 +15,49 @@ cdef extern from "stdlib.h" nogil:
     void free(void *)
 
 cdef extern from "string.h":
-    ctypedef int size_t
     char *strcpy(char *dest, char *src)
     char *strcat(char *dest, char *src)
     int strcmp(const char *s1, const char *s2)
     size_t strlen(char *s)
+    void *memset(void *s, int c, size_t n)
+    void *memcpy(void *dest, const void *src, size_t n)
+
+
+# 1-byte code for each base of samples. The strings of ``BASE_CODE_INDEL`` and
+# ``BASE_CODE_OTHER`` (any single base which is not A/C/G/T/N) are kept in the
+# sparse ``other_*`` arrays of ``BatchInfo``.
+cdef enum:
+    BASE_CODE_N = 0
+    BASE_CODE_A = 1
+    BASE_CODE_C = 2
+    BASE_CODE_G = 3
+    BASE_CODE_T = 4
+    BASE_CODE_INDEL = 5
+    BASE_CODE_OTHER = 6
+
+cdef uint8_t encode_base(const char *base)
+cdef const char *decode_base(uint8_t code)
+
+
+cdef class BatchArena:
+    """Memory pool for all the ``BatchInfo`` in one window, freed in one shot."""
+    cdef char **chunks
+    cdef int chunk_num
+    cdef int chunk_capacity
+    cdef size_t chunk_size
+    cdef size_t chunk_used
+    cdef readonly size_t total_size
+    cdef dict alleles  # interned indel alleles
+
+    cdef void *alloc(self, size_t size)
+    cdef char *intern(self, char *allele)
+
+
+cdef size_t batchinfo_block_size(int size)
 
 
 cdef class BatchInfo:
-    # record the size of array: `*mapqs`==`*strands`==`**sample_bases` == `*sample_base_quals` == `*read_pos_rank`
+    # record the size of array: `*mapqs`==`*strands`==`*base_codes` == `*sample_base_quals` == `*read_pos_rank`
     cdef int size
     cdef int __capacity
 
@@ -30,27 +66,30 @@ cdef class BatchInfo:
     cdef bytes ref_base
     cdef int depth
 
-    cdef char **sample_bases  # could be indel sequence
-    cdef int *sample_base_quals
-    cdef int *read_pos_rank
-    cdef int *mapqs
+    cdef BatchArena arena
+
+    cdef uint8_t *base_codes  # BASE_CODE_*
+    cdef uint8_t *sample_base_quals
+    cdef uint16_t *read_pos_rank
+    cdef uint8_t *mapqs
     cdef char *strands
-    cdef int *is_empty
+    cdef uint8_t *is_empty
+
+    # the strings of BASE_CODE_INDEL and BASE_CODE_OTHER: sample index => allele
+    cdef int other_num
+    cdef int __other_capacity
+    cdef int *other_index
+    cdef char **other_bases
 
     cdef void set_empty(self)
     cdef void set_size(self, int size)
-    cdef void clear(self)
+    cdef void set_base(self, int index, char *base)
+    cdef const char *get_base(self, int index)
     cdef void update_info_by_index(self, int index, bytes _target_chrom, long int _target_position, int mapq,
                                    char map_strand, char *read_base, int base_qual, int read_pos_rank)
     cdef basestring get_str(self)
 
 
-# ``_Cigar_string``, ``_Cigar_char`` and ``_Cigar_int`` are all for matching the type
-# in ``BatchInfo``
-ctypedef struct _CigarString:
-    int n
-    char *b
-
 ctypedef struct _CigarInt:
     int n
     int b
@@ -59,10 +98,6 @@ ctypedef struct _CigarChar:
     int n
     char b
 
-ctypedef struct _CigarStringArray:
-    int size
-    _CigarString *data
-
 ctypedef struct _CigarCharArray:
     int size
     _CigarChar *data
@@ -72,17 +107,15 @@ ctypedef struct _CigarIntArray:
     _CigarInt *data
 
 ctypedef struct BatchCigar:
-    # string(or char**) type
-    _CigarStringArray sample_bases_cigar
+    # single char type
+    _CigarCharArray base_codes_cigar
+    _CigarCharArray strands_cigar
 
     # int type
     _CigarIntArray sample_base_quals_cigar
     _CigarIntArray read_pos_rank_cigar
     _CigarIntArray mapqs_cigar
 
-    # single char type
-    _CigarCharArray strands_cigar
-
 cdef class PositionBatchCigarArray:
     """A class just convert BatchInfo value into Element as a compress value to save memory!"""
 
@@ -91,6 +124,7 @@ cdef class PositionBatchCigarArray:
     cdef bytes ref_base
 
     cdef BatchCigar *array
+    cdef list other_bases  # [(sample index, allele), ...] of BASE_CODE_INDEL and BASE_CODE_OTHER
 
     cdef int __size
     cdef int __capacity
@@ -101,9 +135,9 @@ cdef class PositionBatchCigarArray:
     cdef void append(self, BatchInfo value)
     cdef BatchInfo convert_position_batch_cigar_array_to_batchinfo(self) # convert the whole array into one BatchInfo
 
-    cdef _CigarStringArray _compress_string(self, char **data, int size)
     cdef _CigarCharArray _compress_char(self, char *data, int size)
-    cdef _CigarIntArray _compress_int(self, int *data, int size)
+    cdef _CigarIntArray _compress_uint8(self, uint8_t *data, int size)
+    cdef _CigarIntArray _compress_uint16(self, uint16_t *data, int size)
     cdef BatchCigar _BatchInfo2BatchCigar(self, BatchInfo value)
 
 
@@ -121,6 +155,7 @@ cdef class BatchGenerator:
     cdef int min_base_qual
 
     cdef int sample_size
+    cdef BatchArena arena
     cdef list batch_heap
     cdef long int start_pos_in_batch_heap
 
@@ -14,7 +14,7 @@ cdef int SIN = 0  # Just a single base
 cdef int INS = 1
 cdef int DEL = 2
 
-# the same with definition in read.pyx
+# the same definition in read.pyx
 cdef int LOW_QUAL_BASES = 0
 cdef int UNMAPPED_READ = 1
 cdef int MATE_UNMAPPED = 2
@@ -23,9 +23,126 @@ cdef int SMALL_INSERT = 4
 cdef int DUPLICATE = 5
 cdef int LOW_MAP_QUAL = 6
 
+DEF MAX_READ_POS_RANK = 65535
+DEF ARENA_CHUNK_SIZE = 1048576  # 1M
+DEF INIT_OTHER_CAPACITY = 4
+
+# All the single bases, index by base code.
+cdef char *CODE_BASE_STRING = b"N\x00A\x00C\x00G\x00T\x00"
+
+
+cdef uint8_t encode_base(const char *base):
+    if base[0] == '-' or base[0] == '+':
+        return BASE_CODE_INDEL
+
+    if base[0] == 0 or base[1] != 0:
+        return BASE_CODE_OTHER
+
+    if base[0] == 'A':
+        return BASE_CODE_A
+    elif base[0] == 'C':
+        return BASE_CODE_C
+    elif base[0] == 'G':
+        return BASE_CODE_G
+    elif base[0] == 'T':
+        return BASE_CODE_T
+    elif base[0] == 'N':
+        return BASE_CODE_N
+    else:
+        return BASE_CODE_OTHER
+
+
+cdef const char *decode_base(uint8_t code):
+    """Return the '\\0' terminated base of ``code``, ``BASE_CODE_INDEL`` and
+    ``BASE_CODE_OTHER`` are not allowed here, use ``BatchInfo.get_base()`` for them.
+    """
+    if code > BASE_CODE_T:
+        return CODE_BASE_STRING
+
+    return CODE_BASE_STRING + 2 * code
+
+
+cdef inline size_t _align(size_t size, size_t n):
+    return (size + n - 1) / n * n
+
+
+cdef size_t batchinfo_block_size(int size):
+    """Memory size of the arrays in one ``BatchInfo``:
+    read_pos_rank(u16) + base_codes + sample_base_quals + mapqs + strands + is_empty(u8)"""
+    return _align(7 * size, 8)
+
+
+cdef class BatchArena:
+    """
+    A memory pool for all the ``BatchInfo`` in one window. The arrays of ``BatchInfo`` are
+    cut from big chunks and freed together when the arena is dropped, instead of
+    allocating and freeing memory for every position.
+    """
+    def __cinit__(self, size_t chunk_size=ARENA_CHUNK_SIZE):
+        self.chunk_size = max(chunk_size, 8)
+        self.chunk_used = 0
+        self.total_size = 0
+        self.chunk_num = 0
+        self.chunk_capacity = 4
+        self.chunks = <char**>(calloc(self.chunk_capacity, sizeof(char*)))
+        if self.chunks == NULL:
+            raise MemoryError("Could not allocate memory for BatchArena.")
+
+        self.alleles = {}
+
+    def __dealloc__(self):
+        cdef int i
+        if self.chunks != NULL:
+            for i in range(self.chunk_num):
+                free(self.chunks[i])
+
+            free(self.chunks)
+            self.chunks = NULL
+
+    cdef void *alloc(self, size_t size):
+        """Return ``size`` bytes of zero memory which is 8-bytes aligned."""
+        size = _align(size, 8)
+
+        cdef char **temp = NULL
+        cdef size_t new_chunk_size
+        if self.chunk_num == 0 or self.chunk_used + size > self.chunk_size:
+
+            if self.chunk_num == self.chunk_capacity:
+                temp = <char**>(realloc(self.chunks, 2 * self.chunk_capacity * sizeof(char*)))
+                if temp == NULL:
+                    logger.error("Could not re-allocate memory for BatchArena.")
+                    sys.exit(1)
+
+                self.chunks = temp
+                self.chunk_capacity *= 2
+
+            # The following chunks are smaller, they're just for indels in most of the cases.
+            new_chunk_size = max(size, self.chunk_size if self.chunk_num == 0 else
+                                 min(self.chunk_size, ARENA_CHUNK_SIZE))
+            self.chunks[self.chunk_num] = <char*>(calloc(new_chunk_size, sizeof(char)))
+            if self.chunks[self.chunk_num] == NULL:
+                logger.error("Could not allocate %d bytes memory for BatchArena." % new_chunk_size)
+                sys.exit(1)
+
+            self.chunk_num += 1
+            self.chunk_size = new_chunk_size
+            self.chunk_used = 0
+            self.total_size += new_chunk_size
+
+        cdef void *m = self.chunks[self.chunk_num - 1] + self.chunk_used
+        self.chunk_used += size
+        return m
+
+    cdef char *intern(self, char *allele):
+        """Keep only one copy for the same allele in this arena."""
+        cdef bytes a = allele
+        cdef bytes interned = self.alleles.setdefault(a, a)
+        return <char*>interned
+
+
 # A class to store batch information.
 cdef class BatchInfo:
-    def __cinit__(self, bytes chrid, long int position=0, bytes ref_base=b'N', int size=0):
+    def __cinit__(self, bytes chrid, long int position=0, bytes ref_base=b'N', int size=0, BatchArena arena=None):
         self.size = size  # default size is as the same as capacity
         self.__capacity = size
         self.chrid = chrid
@@ -33,30 +150,24 @@ cdef class BatchInfo:
         self.ref_base = ref_base
 
         self.depth = 0
-        self.strands = <char*> (calloc(self.__capacity, sizeof(char)))
-        self.sample_bases = <char**> (calloc(self.__capacity, sizeof(char*)))
-        self.sample_base_quals = <int*> (calloc(self.__capacity, sizeof(int)))
-        self.mapqs = <int*> (calloc(self.__capacity, sizeof(int)))
-        self.read_pos_rank = <int*> (calloc(self.__capacity, sizeof(int)))
-        self.is_empty = <int*> (calloc(self.__capacity, sizeof(int)))
-
-        # check initialization
-        assert self.sample_bases != NULL, "Could not allocate memory for self.sample_bases in BatchInfo."
-        assert self.sample_base_quals != NULL, "Could not allocate memory for self.sample_base_quals in BatchInfo."
-        assert self.read_pos_rank != NULL, "Could not allocate memory for self.read_pos_rank in BaseInfo."
-        assert self.mapqs != NULL, "Could not allocate memory for self.mapqs in BaseInfo."
-        assert self.strands != NULL, "Could not allocate memory for self.strands in BatchInfo."
-        assert self.is_empty != NULL, "Could not allocate memory for self.is_empty in BaseInfo."
+        self.arena = arena if arena is not None else BatchArena(batchinfo_block_size(size))
+
+        # All the arrays are in one block of memory from arena
+        cdef char *block = <char*>(self.arena.alloc(batchinfo_block_size(self.__capacity)))
+        self.read_pos_rank = <uint16_t*>block
+        self.base_codes = <uint8_t*>(block + 2 * self.__capacity)
+        self.sample_base_quals = self.base_codes + self.__capacity
+        self.mapqs = self.sample_base_quals + self.__capacity
+        self.strands = <char*>(self.mapqs + self.__capacity)
+        self.is_empty = <uint8_t*>(self.strands + self.__capacity)
+
+        self.other_num = 0
+        self.__other_capacity = 0
+        self.other_index = NULL
+        self.other_bases = NULL
 
         # initialization and set empty mark for all the element, 1=>empty, 0=> not empty
-        cdef int i
-        for i in range(self.__capacity):
-            self.is_empty[i] = 1
-            self.mapqs[i] = 0
-            self.strands[i] = '.'
-            self.sample_bases[i] = 'N'
-            self.sample_base_quals[i] = 0
-            self.read_pos_rank[i] = 0
+        self.set_empty()
 
     def __str__(self):
         """
@@ -77,18 +188,56 @@ cdef class BatchInfo:
 
     cdef void set_empty(self):
         self.depth = 0
+        self.other_num = 0
 
-        cdef int i
-        for i in range(self.__capacity):
-            self.is_empty[i] = 1
-            self.mapqs[i] = 0
-            self.strands[i] = '.'
-            self.sample_bases[i] = 'N'
-            self.sample_base_quals[i] = 0
-            self.read_pos_rank[i] = 0
+        # base_codes, sample_base_quals, mapqs and read_pos_rank are all 0 (BASE_CODE_N)
+        memset(self.read_pos_rank, 0, 2 * self.__capacity)
+        memset(self.base_codes, 0, 3 * self.__capacity)
+        memset(self.strands, '.', self.__capacity)
+        memset(self.is_empty, 1, self.__capacity)
+        return
 
+    cdef void set_base(self, int index, char *base):
+        """Set the base of sample ``index``. The string of indels is not copied here, so make sure
+        ``base`` is alive as long as this ``BatchInfo`` is used, or intern it by ``self.arena``.
+        """
+        cdef uint8_t code = encode_base(base)
+        self.base_codes[index] = code
+        if code < BASE_CODE_INDEL:
+            return
+
+        cdef int *temp_index
+        cdef char **temp_bases
+        if self.other_num == self.__other_capacity:
+            # The old arrays are left in arena, there are just a few indels in each position.
+            self.__other_capacity = 2 * self.__other_capacity if self.__other_capacity else INIT_OTHER_CAPACITY
+            temp_index = <int*>(self.arena.alloc(self.__other_capacity * sizeof(int)))
+            temp_bases = <char**>(self.arena.alloc(self.__other_capacity * sizeof(char*)))
+            if self.other_num > 0:
+                memcpy(temp_index, self.other_index, self.other_num * sizeof(int))
+                memcpy(temp_bases, self.other_bases, self.other_num * sizeof(char*))
+
+            self.other_index = temp_index
+            self.other_bases = temp_bases
+
+        self.other_index[self.other_num] = index
+        self.other_bases[self.other_num] = base
+        self.other_num += 1
         return
 
+    cdef const char *get_base(self, int index):
+        """Return the base string of sample ``index``."""
+        cdef uint8_t code = self.base_codes[index]
+        if code < BASE_CODE_INDEL:
+            return decode_base(code)
+
+        cdef int i
+        for i in range(self.other_num - 1, -1, -1):
+            if self.other_index[i] == index:
+                return self.other_bases[i]
+
+        return decode_base(BASE_CODE_N)
+
     cdef basestring get_str(self):
 
         cdef list sample_bases = []
@@ -100,7 +249,7 @@ cdef class BatchInfo:
         cdef int i = 0
         if self.depth > 0:
             for i in range(self.size):
-                sample_bases.append(self.sample_bases[i])  # Note: sample_bases must all be upper
+                sample_bases.append(self.get_base(i))  # Note: sample_bases must all be upper
                 sample_base_quals.append(str(self.sample_base_quals[i]))
                 read_pos_rank.append(str(self.read_pos_rank[i]))
                 strands.append(chr(self.strands[i]))
@@ -134,38 +283,16 @@ cdef class BatchInfo:
         self.mapqs[index] = mapq
         self.strands[index] = map_strand
         self.sample_base_quals[index] = base_qual
-        self.read_pos_rank[index] = read_pos_rank
+        self.read_pos_rank[index] = min(read_pos_rank, MAX_READ_POS_RANK)
 
-        cdef int base_size = strlen(read_base)
-        self.sample_bases[index] = <char*> (calloc(base_size, sizeof(char)))
-        strcpy(self.sample_bases[index], read_base)
-
-        return
+        if encode_base(read_base) < BASE_CODE_INDEL:
+            self.set_base(index, read_base)
+        else:
+            # ``read_base`` is a temporary string, keep it in arena and share it with all the positions
+            self.set_base(index, self.arena.intern(read_base))
 
-    cdef void clear(self):
-        # free memory
-        self.__dealloc__()
         return
 
-    def __dealloc__(self):
-        """Free memory"""
-        self.depth = 0
-        if self.strands != NULL:
-            free(self.strands)
-
-        if self.sample_bases != NULL:
-            free(self.sample_bases)
-
-        if self.sample_base_quals != NULL:
-            free(self.sample_base_quals)
-
-        if self.read_pos_rank != NULL:
-            free(self.read_pos_rank)
-
-        if self.mapqs != NULL:
-            free(self.mapqs)
-
-        return
 
 # compress the ``BatchInfo`` of ``BatchGenerator``
 cdef class PositionBatchCigarArray:
@@ -182,6 +309,7 @@ cdef class PositionBatchCigarArray:
         if self.array == NULL:
             raise StandardError, "Could not allocate memory for PositionBatchCigarArray"
 
+        self.other_bases = []
         self.__size = 0  # We don't put anything in here yet
         self.__capacity = array_size
         self.__sample_number = 0  # The number of samples which have been store in this array
@@ -196,7 +324,7 @@ cdef class PositionBatchCigarArray:
         if self.array != NULL:
             for i in range(self.__size):
                 batch_cigar = self.array[i]
-                free(batch_cigar.sample_bases_cigar.data)
+                free(batch_cigar.base_codes_cigar.data)
                 free(batch_cigar.sample_base_quals_cigar.data)
                 free(batch_cigar.read_pos_rank_cigar.data)
                 free(batch_cigar.mapqs_cigar.data)
@@ -226,6 +354,13 @@ cdef class PositionBatchCigarArray:
                 self.array = temp
                 self.__capacity *= 2
 
+        # keep the string of indels, the index is in the whole array
+        cdef int i
+        for i in range(value.other_num):
+            if value.other_index[i] < value.size:
+                self.other_bases.append((self.__sample_number + value.other_index[i],
+                                         <bytes>value.other_bases[i]))
+
         self.__depth += value.depth  # store coverage
         self.__sample_number += value.size
 
@@ -236,11 +371,11 @@ cdef class PositionBatchCigarArray:
         # Set BatchCigar to compress BatchInfo and save memory.
         cdef BatchCigar batch_cigar
 
-        batch_cigar.mapqs_cigar = self._compress_int(value.mapqs, value.size)
-        batch_cigar.sample_bases_cigar = self._compress_string(value.sample_bases, value.size)
+        batch_cigar.mapqs_cigar = self._compress_uint8(value.mapqs, value.size)
+        batch_cigar.base_codes_cigar = self._compress_char(<char*>value.base_codes, value.size)
 
-        batch_cigar.sample_base_quals_cigar = self._compress_int(value.sample_base_quals, value.size)
-        batch_cigar.read_pos_rank_cigar = self._compress_int(value.read_pos_rank, value.size)
+        batch_cigar.sample_base_quals_cigar = self._compress_uint8(value.sample_base_quals, value.size)
+        batch_cigar.read_pos_rank_cigar = self._compress_uint16(value.read_pos_rank, value.size)
         batch_cigar.strands_cigar = self._compress_char(value.strands, value.size)
 
         return batch_cigar
@@ -251,12 +386,10 @@ cdef class PositionBatchCigarArray:
         batch_info.depth = self.__depth
 
         cdef BatchCigar batch_cigar
-        cdef _CigarString cs
         cdef int i = 0, j = 0, _ = 0
 
         # index in batch_info
         cdef int m1 = 0, m2 = 0, m3 = 0, m4 = 0, m5 = 0
-        cdef int base_size = 0  # just for sample_bases
 
         cdef int total_base_array_size = 0
         cdef int total_qual_array_size = 0
@@ -268,26 +401,21 @@ cdef class PositionBatchCigarArray:
             batch_cigar = self.array[i]
 
             # These total_* are just for debug
-            total_base_array_size += batch_cigar.sample_bases_cigar.size
+            total_base_array_size += batch_cigar.base_codes_cigar.size
             total_qual_array_size += batch_cigar.sample_base_quals_cigar.size
             total_mapqs_array_size += batch_cigar.mapqs_cigar.size
             total_pos_rank_array_size += batch_cigar.read_pos_rank_cigar.size
             total_strand_array_size += batch_cigar.strands_cigar.size
 
-            # set ``sample_bases``
-            for j in range(batch_cigar.sample_bases_cigar.size):
-                # print ">> ", self.chrid, self.position, self.ref_base, batch_cigar.sample_bases_cigar.data[j].n, batch_cigar.sample_bases_cigar.data[j].b
-                if strcmp(batch_cigar.sample_bases_cigar.data[j].b, "N") != 0:
-
-                    for _ in range(batch_cigar.sample_bases_cigar.data[j].n):
-                        # copy char* type, must use strcpy().
-                        base_size = strlen(batch_cigar.sample_bases_cigar.data[j].b)
-                        batch_info.sample_bases[m1] = <char*>(calloc(base_size, sizeof(char)))
-                        strcpy(batch_info.sample_bases[m1], batch_cigar.sample_bases_cigar.data[j].b)
+            # set ``base_codes``
+            for j in range(batch_cigar.base_codes_cigar.size):
 
+                if batch_cigar.base_codes_cigar.data[j].b != BASE_CODE_N:
+                    for _ in range(batch_cigar.base_codes_cigar.data[j].n):
+                        batch_info.base_codes[m1] = batch_cigar.base_codes_cigar.data[j].b
                         m1 += 1
                 else:
-                    m1 += batch_cigar.sample_bases_cigar.data[j].n
+                    m1 += batch_cigar.base_codes_cigar.data[j].n
 
             # set ``sample_base_quals``
             for j in range(batch_cigar.sample_base_quals_cigar.size):
@@ -325,10 +453,17 @@ cdef class PositionBatchCigarArray:
                 if batch_cigar.strands_cigar.data[j].b != '.':
                     for _ in range(batch_cigar.strands_cigar.data[j].n):
                         batch_info.strands[m5] = batch_cigar.strands_cigar.data[j].b
+                        batch_info.is_empty[m5] = 0
                         m5 += 1
                 else:
                     m5 += batch_cigar.strands_cigar.data[j].n
 
+        # the strings of indels, which are shared by the same arena of ``batch_info``
+        cdef int index
+        cdef bytes allele
+        for index, allele in self.other_bases:
+            batch_info.set_base(index, batch_info.arena.intern(allele))
+
         if self.position % 100000 == 0:
             logger.debug("Position %s:%s has %d base array, %d qual array, %d mapqs array, "
                          "%d pos-rank array, %d strands array." % (
@@ -337,77 +472,72 @@ cdef class PositionBatchCigarArray:
 
         return batch_info
 
-    cdef _CigarStringArray _compress_string(self, char ** data, int size):
-        cdef _CigarString *cigar = <_CigarString*> (calloc(size, sizeof(_CigarString)))
+    cdef _CigarCharArray _compress_char(self, char *data, int size):
+        cdef _CigarChar *cigar = <_CigarChar*> (calloc(size, sizeof(_CigarChar)))
 
         cdef int last_index = 0
-        cdef int i = 0, base_size
+        cdef int i = 0
         for i in range(size):
 
             if i > 0:
-                if strcmp(data[i], cigar[last_index].b) == 0:
-                    # the two string is equal
+                if data[i] == cigar[last_index].b:
                     cigar[last_index].n += 1
                 else:
                     last_index += 1
-
-                    base_size = strlen(data[i])
-                    cigar[last_index].b = <char*> (calloc(base_size, sizeof(char)))
-                    strcpy(cigar[last_index].b, data[i])
-
+                    cigar[last_index].b = data[i]
                     cigar[last_index].n = 1
 
             # i == 0
             else:
+
                 last_index = 0
 
-                base_size = strlen(data[i])
-                cigar[last_index].b = <char*> (calloc(base_size, sizeof(char)))
-                strcpy(cigar[last_index].b, data[i])
+                cigar[last_index].b = data[i]
                 cigar[last_index].n = 1
 
-        cdef _CigarStringArray cigar_string_array
-        cigar_string_array.size = last_index + 1
-        cigar_string_array.data = <_CigarString*> (calloc(cigar_string_array.size, sizeof(_CigarString)))
-        for i in range(cigar_string_array.size):
-            cigar_string_array.data[i] = cigar[i]
+        cdef _CigarCharArray cigar_char_array
+        cigar_char_array.size = last_index + 1
+        cigar_char_array.data = <_CigarChar*> (calloc(cigar_char_array.size, sizeof(_CigarChar)))
+        for i in range(cigar_char_array.size):
+            cigar_char_array.data[i] = cigar[i]
 
         free(cigar)
-        return cigar_string_array
+        return cigar_char_array
 
-    cdef _CigarCharArray _compress_char(self, char *data, int size):
-        cdef _CigarChar *cigar = <_CigarChar*> (calloc(size, sizeof(_CigarChar)))
+    cdef _CigarIntArray _compress_uint8(self, uint8_t *data, int size):
+
+        cdef _CigarInt *cigar = <_CigarInt*> (calloc(size, sizeof(_CigarInt)))
 
         cdef int last_index = 0
         cdef int i = 0
         for i in range(size):
 
             if i > 0:
+
                 if data[i] == cigar[last_index].b:
                     cigar[last_index].n += 1
                 else:
                     last_index += 1
                     cigar[last_index].b = data[i]
                     cigar[last_index].n = 1
-
             # i == 0
             else:
 
                 last_index = 0
-
                 cigar[last_index].b = data[i]
                 cigar[last_index].n = 1
 
-        cdef _CigarCharArray cigar_char_array
-        cigar_char_array.size = last_index + 1
-        cigar_char_array.data = <_CigarChar*> (calloc(cigar_char_array.size, sizeof(_CigarChar)))
-        for i in range(cigar_char_array.size):
-            cigar_char_array.data[i] = cigar[i]
+        cdef _CigarIntArray cigar_int_array
+
+        cigar_int_array.size = last_index + 1
+        cigar_int_array.data = <_CigarInt*> (calloc(cigar_int_array.size, sizeof(_CigarInt)))
+        for i in range(cigar_int_array.size):
+            cigar_int_array.data[i] = cigar[i]
 
         free(cigar)
-        return cigar_char_array
+        return cigar_int_array
 
-    cdef _CigarIntArray _compress_int(self, int *data, int size):
+    cdef _CigarIntArray _compress_uint16(self, uint16_t *data, int size):
 
         cdef _CigarInt *cigar = <_CigarInt*> (calloc(size, sizeof(_CigarInt)))
 
@@ -472,9 +602,15 @@ cdef class BatchGenerator(object):
         self.ref_seq_start = max(0, self.reg_start - 200)
         self.ref_seq_end = min(self.reg_end + 200, self.ref_fa.references[self.ref_name].seq_length - 1)
 
-        # initialization the BatchInfo for each position in `ref_name:reg_start-reg_end`
+        # initialization the BatchInfo for each position in `ref_name:reg_start-reg_end`, all
+        # of them are in one arena which is freed in one shot with this window.
+        self.arena = BatchArena((reg_end - reg_start + 1) * batchinfo_block_size(sample_size))
+
+        # `ref_seq[i]` is the reference base of `reg_start + i`
+        cdef char *ref_seq = self.ref_fa.get_sequence_ptr(self.ref_name, reg_start-1, reg_end)
         cdef long int _pos  # `_pos` is 1-base system in the follow code.
-        self.batch_heap = [BatchInfo(ref_name, _pos, self.ref_fa.get_character(self.ref_name, _pos-1), sample_size)
+        self.batch_heap = [BatchInfo(ref_name, _pos, ref_seq[_pos-reg_start:_pos-reg_start+1], sample_size,
+                                     self.arena)
                            for _pos in range(reg_start, reg_end+1)]
         self.start_pos_in_batch_heap = reg_start  # 1-base, represent the first element in `batch_heap`
         self.options = options
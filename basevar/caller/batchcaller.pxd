@@ -20,4 +20,7 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
                                        FastaFile fa,
                                        list sample_ids,
                                        basestring outdir,
-                                       object options)
\ No newline at end of file
+                                       object options,
+                                       object journal=*)
+cdef list stored_batchfiles_in_regions(basestring batch_store, bytes chrom, list regions, list samples,
+                                       FastaFile fa, object options)
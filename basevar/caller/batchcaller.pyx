@@ -7,14 +7,135 @@ Date : 2016-07-19 14:14:21
 import os
 import sys
 import time
+import hashlib
 
 from basevar.log import logger
 
 from basevar.io.openfile import Open
 from basevar.io.fasta cimport FastaFile
-from basevar.io.bam cimport load_bamdata
+from basevar.io.bam cimport load_bamdata, uncompress_sample_reads
 from basevar.io.read cimport BamReadBuffer
-from basevar.caller.batch cimport BatchGenerator
+from basevar.caller.batch cimport BatchGenerator, BatchInfo
+from basevar.caller.batchfile cimport BatchFileWriter, BatchFileReader, is_binary_batchfile
+
+
+# The options which change the content of batchfiles.
+BATCH_PARAMETERS = ["mapq", "r_len", "max_reads", "qual_bin_size", "is_compress_read", "trim_overlapping",
+                    "trim_soft_clipped", "filter_duplicates", "filter_reads_with_unmapped_mates",
+                    "filter_reads_with_distant_mates", "filter_read_pairs_with_small_inserts"]
+
+
+cdef bytes batch_parameters(FastaFile fa, object options):
+    """The ``##CallParameters`` of the batchfiles in a batch store.
+
+    ``r_len`` is the one in the command line, it's raised by the longest read at runtime
+    (see ``_batch_buffers_in_window``) and the original one is kept in ``input_r_len``.
+    """
+    cdef dict values = dict([(k, getattr(options, k)) for k in BATCH_PARAMETERS])
+    values["r_len"] = getattr(options, "input_r_len", options.r_len)
+    return <bytes>(";".join(["reference=%s" % os.path.basename(fa.filename)] +
+                            ["%s=%s" % (k, values[k]) for k in BATCH_PARAMETERS]))
+
+
+cdef basestring stored_batchfile_name(basestring batch_store, basestring region_name, list batch_sample_ids,
+                                      basestring suffix):
+    """The batchfile of a block of samples in the batch store, it's named by the region
+    and the samples, so the same block of samples is always in the same file.
+    """
+    return os.path.join(batch_store, "basevar.%s.%s.%s" % (
+        region_name, hashlib.md5(",".join(batch_sample_ids)).hexdigest(), suffix))
+
+
+cdef bint is_stored_batchfile(bytes file_name, list batch_sample_ids, bytes parameters):
+    """Return True if the batchfile in store is for ``batch_sample_ids`` and created
+    with the same ``parameters``.
+    """
+    if not os.path.isfile(file_name):
+        return False
+
+    cdef list sample_ids = []
+    cdef bytes file_parameters = None
+    cdef BatchFileReader reader
+    if is_binary_batchfile(file_name):
+        reader = BatchFileReader(file_name)
+        sample_ids, file_parameters = reader.sample_ids, reader.parameters
+        reader.close()
+    else:
+        with Open(file_name, "rb") as I:
+            for line in I:
+                if not line.startswith("##"):
+                    break
+
+                if line.startswith("##SampleIDs="):
+                    sample_ids = line.strip().split("=", 1)[-1].split(",")
+                elif line.startswith("##CallParameters="):
+                    file_parameters = line.strip().split("=", 1)[-1]
+
+    if sample_ids != batch_sample_ids:
+        logger.warning("The samples in %s are not the same with this run." % file_name)
+        return False
+
+    if file_parameters != parameters:
+        logger.warning("%s is created with different parameters (%s)." % (file_name, file_parameters))
+        return False
+
+    return True
+
+
+cdef list stored_batchfiles_in_regions(basestring batch_store, bytes chrom, list regions, list samples,
+                                       FastaFile fa, object options):
+    """Find the binary batchfiles of all the blocks of ``samples`` in ``batch_store`` for
+    ``regions`` (1-base and sorted) of ``chrom``.
+
+    Return [(regions in the batchfiles, [batchfile of each block of samples]), ...] in the
+    order of positions, a position is only in one of them even if the regions of batchfiles
+    in store are overlapped.
+    """
+    cdef bytes parameters = batch_parameters(fa, options)
+    cdef int batchcount = options.batch_count
+    cdef list sample_blocks = [samples[i:i+batchcount] for i in range(0, len(samples), batchcount)]
+    cdef basestring prefix = "basevar.%s." % chrom
+    cdef basestring suffix = ".batch.bin"
+
+    # basevar.<chrom>.<start>.<end>.<md5 of samples>.batch.bin
+    cdef set stored_regions = set()
+    for name in os.listdir(batch_store):
+        if name.startswith(prefix) and name.endswith(suffix):
+            fields = name[len(prefix):-len(suffix)].split(".")
+            if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+                stored_regions.add((int(fields[0]), int(fields[1])))
+
+    cdef list stored_batchfiles = []
+    cdef long int covered_end = 0, covered_size = 0, lower
+    for start, end in sorted(stored_regions):
+        # The positions before ``covered_end`` are in the previous batchfiles.
+        lower = max(start, covered_end + 1)
+        sub_regions = [[max(reg_start, lower), min(reg_end, end)] for reg_start, reg_end in regions
+                       if reg_start <= end and reg_end >= lower]
+        if lower > end or not sub_regions:
+            continue
+
+        batchfiles = [stored_batchfile_name(batch_store, "%s.%s.%s" % (chrom, start, end), block, suffix[1:])
+                      for block in sample_blocks]
+        if not all([os.path.isfile(f) for f in batchfiles]):
+            # The batchfiles of another cohort or created by other regions.
+            continue
+
+        if not all([is_stored_batchfile(f, block, parameters) for f, block in zip(batchfiles, sample_blocks)]):
+            logger.warning("The batchfiles of %s:%s-%s in the batch store are not for the samples or parameters "
+                           "of this run, they're skipped." % (chrom, start, end))
+            continue
+
+        stored_batchfiles.append((sub_regions, batchfiles))
+        covered_end = sub_regions[-1][1]
+        covered_size += sum([reg_end - reg_start + 1 for reg_start, reg_end in sub_regions])
+
+    cdef long int region_size = sum([reg_end - reg_start + 1 for reg_start, reg_end in regions])
+    if covered_size < region_size:
+        logger.warning("%d/%d positions of %s are not in the batch store %s, they're ignored." % (
+            region_size - covered_size, region_size, chrom, batch_store))
+
+    return stored_batchfiles
 
 
 cdef list create_batchfiles_in_regions(bytes chrom_name,
@@ -25,12 +146,15 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
                                        FastaFile fa,
                                        list samples,
                                        basestring outdir,
-                                       object options):
+                                       object options,
+                                       object journal=None):
     """
     ``regions`` is a 2-D array
         They all are the some chromosome: [[start1,end1], [start2, end2], ...]
         
     ``samples``: The sample id of align_files
+    ``journal``: The ``CheckpointJournal`` of ``--smart-rerun``, the finished batchfiles in it are not
+        created again.
     ``fa``:
         # get sequence of chrom_name from reference fasta
         fa = self.ref_file_hd.fetch(chrid)
@@ -47,32 +171,53 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
                                               region_boundary_end+1.0*options.r_len)
     cdef char* refseq = refseq_bytes
 
+    # The text batchfile is just for debugging
+    cdef basestring batchfile_suffix = "batch.gz" if options.batch_format == "text" else "batch.bin"
+
+    # The batchfiles in ``options.batch_store`` are kept after variants discovery, and they're
+    # reused by the later runs if they have the same samples and parameters.
+    cdef bytes parameters = batch_parameters(fa, options) if options.batch_store else None
+    cdef basestring region_name = "%s.%s.%s" % (chrom_name, region_boundary_start+1, region_boundary_end+1)
+
     cdef int m = 0, i = 0
     for i in range(0, len(align_files), batchcount):
         # Create a batch of temp files which we call them batchfiles for variant discovery
         start_time = time.time()
 
+        # One batch of alignment files, the size and order are the same with ``sub_align_files`` and
+        # ``batch_sample_ids``
+        sub_align_files = align_files[i:i+batchcount]
+        batch_sample_ids = None
+        if samples:
+            batch_sample_ids = samples[i:i+batchcount]
+
         m += 1
-        part_file_name = "basevar.%s.%d_%d.batch.gz" % (
-            "%s.%s.%s" % (chrom_name, region_boundary_start+1, region_boundary_end+1), m, part_num)
-        part_file_name = os.path.join(outdir, part_file_name)  # Join Path could fix different OS
+        if options.batch_store:
+            part_file_name = stored_batchfile_name(options.batch_store, region_name, batch_sample_ids,
+                                                   batchfile_suffix)
+        else:
+            part_file_name = "basevar.%s.%d_%d.%s" % (region_name, m, part_num, batchfile_suffix)
+            part_file_name = os.path.join(outdir, part_file_name)  # Join Path could fix different OS
 
         # store the name of batchfiles into a list.
         batchfiles.append(part_file_name)
-        if options.smartrerun and os.path.isfile(part_file_name):
-            # ``part_file_name`` is exists We don't have to create it again if setting `smartrerun`
-            logger.info("%s already exists, we don't have to create it again, "
+        if options.batch_store and is_stored_batchfile(part_file_name, batch_sample_ids, parameters):
+            logger.info("%s is already in the batch store, we don't have to create it again." % part_file_name)
+            continue
+        elif journal is not None and journal.is_done("batch", part_file_name, [part_file_name]):
+            # ``part_file_name`` is finished in the previous run, we don't have to create it again.
+            logger.info("%s is already in the checkpoint journal, we don't have to create it again, "
                         "when you set `smartrerun`" % part_file_name)
             continue
         else:
             logger.info("Creating batchfile %s\n" % part_file_name)
 
-        # One batch of alignment files, the size and order are the same with ``sub_align_files`` and
-        # ``batch_sample_ids``
-        sub_align_files = align_files[i:i+batchcount]
-        batch_sample_ids = None
-        if samples:
-            batch_sample_ids = samples[i:i+batchcount]
+        # The batchfile in store is written into a temporary file first, so that a broken
+        # one would never be taken as a finished batchfile.
+        out_file_name = part_file_name
+        if options.batch_store:
+            out_file_name = os.path.join(os.path.dirname(part_file_name), "tmp.%d.%s" % (
+                os.getpid(), os.path.basename(part_file_name)))
 
         generate_batchfile(chrom_name,
                            region_boundary_start,  # 1-base
@@ -81,9 +226,16 @@ cdef list create_batchfiles_in_regions(bytes chrom_name,
                            sub_align_files,
                            refseq,
                            fa,
-                           part_file_name,
+                           out_file_name,
                            batch_sample_ids,
-                           options)
+                           options,
+                           parameters)
+
+        if out_file_name != part_file_name:
+            os.rename(out_file_name, part_file_name)
+
+        if journal is not None:
+            journal.done("batch", part_file_name, [part_file_name])
 
         logger.info("Done for batchfile %s , %d seconds elapsed." % (
             part_file_name, time.time() - start_time))
@@ -100,14 +252,20 @@ cdef void generate_batchfile(bytes chrom_name,
                              FastaFile fa,
                              bytes out_batch_file,
                              list batch_sample_ids,
-                             object options):
+                             object options,
+                             bytes parameters=None):
 
     """Loading bamfile and create a batchfile in ``regions``.
 
+    The regions are processed window by window (``options.window_size`` positions at most),
+    so the memory is capped by the size of window instead of the size of chromosome. The
+    reads which span two windows are fetched by both of them.
+
     Parameters:
         ``bigstart``: It's already 0-base position
         ``bigend``: It's already 0-base position
         ``regions``: The coordinate in regions is 1-base system.
+        ``parameters``: ``##CallParameters`` in the header, see ``batch_parameters``.
     """
     # Make bamfiles dict: {sample_id:bamfile,...,}
     cdef int sample_size = len(batch_sample_ids)
@@ -116,80 +274,148 @@ cdef void generate_batchfile(bytes chrom_name,
     for i in range(sample_size):
         bam_files[batch_sample_ids[i]] = batch_align_files[i]
 
+    cdef BatchFileWriter writer = None
+    text_handle = None
+    if options.batch_format == "text":
+        text_handle = _open_text_batch_file(out_batch_file, batch_sample_ids, parameters)
+    else:
+        writer = BatchFileWriter(out_batch_file, chrom_name, batch_sample_ids, parameters)
+
+    cdef list sorted_regions = sorted(regions)
+    cdef long int span_start = sorted_regions[0][0] if sorted_regions else 1
+    cdef long int span_end = max([reg_end for _, reg_end in sorted_regions]) if sorted_regions else 0
+    cdef long int win_start, win_end
+    cdef list window_regions, region_batch_buffers
+    for win_start in range(span_start, span_end + 1, options.window_size):
+        win_end = min(win_start + options.window_size - 1, span_end)
+        window_regions = [[max(reg_start, win_start), min(reg_end, win_end)]
+                          for reg_start, reg_end in sorted_regions if reg_start <= win_end and reg_end >= win_start]
+        if not window_regions:
+            continue
+
+        # ``ref_seq`` starts from ``bigstart``, and the one for ``load_bamdata`` starts from the window
+        region_batch_buffers = _batch_buffers_in_window(chrom_name, window_regions, bam_files, batch_sample_ids,
+                                                        ref_seq + (window_regions[0][0] - 1 - bigstart),
+                                                        fa, options)
+        if text_handle is not None:
+            output_batch_file(text_handle, region_batch_buffers)
+        else:
+            output_binary_batch_file(writer, region_batch_buffers)
+
+        # release the ``BatchInfo`` of this window before loading the next one
+        region_batch_buffers = None
+
+    if text_handle is not None:
+        text_handle.close()
+    else:
+        writer.close()
+
+    return
+
+
+cdef list _batch_buffers_in_window(bytes chrom_name, list window_regions, dict bam_files, list batch_sample_ids,
+                                   char *ref_seq, FastaFile fa, object options):
+    """Load the reads of ``batch_sample_ids`` which are overlapped with ``window_regions`` and
+    return the ``BatchGenerator`` of each region. ``window_regions`` is 1-base and sorted, and
+    ``ref_seq`` starts from the first position of the window.
+
+    The samples are walked one by one, if the reads are compressed, only the reads of current
+    sample are uncompressed, and they're released as soon as the sample is done.
+    """
+    cdef long int window_start = window_regions[0][0]
+    cdef long int window_end = window_regions[-1][1]
+
     cdef list sample_read_buffers
     try:
-        # load the whole mapping reads in [chrom_name, bigstart, bigend]
+        # load the whole mapping reads in [chrom_name, window_start, window_end]
         sample_read_buffers = load_bamdata(bam_files, batch_sample_ids, chrom_name,
-                                           bigstart-1, bigend-1, ref_seq, options)
+                                           window_start - 1, window_end, ref_seq, options)
 
     except Exception, e:
-        logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom_name, bigstart, bigend, e))
+        logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom_name, window_start, window_end, e))
         sys.exit(1)
 
-    if sample_read_buffers is None or len(sample_read_buffers) == 0:
-        logger.info("Skipping region %s:%s-%s as it's empty." % (chrom_name, bigstart, bigend))
-        return
-
+    cdef int sample_size = len(batch_sample_ids)
     cdef BatchGenerator batch_buffer
     cdef list region_batch_buffers = []
 
-    cdef int sample_index
-    cdef int longest_read_size = 0
-    cdef BamReadBuffer sample_read_buffer
     cdef long int reg_start, reg_end
-    for reg_start, reg_end in regions:
+    for reg_start, reg_end in window_regions:
         # initialization the BatchGenerator in `ref_name:reg_start-reg_end`
-        batch_buffer = BatchGenerator(chrom_name, reg_start, reg_end, fa, sample_size, options)
+        region_batch_buffers.append(BatchGenerator(chrom_name, reg_start, reg_end, fa, sample_size, options))
+
+    cdef int sample_index, k
+    cdef int longest_read_size = 0
+    cdef BamReadBuffer sample_read_buffer
+    for sample_index in range(len(sample_read_buffers)):
+        sample_read_buffer = sample_read_buffers[sample_index]
+        uncompress_sample_reads(sample_read_buffer, ref_seq, window_start - 1, options)
 
-        # loop all samples
-        for sample_index in range(sample_size):
-            sample_read_buffer = sample_read_buffers[sample_index]
-            if longest_read_size < sample_read_buffer.reads.get_length_of_longest_read():
-                longest_read_size = sample_read_buffer.reads.get_length_of_longest_read()
+        if longest_read_size < sample_read_buffer.reads.get_length_of_longest_read():
+            longest_read_size = sample_read_buffer.reads.get_length_of_longest_read()
 
-            # get batch information for each sample in [start, end]
+        # get batch information for each sample in each [reg_start, reg_end]
+        for k in range(len(window_regions)):
+            batch_buffer = region_batch_buffers[k]
             batch_buffer.create_batch_in_region(
-                (chrom_name, reg_start, reg_end),
+                (chrom_name, window_regions[k][0], window_regions[k][1]),
                 sample_read_buffer.reads.array,  # this start pointer will move automatically
                 sample_read_buffer.reads.array + sample_read_buffer.reads.get_size(),
                 sample_index  # sample_index is the index in ``BatchGenerator``
             )
 
-        # store information in each [reg_start, reg_end] of all samples
-        region_batch_buffers.append(batch_buffer)
+        # release the reads of this sample
+        sample_read_buffers[sample_index] = None
 
     # Todo: take care, although this code may not been called forever.
     if longest_read_size > options.r_len:
+        if not hasattr(options, "input_r_len"):
+            options.input_r_len = options.r_len
+
         options.r_len = longest_read_size
 
-    output_batch_file(chrom_name, fa, region_batch_buffers, out_batch_file, batch_sample_ids, regions)
+    return region_batch_buffers
+
+
+cdef void output_binary_batch_file(BatchFileWriter writer, list region_batch_buffers):
+    """Output batch information into a binary batchfile (BaseVarBatchFile_v2.0)."""
+    cdef BatchGenerator batch_buffer
+    cdef BatchInfo batch_info
+    for batch_buffer in region_batch_buffers:
+        for batch_info in batch_buffer.batch_heap:
+            writer.write(batch_info)
+
     return
 
 
-cdef void output_batch_file(bytes chrom_name, FastaFile fa, list region_batch_buffers, bytes out_batch_file,
-                            list batch_sample_ids, list regions):
+cdef object _open_text_batch_file(bytes out_batch_file, list batch_sample_ids, bytes parameters=None):
+    """Open the text batchfile (BaseVarBatchFile_v1.0) and output the header."""
+    OUT = Open(out_batch_file, "wb", isbgz=True) if out_batch_file.endswith(".gz") else \
+        open(out_batch_file, "w")
+
+    OUT.write("##fileformat=BaseVarBatchFile_v1.0\n")
+    if batch_sample_ids:
+        OUT.write("##SampleIDs=%s\n" % ",".join(batch_sample_ids))
+    if parameters:
+        OUT.write("##CallParameters=%s\n" % parameters)
+
+    suff_header = ["#CHROM", "POS", "REF", "Depth(CoveredSample)", "MappingQuality", "Readbases",
+                   "ReadbasesQuality", "ReadPositionRank", "Strand"]
+    OUT.write("%s\n" % "\t".join(suff_header))
+    return OUT
+
+
+cdef void output_batch_file(object OUT, list region_batch_buffers):
 
     cdef int region_number = len(region_batch_buffers)
     cdef int position_number = 0
     cdef int i = 0, j = 0
     cdef BatchGenerator batch_buffer
-    with Open(out_batch_file, "wb", isbgz=True) if out_batch_file.endswith(".gz") else \
-            open(out_batch_file, "w") as OUT:
+    for i in range(region_number):
 
-        OUT.write("##fileformat=BaseVarBatchFile_v1.0\n")
-        if batch_sample_ids:
-            OUT.write("##SampleIDs=%s\n" % ",".join(batch_sample_ids))
+        batch_buffer = region_batch_buffers[i]
+        position_number = len(batch_buffer.batch_heap)
+        for j in range(position_number):
+            OUT.write("%s\n" % batch_buffer.batch_heap[j])
 
-        suff_header = ["#CHROM", "POS", "REF", "Depth(CoveredSample)", "MappingQuality", "Readbases",
-                       "ReadbasesQuality", "ReadPositionRank", "Strand"]
-        OUT.write("%s\n" % "\t".join(suff_header))
-
-        for i in range(region_number):
-
-            batch_buffer = region_batch_buffers[i]
-            position_number = len(batch_buffer.batch_heap)
-            for j in range(position_number):
-                OUT.write("%s\n" % batch_buffer.batch_heap[j])
     return
-
-
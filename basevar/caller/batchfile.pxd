@@ -0,0 +1,64 @@
+"""Header for batchfile.pyx
+"""
+from libc.stdio cimport FILE
+from libc.stdint cimport int32_t, int64_t, uint8_t, uint16_t
+
+from basevar.caller.batch cimport BatchInfo
+
+cdef class BatchFileWriter:
+    cdef bytes filename
+    cdef FILE *fh
+    cdef int sample_num
+
+    cdef char *buffer
+    cdef size_t buffer_capacity
+
+    cdef size_t file_offset  # the offset of next record
+    cdef long int record_num
+    cdef list block_index  # [(position, offset), ...]
+
+    cdef void write(self, BatchInfo batchinfo)
+    cdef void _reserve(self, size_t size)
+    cdef void _write_block_index(self)
+    cdef void close(self)
+
+
+cdef class BatchFileReader:
+    cdef bytes filename
+    cdef int fd
+    cdef char *data
+    cdef size_t data_size
+    cdef size_t data_end  # the end of records
+    cdef size_t first_offset
+    cdef size_t offset
+    cdef int64_t *block_index  # [position, offset, ...] in ``data``
+    cdef long int index_num
+
+    cdef readonly bytes chrom
+    cdef readonly list sample_ids
+    cdef readonly bytes parameters  # ``##CallParameters``, None if it's not in the header
+    cdef readonly int sample_num
+
+    # information of current record
+    cdef long int position
+    cdef char ref_base
+    cdef int depth
+    cdef int covered_num
+    cdef int other_num
+    cdef int32_t *sample_index
+    cdef uint16_t *read_pos_rank
+    cdef uint8_t *base_code
+    cdef uint8_t *base_qual
+    cdef uint8_t *mapq
+    cdef uint8_t *strand
+    cdef int32_t *other_slot
+    cdef int32_t *other_offset
+    cdef char *other_blob
+
+    cdef bint next_record(self)
+    cdef bint seek(self, long int position)
+    cdef void fill_batchinfo(self, BatchInfo batchinfo, int start_index)
+    cdef void close(self)
+
+
+cdef bint is_binary_batchfile(bytes filename)
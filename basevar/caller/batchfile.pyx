@@ -0,0 +1,435 @@
+# cython: profile=True
+"""Binary batch file: BaseVarBatchFile_v2.0
+
+The text batch file (BaseVarBatchFile_v1.0) joins every column of a position by ',' and has
+to be split and converted by ``atoi`` for every sample when we do variants discovery. Here we
+keep each column as fixed-width per-sample array, just record the samples which are covered
+(sparse) and put the indels (or any alleles which are not A/C/G/T/N) into a side table,
+the base codes are the same as ``BatchInfo.base_codes``. The
+file is read back by ``mmap`` and all the arrays are used in place.
+
+Layout (native byte order, every record is 8-bytes aligned)
+===========================================================
+
+    File header:
+        magic(8) | version(u32) | sample_num(u32) | text_size(u32) | text | pad
+
+        ``text`` is the same '##' header lines as the text batch file, the parameters
+        of creating the batch file are in ``##CallParameters`` if it's in a batch store.
+
+    Record:
+        position(i64) | depth(i32) | covered_num(i32) | other_num(i32) | ref_base(char) | pad(3)
+        sample_index(i32 x covered_num)   # index of covered sample in this batch
+        read_pos_rank(u16 x covered_num)
+        base_code(u8 x covered_num)
+        base_qual(u8 x covered_num)
+        mapq(u8 x covered_num)
+        strand(u8 x covered_num)
+        pad to 4
+        other_slot(i32 x other_num)       # index in ``sample_index``
+        other_offset(i32 x other_num)     # offset of allele string in ``blob``
+        blob_size(i32) | blob             # '\\0' terminated allele strings
+        pad to 8
+
+    Block index (since version 3):
+        (position(i64) | offset(i64)) x index_num   # every ``BATCH_INDEX_INTERVAL`` records
+        index_num(i64) | index_magic(8)
+
+        The reader seeks to a position by the index instead of scanning from the first record.
+"""
+import sys
+
+from libc.stdio cimport fopen, fclose, fwrite
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy, memset, strlen
+from libc.stdint cimport int32_t, int64_t, uint8_t, uint16_t, uint32_t
+
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.unistd cimport close as c_close
+from posix.stat cimport struct_stat, fstat
+from posix.mman cimport mmap, munmap, posix_madvise, PROT_READ, MAP_PRIVATE, MAP_FAILED, \
+    POSIX_MADV_SEQUENTIAL
+
+from basevar.log import logger
+from basevar.caller.batch cimport BatchInfo, BASE_CODE_INDEL
+
+DEF BATCH_MAGIC = b"BVBATCH\x00"
+DEF BATCH_MAGIC_SIZE = 8
+DEF BATCH_VERSION = 3
+DEF BATCH_INDEX_MAGIC = b"BVINDEX\x00"
+DEF BATCH_INDEX_INTERVAL = 1024  # records
+DEF FILE_HEADER_SIZE = 20  # magic + version + sample_num + text_size
+DEF RECORD_HEADER_SIZE = 24
+
+cdef inline size_t _align(size_t size, size_t n):
+    return (size + n - 1) / n * n
+
+
+cdef bint is_binary_batchfile(bytes filename):
+    """Return True if ``filename`` is a BaseVarBatchFile_v2.0 file."""
+    with open(filename, "rb") as I:
+        return I.read(BATCH_MAGIC_SIZE) == BATCH_MAGIC
+
+
+cdef class BatchFileWriter:
+    """Write ``BatchInfo`` of one batch of samples into a binary batch file."""
+
+    def __cinit__(self, bytes filename, bytes chrom, list sample_ids, bytes parameters=None):
+        self.filename = filename
+        self.sample_num = len(sample_ids)
+        self.buffer_capacity = 0
+        self.buffer = NULL
+        self.record_num = 0
+        self.block_index = []
+
+        self.fh = fopen(filename, "wb")
+        if self.fh == NULL:
+            raise IOError("Could not open file `%s` for writing." % filename)
+
+        cdef bytes text = <bytes>("##fileformat=BaseVarBatchFile_v2.0\n"
+                                  "##Chromosome=%s\n"
+                                  "##SampleIDs=%s\n" % (chrom, ",".join(sample_ids)))
+        if parameters:
+            text += <bytes>("##CallParameters=%s\n" % parameters)
+
+        cdef uint32_t version = BATCH_VERSION
+        cdef uint32_t sample_num = self.sample_num
+        cdef uint32_t text_size = len(text)
+        cdef size_t header_size = _align(FILE_HEADER_SIZE + text_size, 8)
+
+        self._reserve(header_size)
+        memset(self.buffer, 0, header_size)
+        memcpy(self.buffer, <char*>BATCH_MAGIC, BATCH_MAGIC_SIZE)
+        memcpy(self.buffer + 8, &version, 4)
+        memcpy(self.buffer + 12, &sample_num, 4)
+        memcpy(self.buffer + 16, &text_size, 4)
+        memcpy(self.buffer + FILE_HEADER_SIZE, <char*>text, text_size)
+
+        if fwrite(self.buffer, 1, header_size, self.fh) != header_size:
+            raise IOError("Fail to write header into %s" % filename)
+
+        self.file_offset = header_size
+
+    def __dealloc__(self):
+        self.close()
+
+    cdef void _reserve(self, size_t size):
+        cdef char *temp = NULL
+        if size <= self.buffer_capacity:
+            return
+
+        temp = <char*>(realloc(self.buffer, size))
+        if temp == NULL:
+            logger.error("Could not allocate memory for the buffer of BatchFileWriter.")
+            sys.exit(1)
+
+        self.buffer = temp
+        self.buffer_capacity = size
+        return
+
+    cdef void write(self, BatchInfo batchinfo):
+        if batchinfo.size != self.sample_num:
+            logger.error("The size of BatchInfo (%d) is not match with the number of samples (%d) in %s" % (
+                batchinfo.size, self.sample_num, self.filename))
+            sys.exit(1)
+
+        cdef int i = 0, k = 0, n = 0
+        cdef int covered_num = 0
+        cdef int other_num = 0
+        cdef size_t blob_size = 0
+
+        # Keep the same behavior with the text batch file: Nothing is kept if depth == 0
+        if batchinfo.depth > 0:
+            for i in range(batchinfo.size):
+                if batchinfo.is_empty[i]:
+                    continue
+
+                covered_num += 1
+                if batchinfo.base_codes[i] >= BASE_CODE_INDEL:
+                    other_num += 1
+                    blob_size += strlen(batchinfo.get_base(i)) + 1
+
+        cdef size_t rank_off = RECORD_HEADER_SIZE + 4 * covered_num
+        cdef size_t code_off = rank_off + 2 * covered_num
+        cdef size_t qual_off = code_off + covered_num
+        cdef size_t mapq_off = qual_off + covered_num
+        cdef size_t strand_off = mapq_off + covered_num
+        cdef size_t slot_off = _align(strand_off + covered_num, 4)
+        cdef size_t offset_off = slot_off + 4 * other_num
+        cdef size_t blob_off = offset_off + 4 * other_num + 4
+        cdef size_t record_size = _align(blob_off + blob_size, 8)
+
+        self._reserve(record_size)
+        memset(self.buffer, 0, record_size)
+
+        cdef int64_t position = batchinfo.position
+        cdef int32_t depth = batchinfo.depth
+        cdef int32_t c_covered_num = covered_num
+        cdef int32_t c_other_num = other_num
+        cdef int32_t c_blob_size = blob_size
+        memcpy(self.buffer, &position, 8)
+        memcpy(self.buffer + 8, &depth, 4)
+        memcpy(self.buffer + 12, &c_covered_num, 4)
+        memcpy(self.buffer + 16, &c_other_num, 4)
+        self.buffer[20] = (<char*>batchinfo.ref_base)[0]
+        memcpy(self.buffer + offset_off + 4 * other_num, &c_blob_size, 4)
+
+        cdef int32_t *sample_index = <int32_t*>(self.buffer + RECORD_HEADER_SIZE)
+        cdef uint16_t *read_pos_rank = <uint16_t*>(self.buffer + rank_off)
+        cdef uint8_t *base_code = <uint8_t*>(self.buffer + code_off)
+        cdef uint8_t *base_qual = <uint8_t*>(self.buffer + qual_off)
+        cdef uint8_t *mapq = <uint8_t*>(self.buffer + mapq_off)
+        cdef uint8_t *strand = <uint8_t*>(self.buffer + strand_off)
+        cdef int32_t *other_slot = <int32_t*>(self.buffer + slot_off)
+        cdef int32_t *other_offset = <int32_t*>(self.buffer + offset_off)
+        cdef char *blob = self.buffer + blob_off
+
+        cdef size_t base_size = 0
+        cdef const char *other_base
+        cdef int32_t blob_pos = 0
+        if covered_num > 0:
+            for i in range(batchinfo.size):
+                if batchinfo.is_empty[i]:
+                    continue
+
+                sample_index[k] = i
+                read_pos_rank[k] = batchinfo.read_pos_rank[i]
+                base_code[k] = batchinfo.base_codes[i]
+                base_qual[k] = batchinfo.sample_base_quals[i]
+                mapq[k] = batchinfo.mapqs[i]
+                strand[k] = batchinfo.strands[i]
+
+                if base_code[k] >= BASE_CODE_INDEL:
+                    other_base = batchinfo.get_base(i)
+                    base_size = strlen(other_base) + 1
+                    memcpy(blob + blob_pos, other_base, base_size)
+                    other_slot[n] = k
+                    other_offset[n] = blob_pos
+
+                    blob_pos += base_size
+                    n += 1
+
+                k += 1
+
+        if fwrite(self.buffer, 1, record_size, self.fh) != record_size:
+            logger.error("Fail to write %s:%d into %s" % (batchinfo.chrid, batchinfo.position, self.filename))
+            sys.exit(1)
+
+        if self.record_num % BATCH_INDEX_INTERVAL == 0:
+            self.block_index.append((batchinfo.position, self.file_offset))
+
+        self.record_num += 1
+        self.file_offset += record_size
+        return
+
+    cdef void _write_block_index(self):
+        cdef int64_t value
+        cdef list values = [v for entry in self.block_index for v in entry] + [len(self.block_index)]
+        for value in values:
+            if fwrite(&value, 8, 1, self.fh) != 1:
+                logger.error("Fail to write the block index into %s" % self.filename)
+                sys.exit(1)
+
+        if fwrite(<char*>BATCH_INDEX_MAGIC, 1, BATCH_MAGIC_SIZE, self.fh) != BATCH_MAGIC_SIZE:
+            logger.error("Fail to write the block index into %s" % self.filename)
+            sys.exit(1)
+
+        return
+
+    cdef void close(self):
+        if self.fh != NULL:
+            self._write_block_index()
+            fclose(self.fh)
+            self.fh = NULL
+
+        if self.buffer != NULL:
+            free(self.buffer)
+            self.buffer = NULL
+            self.buffer_capacity = 0
+
+        return
+
+
+cdef class BatchFileReader:
+    """Read binary batch file by mmap and fill the record into ``BatchInfo`` without copying
+    any strings."""
+
+    def __cinit__(self, bytes filename):
+        self.filename = filename
+        self.data = NULL
+        self.data_size = 0
+        self.data_end = 0
+        self.offset = 0
+        self.block_index = NULL
+        self.index_num = 0
+
+        self.fd = c_open(filename, O_RDONLY)
+        if self.fd < 0:
+            raise IOError("Could not open file `%s`. Check that file/path exists." % filename)
+
+        cdef struct_stat st
+        if fstat(self.fd, &st) != 0:
+            c_close(self.fd)
+            raise IOError("Could not get the size of file `%s`." % filename)
+
+        self.data_size = st.st_size
+        if self.data_size < FILE_HEADER_SIZE:
+            c_close(self.fd)
+            raise IOError("%s is not a BaseVarBatchFile_v2.0 file." % filename)
+
+        cdef void *m = mmap(NULL, self.data_size, PROT_READ, MAP_PRIVATE, self.fd, 0)
+        if m == MAP_FAILED:
+            c_close(self.fd)
+            raise IOError("Could not mmap file `%s`." % filename)
+
+        self.data = <char*>m
+        posix_madvise(m, self.data_size, POSIX_MADV_SEQUENTIAL)
+
+        if self.data[:BATCH_MAGIC_SIZE] != BATCH_MAGIC:
+            self.close()
+            raise IOError("%s is not a BaseVarBatchFile_v2.0 file." % filename)
+
+        cdef uint32_t version, sample_num, text_size
+        memcpy(&version, self.data + 8, 4)
+        memcpy(&sample_num, self.data + 12, 4)
+        memcpy(&text_size, self.data + 16, 4)
+        if version != BATCH_VERSION and version != 2:
+            self.close()
+            raise IOError("Unsupported version (%d) of batch file %s" % (version, filename))
+
+        self.sample_num = sample_num
+        self.chrom = None
+        self.sample_ids = []
+        self.parameters = None
+        for line in self.data[FILE_HEADER_SIZE:FILE_HEADER_SIZE + text_size].split("\n"):
+            if line.startswith("##Chromosome="):
+                self.chrom = line.split("=", 1)[-1]
+            elif line.startswith("##SampleIDs="):
+                self.sample_ids = line.split("=", 1)[-1].split(",")
+            elif line.startswith("##CallParameters="):
+                self.parameters = line.split("=", 1)[-1]
+
+        # move to the first record
+        self.first_offset = _align(FILE_HEADER_SIZE + text_size, 8)
+        self.offset = self.first_offset
+        self.data_end = self.data_size
+
+        cdef int64_t index_num = 0
+        if version >= 3 and self.data_size >= self.first_offset + 16 and \
+                self.data[self.data_size-BATCH_MAGIC_SIZE:self.data_size] == BATCH_INDEX_MAGIC:
+            memcpy(&index_num, self.data + self.data_size - 16, 8)
+            if index_num < 0 or self.first_offset + 16 * (index_num + 1) > self.data_size:
+                self.close()
+                raise IOError("The block index of %s is broken." % filename)
+
+            self.index_num = index_num
+            self.data_end = self.data_size - 16 * (index_num + 1)
+            self.block_index = <int64_t*>(self.data + self.data_end)
+        elif version >= 3:
+            self.close()
+            raise IOError("%s is truncated, the block index is missing." % filename)
+
+    def __dealloc__(self):
+        self.close()
+
+    cdef bint next_record(self):
+        """Move to the next record, return False if hit the end of file."""
+        if self.data == NULL or self.offset + RECORD_HEADER_SIZE > self.data_end:
+            return False
+
+        cdef char *record = self.data + self.offset
+        cdef int64_t position
+        cdef int32_t depth, covered_num, other_num, blob_size
+        memcpy(&position, record, 8)
+        memcpy(&depth, record + 8, 4)
+        memcpy(&covered_num, record + 12, 4)
+        memcpy(&other_num, record + 16, 4)
+
+        self.position = position
+        self.depth = depth
+        self.ref_base = record[20]
+        self.covered_num = covered_num
+        self.other_num = other_num
+
+        cdef size_t rank_off = RECORD_HEADER_SIZE + 4 * covered_num
+        cdef size_t code_off = rank_off + 2 * covered_num
+        cdef size_t qual_off = code_off + covered_num
+        cdef size_t mapq_off = qual_off + covered_num
+        cdef size_t strand_off = mapq_off + covered_num
+        cdef size_t slot_off = _align(strand_off + covered_num, 4)
+        cdef size_t offset_off = slot_off + 4 * other_num
+        cdef size_t blob_off = offset_off + 4 * other_num + 4
+
+        if self.offset + blob_off > self.data_end:
+            logger.error("%s is truncated at position %d." % (self.filename, position))
+            sys.exit(1)
+
+        memcpy(&blob_size, record + offset_off + 4 * other_num, 4)
+
+        self.sample_index = <int32_t*>(record + RECORD_HEADER_SIZE)
+        self.read_pos_rank = <uint16_t*>(record + rank_off)
+        self.base_code = <uint8_t*>(record + code_off)
+        self.base_qual = <uint8_t*>(record + qual_off)
+        self.mapq = <uint8_t*>(record + mapq_off)
+        self.strand = <uint8_t*>(record + strand_off)
+        self.other_slot = <int32_t*>(record + slot_off)
+        self.other_offset = <int32_t*>(record + offset_off)
+        self.other_blob = record + blob_off
+
+        self.offset += _align(blob_off + blob_size, 8)
+        return True
+
+    cdef bint seek(self, long int position):
+        """Move to the first record at or after ``position`` and make it the current record,
+        return False if there's no such record. We jump to the nearest record in front of
+        ``position`` by the block index, or scan from the first record if there's no index.
+        """
+        cdef long int lo = 0, hi = self.index_num, mid
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.block_index[2 * mid] <= position:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        self.offset = self.block_index[2 * (lo - 1) + 1] if lo > 0 else self.first_offset
+        while self.next_record():
+            if self.position >= position:
+                return True
+
+        return False
+
+    cdef void fill_batchinfo(self, BatchInfo batchinfo, int start_index):
+        """Fill the current record into ``batchinfo`` from ``start_index``, the samples
+        which are not covered keep the empty value of ``BatchInfo.set_empty()``. The strings
+        of indels are not copied, they are only valid before calling ``next_record()`` again."""
+        cdef int k = 0, j = 0
+        for k in range(self.covered_num):
+            j = start_index + self.sample_index[k]
+
+            batchinfo.is_empty[j] = 0
+            batchinfo.mapqs[j] = self.mapq[k]
+            batchinfo.base_codes[j] = self.base_code[k]
+            batchinfo.sample_base_quals[j] = self.base_qual[k]
+            batchinfo.read_pos_rank[j] = self.read_pos_rank[k]
+            batchinfo.strands[j] = self.strand[k]
+
+        for k in range(self.other_num):
+            j = start_index + self.sample_index[self.other_slot[k]]
+            batchinfo.set_base(j, self.other_blob + self.other_offset[k])
+
+        batchinfo.depth += self.depth
+        return
+
+    cdef void close(self):
+        if self.data != NULL:
+            munmap(self.data, self.data_size)
+            self.data = NULL
+            self.block_index = NULL
+            self.index_num = 0
+
+        if self.fd >= 0:
+            c_close(self.fd)
+            self.fd = -1
+
+        return
@@ -0,0 +1,49 @@
+"""Header for coverage.pyx
+"""
+from libc.stdint cimport uint8_t, int32_t, uint32_t
+
+from basevar.io.fasta cimport FastaFile
+from basevar.io.read cimport cAlignedRead
+from basevar.io.writer cimport RecordWriter
+from basevar.caller.popgroup cimport PopGroup
+
+cdef extern from "stdlib.h" nogil:
+    void *calloc(size_t, size_t)
+    void *malloc(size_t)
+    void free(void *)
+
+cdef extern from "string.h":
+    void *memset(void *s, int c, size_t n)
+
+
+cdef class CoverageWindow:
+    cdef bytes chrom
+    cdef long int start  # 1-base
+    cdef long int end  # 1-base
+    cdef long int length
+    cdef bytes ref_seq
+    cdef FastaFile ref_fa
+
+    cdef PopGroup popgroup
+    cdef int group_num
+    cdef int *sample_group  # ``PopGroup.sample_group``
+
+    # [A+, A-, C+, C-, G+, G-, T+, T-] for each position
+    cdef uint32_t *strand_counts
+    # [A, C, G, T] of each group for each position
+    cdef uint32_t *group_counts
+    # The first read of a sample is the only one we use in a position, same as ``BatchGenerator``,
+    # it's the index of the last sample which has been counted in each position.
+    cdef int32_t *last_sample
+    # Indels and the other bases are rare, keep them sparse: position index => {allele: count}
+    cdef dict indels
+    cdef dict group_indels  # (position index, group index) => {allele: count}
+
+    cdef void add_sample_reads(self, int sample_index, cAlignedRead **read_start, cAlignedRead **read_end)
+    cdef void _add_read(self, cAlignedRead *read, int sample_index)
+    cdef void _add_allele(self, long int ref_pos, int sample_index, char *allele, char strand)
+    cdef bint write(self, RecordWriter writer)
+
+
+cdef bint coverage_in_regions(bytes chrom, list regions, list align_files, list samples, FastaFile fa,
+                              PopGroup popgroup, out_file_handle, object options)
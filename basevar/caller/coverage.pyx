@@ -0,0 +1,360 @@
+# cython: profile=True
+"""
+Coverage-only engine of basetype.
+
+It's used when we just need the CVG file. The reads are streamed into the per-position
+counters of [A, C, G, T] on each strand (and the counters of each population group)
+directly, without ``BatchInfo`` and batchfiles.
+"""
+import sys
+import time
+
+from basevar.log import logger
+
+from basevar.io.bam cimport load_bamdata, uncompress_sample_reads
+from basevar.io.read cimport BamReadBuffer
+from basevar.io.writer cimport RecordWriter
+from basevar.io.htslibWrapper cimport Read_IsQCFail
+from basevar.io.htslibWrapper cimport Read_IsReverse
+
+from basevar.caller.algorithm cimport strand_bias_by_counts
+from basevar.caller.batch cimport encode_base, BASE_CODE_N, BASE_CODE_A, BASE_CODE_T, BASE_CODE_INDEL
+
+# The number of positions in a window, the memory of counters is about
+# (32 + 16 * number_of_group) bytes for each position.
+DEF COVERAGE_WINDOW_SIZE = 5000000
+
+# CIGAR here is the Mapping information in bwa, the same as ``BatchGenerator``
+DEF CIGAR_M = 0  # Match
+DEF CIGAR_I = 1  # Insertion
+DEF CIGAR_D = 2  # Deletion
+DEF CIGAR_N = 3  # Skipped region from reference
+DEF CIGAR_S = 4  # Soft clipping. Sequence is present in read
+DEF CIGAR_EQ = 7  # Alignment match; sequence match
+DEF CIGAR_X = 8  # Alignment match; sequence mismatch
+
+cdef list BASE = ['A', 'C', 'G', 'T']
+
+# The order of the most covered bases when they have the same depth, which is the
+# same as iterating the ``base_depth`` dict in ``variantcaller._out_cvg_file``.
+cdef int TIE_ORDER[4]
+TIE_ORDER[:] = [0, 1, 3, 2]
+
+
+cdef class CoverageWindow:
+    """Coverage of all the samples in ``chrom:start-end``."""
+
+    def __cinit__(self, bytes chrom, long int start, long int end, FastaFile ref_fa, PopGroup popgroup):
+        """``start`` and ``end`` are 1-base."""
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.length = end - start + 1
+        self.ref_fa = ref_fa
+
+        self.ref_seq = ref_fa.get_sequence(chrom, start - 1, end)
+        while len(self.ref_seq) < self.length:
+            # ``get_sequence`` does not contain the last base of the chromosome
+            self.ref_seq += ref_fa.get_character(chrom, start - 1 + len(self.ref_seq))
+
+        self.popgroup = popgroup
+        self.group_num = popgroup.group_num
+        self.sample_group = popgroup.sample_group
+        self.strand_counts = <uint32_t*>(calloc(self.length * 8, sizeof(uint32_t)))
+        self.group_counts = <uint32_t*>(calloc(self.length * self.group_num * 4 + 1, sizeof(uint32_t)))
+        self.last_sample = <int32_t*>(malloc(self.length * sizeof(int32_t)))
+        if self.strand_counts == NULL or self.group_counts == NULL or self.last_sample == NULL:
+            raise StandardError, "Could not allocate memory for CoverageWindow"
+
+        # No sample has been counted, all the bytes of -1 are 0xff.
+        memset(self.last_sample, 0xff, self.length * sizeof(int32_t))
+
+        self.indels = {}
+        self.group_indels = {}
+
+    def __dealloc__(self):
+        if self.strand_counts != NULL:
+            free(self.strand_counts)
+
+        if self.group_counts != NULL:
+            free(self.group_counts)
+
+        if self.last_sample != NULL:
+            free(self.last_sample)
+
+    cdef void add_sample_reads(self, int sample_index, cAlignedRead **read_start, cAlignedRead **read_end):
+        """Count all the reads of a sample in this window, the same rules as
+        ``BatchGenerator.create_batch_in_region``."""
+        while read_start != read_end:
+
+            if Read_IsQCFail(read_start[0]) or read_start[0].end < self.start:
+                read_start += 1
+                continue
+
+            # Break the loop when mapping start position is outside the window.
+            if read_start[0].pos > self.end:
+                break
+
+            self._add_read(read_start[0], sample_index)
+            read_start += 1
+
+        return
+
+    cdef void _add_read(self, cAlignedRead *read, int sample_index):
+        """Walk through the CIGAR of ``read``, the same as
+        ``BatchGenerator.get_batch_from_single_read_in_region``."""
+        cdef long int read_start_pos = read.pos  # 0-base
+        cdef int ref_offset = 0
+        cdef int read_offset = 0
+        cdef int cigar_length = read.cigar_len
+        cdef char *read_seq = read.seq
+        cdef char map_strand = '-' if Read_IsReverse(read) else '+'
+
+        cdef int cigar_flag = 0
+        cdef int cigar_index = 0
+        cdef int length = 0
+        cdef int index = 0
+        cdef long int ref_pos = 0
+        cdef bytes indel
+        cdef char base_char[2]
+        base_char[1] = '\0'
+
+        for cigar_index in range(cigar_length):
+            cigar_flag = read.cigar_ops[2 * cigar_index]
+            length = read.cigar_ops[(2 * cigar_index) + 1]
+
+            if cigar_flag == CIGAR_I or cigar_flag == CIGAR_D:
+
+                # Only the indels which are next to a match are used
+                if not ((cigar_index > 0 and read.cigar_ops[(2 * cigar_index) - 2] == CIGAR_M) or
+                        (cigar_index < cigar_length - 1 and read.cigar_ops[(2 * cigar_index) + 2] == CIGAR_M)):
+                    if cigar_flag == CIGAR_I:
+                        read_offset += length
+                    else:
+                        ref_offset += length
+                    continue
+
+                ref_pos = read_start_pos + ref_offset  # 1-base, the position before the indel
+                if self.start <= ref_pos <= self.end:
+                    if cigar_flag == CIGAR_I:
+                        indel = read_seq[read_offset:read_offset + length]
+                        # do not use indels with Ns in them
+                        if indel.count("N") == 0:
+                            self._add_allele(ref_pos, sample_index, "+%s" % indel, map_strand)
+                    else:
+                        indel = self.ref_fa.get_sequence(self.chrom, read_start_pos + ref_offset,
+                                                         read_start_pos + ref_offset + length)
+                        if indel.upper().count("N") == 0:
+                            self._add_allele(ref_pos, sample_index, "-%s" % indel, map_strand)
+
+                if cigar_flag == CIGAR_I:
+                    read_offset += length
+                else:
+                    ref_offset += length
+
+            elif cigar_flag == CIGAR_M or cigar_flag == CIGAR_EQ or cigar_flag == CIGAR_X:
+
+                for index in range(length):
+                    ref_pos = read_start_pos + ref_offset + index + 1  # 1-base
+                    if ref_pos < self.start:
+                        continue
+
+                    if ref_pos > self.end:
+                        break
+
+                    base_char[0] = read_seq[read_offset + index]
+                    self._add_allele(ref_pos, sample_index, base_char, map_strand)
+
+                ref_offset += length
+                read_offset += length
+
+            elif cigar_flag == CIGAR_N:
+                ref_offset += length
+
+            elif cigar_flag == CIGAR_S:
+                read_offset += length
+                # We have to move back read position when there is a soft-clipping at the
+                # beginning of reads
+                if cigar_index == 0:
+                    ref_offset += length
+
+            # Hard clipping, padding and the other kinds of flag, just don't care about them.
+
+        return
+
+    cdef void _add_allele(self, long int ref_pos, int sample_index, char *allele, char strand):
+
+        cdef long int i = ref_pos - self.start
+        if self.last_sample[i] == sample_index:
+            # Just count the first read of this sample
+            return
+
+        self.last_sample[i] = sample_index
+
+        cdef uint8_t code = encode_base(allele)
+        cdef int g = self.sample_group[sample_index]
+        cdef dict allele_depth
+        if BASE_CODE_A <= code <= BASE_CODE_T:
+            self.strand_counts[i * 8 + (code - BASE_CODE_A) * 2 + (1 if strand == '-' else 0)] += 1
+            if g >= 0:
+                self.group_counts[(i * self.group_num + g) * 4 + code - BASE_CODE_A] += 1
+
+        elif code != BASE_CODE_N:
+            # Indel, or the base which is not in ``BASE``
+            allele_depth = self.indels.setdefault(i, {})
+            allele_depth[allele] = allele_depth.get(allele, 0) + 1
+            if g >= 0:
+                allele_depth = self.group_indels.setdefault((i, g), {})
+                allele_depth[allele] = allele_depth.get(allele, 0) + 1
+
+        return
+
+    cdef bint write(self, RecordWriter writer):
+        """Output the CVG lines in the same format as ``variantcaller._out_cvg_file``,
+        return True if nothing is written."""
+        cdef bint is_empty = True
+        cdef long int i
+        cdef int k, g, depth, b1, b2, ref_index
+        cdef uint32_t *counts
+        cdef uint32_t *group_counts
+        cdef uint32_t base_depth[4]
+        cdef double fs, sor
+        cdef int ref_fwd, ref_rev, alt_fwd, alt_rev
+        cdef bytes ref_base, ref_upper
+
+        for i in range(self.length):
+
+            counts = self.strand_counts + i * 8
+            depth = 0
+            for k in range(4):
+                base_depth[k] = counts[2 * k] + counts[2 * k + 1]
+                depth += base_depth[k]
+
+            if depth == 0:
+                continue
+
+            is_empty = False
+            ref_base = self.ref_seq[i:i + 1]
+            ref_upper = ref_base.upper()
+
+            # The top two bases
+            b1, b2 = TIE_ORDER[0], -1
+            for k in TIE_ORDER[1:4]:
+                if base_depth[k] > base_depth[b1]:
+                    b1, b2 = k, b1
+                elif b2 < 0 or base_depth[k] > base_depth[b2]:
+                    b2 = k
+
+            # strand bias of REF and the top ALT
+            ref_index = BASE.index(ref_upper) if ref_upper in BASE else -1
+            k = b1 if b1 != ref_index else b2
+            ref_fwd = counts[2 * ref_index] if ref_index >= 0 else 0
+            ref_rev = counts[2 * ref_index + 1] if ref_index >= 0 else 0
+            alt_fwd, alt_rev = counts[2 * k], counts[2 * k + 1]
+            fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias_by_counts(ref_fwd, ref_rev, alt_fwd, alt_rev)
+
+            writer.write_bytes(self.chrom)
+            writer.write_char('\t')
+            writer.write_int(self.start + i)
+            writer.write_char('\t')
+            writer.write_bytes(ref_base)
+            writer.write_char('\t')
+            writer.write_int(depth)
+            for k in range(4):
+                writer.write_char('\t')
+                writer.write_int(base_depth[k])
+
+            writer.write_char('\t')
+            writer.write_bytes(_indel_string(self.indels[i]) if i in self.indels else b".")
+            writer.write_char('\t')
+            writer.write_float(fs, 3)
+            writer.write_char('\t')
+            writer.write_float(sor, 3)
+            writer.write_char('\t')
+            writer.write_int(ref_fwd)
+            writer.write_char(',')
+            writer.write_int(ref_rev)
+            writer.write_char(',')
+            writer.write_int(alt_fwd)
+            writer.write_char(',')
+            writer.write_int(alt_rev)
+
+            # A:C:G:T[:indels] of each group
+            for g in range(self.group_num):
+                group_counts = self.group_counts + (i * self.group_num + g) * 4
+                writer.write_char('\t')
+                for k in range(4):
+                    if k > 0:
+                        writer.write_char(':')
+                    writer.write_int(group_counts[k])
+
+                if (i, g) in self.group_indels:
+                    writer.write_char(':')
+                    writer.write_bytes(_indel_string(self.group_indels[(i, g)]))
+
+            writer.write_char('\n')
+
+        return is_empty
+
+
+cdef bytes _indel_string(dict indel_depth):
+    return bytes(','.join([k + '|' + str(v) for k, v in indel_depth.items()]))
+
+
+cdef bint coverage_in_regions(bytes chrom, list regions, list align_files, list samples, FastaFile fa,
+                              PopGroup popgroup, out_file_handle, object options):
+    """Output the coverage of ``samples`` in ``regions`` of ``chrom`` into ``out_file_handle``.
+
+    ``regions``: [[start1, end1], [start2, end2], ...], 1-base and sorted.
+
+    Return True if nothing is written.
+    """
+    cdef int sample_size = len(samples)
+    cdef int batchcount = options.batch_count
+    cdef bint is_empty = True
+
+    cdef CoverageWindow window
+    cdef RecordWriter writer = RecordWriter(out_file_handle)
+    cdef BamReadBuffer sample_read_buffer
+    cdef list sample_read_buffers
+    cdef bytes refseq_bytes
+    cdef long int reg_start, reg_end, win_start, win_end
+    cdef int i, k
+    for reg_start, reg_end in regions:
+        for win_start in range(reg_start, reg_end + 1, COVERAGE_WINDOW_SIZE):
+
+            start_time = time.time()
+            win_end = min(win_start + COVERAGE_WINDOW_SIZE - 1, reg_end)
+            window = CoverageWindow(chrom, win_start, win_end, fa, popgroup)
+
+            refseq_bytes = fa.get_sequence(chrom, win_start - 1, win_end + options.r_len)
+            for i in range(0, sample_size, batchcount):
+                batch_sample_ids = samples[i:i + batchcount]
+                try:
+                    sample_read_buffers = load_bamdata(
+                        {s: f for s, f in zip(batch_sample_ids, align_files[i:i + batchcount])},
+                        batch_sample_ids, chrom, win_start - 1, win_end, refseq_bytes, options)
+
+                except Exception, e:
+                    logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom, win_start, win_end, e))
+                    sys.exit(1)
+
+                for k in range(len(sample_read_buffers)):
+                    sample_read_buffer = sample_read_buffers[k]
+                    uncompress_sample_reads(sample_read_buffer, refseq_bytes, win_start - 1, options)
+                    window.add_sample_reads(i + k,
+                                            sample_read_buffer.reads.array,
+                                            sample_read_buffer.reads.array + sample_read_buffer.reads.get_size())
+
+                # release the reads of this batch
+                sample_read_buffers = None
+
+            if not window.write(writer):
+                is_empty = False
+
+            writer.flush()
+
+            logger.info("Done for the coverage of %d samples in %s:%s-%s, %d seconds elapsed." % (
+                sample_size, chrom, win_start, win_end, time.time() - start_time))
+
+    return is_empty
@@ -1,9 +1,14 @@
 """
 This is a caller process
 """
+import os
 import sys
 import time
 import multiprocessing
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 
 class CallerProcess(multiprocessing.Process):
@@ -49,3 +54,167 @@ def process_runner(processes):
         p.join()
 
     return
+
+
+class ShardWorkerProcess(multiprocessing.Process):
+    """
+    A worker of the shard scheduler. It keeps fetching shard jobs from its own ``task_queue``
+    and runs ``func(*args, **kwargs).run()`` for each of them, until it gets a ``None``.
+
+    The result of each job is sent back to the scheduler by its own ``result_queue``:
+        (token, is_success), ``token`` is the unique number given to the job by the scheduler.
+    The queues are only used by this worker, so a worker which is killed while it's using
+    them (e.g. holding the lock of a queue) can't block the others.
+    """
+
+    def __init__(self, worker_id, func, task_queue, result_queue):
+        multiprocessing.Process.__init__(self)
+        self.worker_id = worker_id
+        self.func = func
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+
+    def run(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                break
+
+            token, (shard_index, args, kwargs, marker_file) = task
+            is_success = False
+            try:
+                self.func(*args, **kwargs).run()
+                # The shard is done only if it leaves the marker file.
+                is_success = os.path.exists(marker_file)
+
+            except (Exception, SystemExit), e:
+                sys.stderr.write("[ERROR] Shard %d fail in worker %d: %s\n" % (shard_index, self.worker_id, e))
+
+            self.result_queue.put((token, is_success))
+
+        return
+
+
+def shard_runner(func, shard_jobs, process_num, max_retries=2):
+    """Run ``shard_jobs`` by a pool of ``process_num`` workers.
+
+    The workers get a new shard as soon as they finish the previous one, so a slow
+    shard won't hold up the others. A failed shard is retried individually for
+    ``max_retries`` times, and a worker which is killed will be replaced.
+
+    The scheduler gives one shard to a worker at a time and keeps it in ``pending``
+    until the result comes back, so the shard of a worker which is killed is never
+    lost even if the worker has no chance to report anything, and a late result of
+    the job which has been taken back is ignored.
+
+    ``shard_jobs``: a list of (shard_index, args, kwargs, marker_file)
+
+    return: a list of the shard indexes which are still failed at last.
+    """
+    cdef dict jobs = {job[0]: job for job in shard_jobs}
+    cdef dict attempts = {job[0]: 0 for job in shard_jobs}
+    cdef list waiting = [job[0] for job in shard_jobs]  # shard indexes in order
+
+    cdef dict pending = {}  # token => (worker_id, shard_index) of the jobs given to the workers
+    cdef dict assigned = {}  # worker_id => token of the job the worker is running
+    cdef list failed_shards = []
+    cdef int finished_num = 0
+    cdef int total_num = len(shard_jobs)
+    cdef long next_token = 0
+
+    workers = {}
+
+    def start_worker(worker_id):
+        # New queues for each worker, the ones of a dead worker may keep its job or be broken.
+        workers[worker_id] = ShardWorkerProcess(worker_id, func, multiprocessing.Queue(), multiprocessing.Queue())
+        workers[worker_id].start()
+
+    def retry_or_fail(shard_index):
+        attempts[shard_index] += 1
+        if attempts[shard_index] <= max_retries:
+            sys.stderr.write("[WARNING] Retry shard %d (%d/%d).\n" % (shard_index, attempts[shard_index],
+                                                                      max_retries))
+            waiting.append(shard_index)
+            return False
+        else:
+            failed_shards.append(shard_index)
+            return True
+
+    cdef int i
+    for i in range(min(process_num, total_num)):
+        start_worker(i)
+
+    try:
+        while finished_num < total_num:
+            # Give a shard to each idle worker.
+            for worker_id, worker in workers.items():
+                if worker_id not in assigned and waiting:
+                    shard_index = waiting.pop(0)
+                    pending[next_token] = (worker_id, shard_index)
+                    assigned[worker_id] = next_token
+                    worker.task_queue.put((next_token, jobs[shard_index]))
+                    next_token += 1
+
+            # Take all the results which are arrived, a dead worker may have reported its shard.
+            results = []
+            for worker in workers.values():
+                try:
+                    while True:
+                        results.append(worker.result_queue.get_nowait())
+                except Empty:
+                    pass
+
+            for token, is_success in results:
+                if token not in pending:
+                    # The job has been taken back from its dead worker.
+                    continue
+
+                worker_id, shard_index = pending.pop(token)
+                del assigned[worker_id]
+                if is_success:
+                    finished_num += 1
+                    sys.stderr.write("[INFO] Shard %d done, %d/%d finished.\n" % (shard_index, finished_num,
+                                                                                total_num))
+                elif retry_or_fail(shard_index):
+                    finished_num += 1
+
+            # Check all the workers in each loop, a worker could be killed (e.g. by OOM) when
+            # running a shard even if the others keep sending results.
+            for worker_id, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+
+                if worker_id in assigned:
+                    _, shard_index = pending.pop(assigned.pop(worker_id))
+                    if os.path.exists(jobs[shard_index][3]):
+                        # The shard is done but its result is lost with the worker.
+                        finished_num += 1
+                        sys.stderr.write("[INFO] Shard %d done, %d/%d finished.\n" % (shard_index, finished_num,
+                                                                                    total_num))
+                    else:
+                        sys.stderr.write("[ERROR] Worker %d is terminated (exitcode: %s) when running "
+                                         "shard %d.\n" % (worker_id, worker.exitcode, shard_index))
+                        if retry_or_fail(shard_index):
+                            finished_num += 1
+
+                # Replace the dead worker.
+                start_worker(worker_id)
+
+            if not results:
+                time.sleep(0.1)
+
+    except KeyboardInterrupt:
+        sys.stderr.write('KeyboardInterrupt detected, terminating all processes...\n')
+        for worker in workers.values():
+            worker.terminate()
+
+        sys.exit(1)
+
+    # Stop all the workers
+    for worker in workers.values():
+        worker.task_queue.put(None)
+
+    for worker in workers.values():
+        worker.join()
+
+    return sorted(failed_shards)
@@ -89,3 +89,84 @@ void em(double *init_allele_freq, double *ind_allele_likelihood, double *margina
     return;
 }
 
+
+/*
+ * The same EM as ``em`` above, but the individuals which have the same likelihood are
+ * collapsed into one class and ``class_weight`` is the number of individuals in each
+ * class. In low-pass data each individual just has one base and one base quality, so
+ * ``nclass`` is bounded by the number of distinct (base, quality) pairs instead of the
+ * size of the cohort. ``marginal_likelihood`` is per class.
+ */
+static void singleWeightedEM(double *allele_freq, double *class_allele_likelihood, double *class_weight,
+                             double total_weight, double *marginal_likelihood, double *expect_allele_prob,
+                             int nclass, int ntype) {
+    double *likelihood = (double *) calloc(ntype, sizeof(double));
+    int i, j;
+
+    // step E and M together, the posterior of each class is only used in the sum of step M
+    for(i=0; i<nclass; ++i){
+        for(j=0; j<ntype; ++j){
+            likelihood[j] = allele_freq[j] * class_allele_likelihood[i * ntype + j];
+            marginal_likelihood[i] += likelihood[j];
+        }
+        for(j=0; j<ntype; ++j){
+            expect_allele_prob[j] += class_weight[i] * likelihood[j] / marginal_likelihood[i];
+        }
+    }
+    free(likelihood);
+
+    for(j=0; j<ntype; ++j){
+        expect_allele_prob[j] = expect_allele_prob[j] / total_weight;
+    }
+
+    return;
+}
+
+static double weighted_delta_bylog(double *bf, double *af, double *weight, int n) {
+    double delta = 0.0;
+    int i;
+    for(i=0; i<n; ++i){
+        delta += weight[i] * fabs(log(af[i]) - log(bf[i]));
+        bf[i] = af[i];
+        af[i] = 0.0;
+    }
+    return delta;
+}
+
+/* Return the number of EM steps, so that the caller could tell how fast it converges. */
+int em_weighted(double *init_allele_freq, double *class_allele_likelihood, double *class_weight,
+                double *marginal_likelihood, double *expect_allele_prob, int nclass, int ntype,
+                int iter_num, double epsilon) {
+
+    double *af_marginal_likelihood = (double *) calloc(nclass, sizeof(double));
+    double *allele_freq = (double *) malloc(ntype * sizeof(double));
+    double total_weight = 0.0;
+    double delta;
+    int i, j;
+
+    for(i = 0; i < nclass; ++i){
+        total_weight += class_weight[i];
+    }
+
+    for(j = 0; j < ntype; ++j){
+        allele_freq[j] = init_allele_freq[j];
+    }
+    singleWeightedEM(allele_freq, class_allele_likelihood, class_weight, total_weight,
+                     marginal_likelihood, expect_allele_prob, nclass, ntype);
+
+    for(i=0; i<iter_num; ++i){
+        update_allele_freq(allele_freq, expect_allele_prob, ntype);
+        singleWeightedEM(allele_freq, class_allele_likelihood, class_weight, total_weight,
+                         af_marginal_likelihood, expect_allele_prob, nclass, ntype);
+        delta = weighted_delta_bylog(marginal_likelihood, af_marginal_likelihood, class_weight, nclass);
+        if(delta < epsilon){
+            ++i;
+            break;
+        }
+    }
+
+    free(af_marginal_likelihood);
+    free(allele_freq);
+
+    return i + 1;
+}
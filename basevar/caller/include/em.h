@@ -4,4 +4,8 @@
 void em(double *init_allele_freq, double *ind_allele_likelihood, double *marginal_likelihood,
         double *expect_allele_prob, int nsample, int ntype, int iter_num, double epsilon);
 
+int em_weighted(double *init_allele_freq, double *class_allele_likelihood, double *class_weight,
+                double *marginal_likelihood, double *expect_allele_prob, int nclass, int ntype,
+                int iter_num, double epsilon);
+
 #endif
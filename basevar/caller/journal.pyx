@@ -0,0 +1,128 @@
+"""
+A checkpoint journal of the finished works in a process for ``--smart-rerun``.
+"""
+import os
+import zlib
+import hashlib
+
+from basevar.log import logger
+
+# The options which don't change the results, they could be different between the reruns.
+RUNTIME_OPTIONS = set(["smartrerun", "nCPU", "pipeline_depth", "shard_retries", "work_dir", "decoder_threads",
+                       "max_open_files", "bgzf_threads", "verbosity", "sample_name_cache", "batch_store",
+                       "input_r_len"])
+
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def file_checksum(basestring file_name):
+    """Return the (size, crc32) of a file."""
+    cdef long long size = 0
+    crc = 0
+    with open(file_name, "rb") as I:
+        while True:
+            data = I.read(CHECKSUM_BUFFER_SIZE)
+            if not data:
+                break
+
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+
+    return size, crc & 0xffffffff
+
+
+def parameter_fingerprint(samples, align_files, ref_file, regions, options):
+    """The md5 of all the inputs and parameters which could change the results."""
+    params = [(k, v) for k, v in sorted(vars(options).items()) if k not in RUNTIME_OPTIONS and not callable(v)]
+    return hashlib.md5(repr((list(samples), list(align_files), ref_file, list(regions), params))).hexdigest()
+
+
+class CheckpointJournal(object):
+    """An append-only journal of the finished works (the batchfiles and the windows of
+    variants discovery) in ``cache_dir``, with the size and checksum of their output files.
+
+    The journal starts with the fingerprint of parameters, all the works in ``cache_dir``
+    are dropped if it's different from the current run. Each record is one line written
+    by one ``write()`` in append mode, so the producer of batchfiles and the variants
+    discovery could share the journal, and the last line broken by a crash is ignored.
+
+    A record is ``kind, key, value, (file_name, size, crc32) ...``, ``value`` is a short
+    string about the result of the work, e.g. whether a window of variants discovery is empty.
+    """
+    FILE_NAME = "basevar.checkpoint.journal"
+
+    def __init__(self, cache_dir, fingerprint):
+        self.cache_dir = cache_dir
+        self.file_name = os.path.join(cache_dir, self.FILE_NAME)
+        self.records = {}  # (kind, key) => (value, [(file_name, size, crc32), ...])
+
+        if os.path.isfile(self.file_name):
+            with open(self.file_name) as I:
+                lines = I.read().split("\n")
+
+            if lines[0] == "#fingerprint\t%s" % fingerprint:
+                # The last one is empty or broken.
+                for line in lines[1:-1]:
+                    self._load_record(line)
+
+                if lines[-1]:
+                    # Close the broken line, the new records must start at a new line.
+                    self._append("\n")
+            else:
+                logger.warning("The parameters or inputs are changed since the previous run, drop all the "
+                               "finished works in %s." % cache_dir)
+                for name in os.listdir(cache_dir):
+                    if os.path.isfile(os.path.join(cache_dir, name)):
+                        os.remove(os.path.join(cache_dir, name))
+
+        if not os.path.isfile(self.file_name):
+            self._append("#fingerprint\t%s\n" % fingerprint)
+
+    def _load_record(self, line):
+        fields = line.split("\t")
+        if len(fields) < 3 or (len(fields) - 3) % 3:
+            return
+
+        try:
+            self.records[(fields[0], fields[1])] = (fields[2], [(fields[i], int(fields[i+1]), int(fields[i+2]))
+                                                                for i in range(3, len(fields), 3)])
+        except ValueError:
+            pass
+
+    def _append(self, line):
+        fd = os.open(self.file_name, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def is_done(self, kind, key, file_names):
+        """Return True if the work is in the journal and its output files are not changed."""
+        record = self.records.get((kind, key))
+        if record is None or [f for f, _, _ in record[1]] != list(file_names):
+            return False
+
+        for file_name, size, crc in record[1]:
+            if not os.path.isfile(file_name) or os.path.getsize(file_name) != size:
+                return False
+
+            if file_checksum(file_name) != (size, crc):
+                return False
+
+        return True
+
+    def done(self, kind, key, file_names, value=""):
+        """Record the work, its ``value`` and the size and checksum of its output files."""
+        record = [(f,) + file_checksum(f) for f in file_names]
+        self._append("\t".join([kind, key, value] + ["%s\t%d\t%d" % r for r in record]) + "\n")
+        self.records[(kind, key)] = (value, record)
+
+    def value(self, kind, key):
+        """The value of the work in the journal, None if it's not in the journal."""
+        record = self.records.get((kind, key))
+        return record[0] if record is not None else None
+
+    def remove(self):
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
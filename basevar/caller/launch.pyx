@@ -13,17 +13,25 @@ import time
 
 from basevar.log import logger
 from basevar import utils
-from basevar.utils cimport generate_regions_by_process_num, fast_merge_files
+from basevar.utils cimport generate_regions_by_process_num, generate_region_shards, fast_merge_files
 
-from basevar.caller.do import CallerProcess, process_runner
+from basevar.caller.do import CallerProcess, process_runner, shard_runner
 from basevar.caller.basetypeprocess cimport BaseVarProcess
+from basevar.caller.scatter import ShardQueue, ScatterWorker
 
-from basevar.io.BGZF.tabix import tabix_index
 from basevar.io.bam cimport get_sample_names
+from basevar.io.htslibWrapper import set_cram_reference
 from basevar.caller.vqsr import vqsr
 from basevar.caller.other import NearbyIndel
 
 
+cdef basestring _temp_suffix(basestring final_file_name):
+    """The temporary outputs are BGZF files if the final one is, so that they could be
+    concatenated block by block without decompressing.
+    """
+    return ".gz" if final_file_name.endswith(".gz") else ""
+
+
 class BaseTypeRunner(object):
 
     def __init__(self, args):
@@ -40,18 +48,54 @@ class BaseTypeRunner(object):
         self.outcvg = args.outcvg
         self.options = args
 
+        # All the CRAM files are decoded by the reference of -R, it's loaded once
+        # in each process and shared by the CRAM files.
+        set_cram_reference(self.reference_file)
+
         # setting the resolution of MAF
         self.options.min_af = utils.set_minaf(len(self.alignfiles)) if (args.min_af is None) else args.min_af
         logger.info("Finish loading arguments and we have %d BAM/CRAM files for "
                     "variants calling." % len(self.alignfiles))
 
+        if self.options.window_size <= 0:
+            logger.error("--window-size must be a positive number, but we get %d" % self.options.window_size)
+            sys.exit(1)
+
+        if self.options.from_batch_store and (not self.options.batch_store or
+                                              not os.path.isdir(self.options.batch_store)):
+            logger.error("--from-batch-store needs an existing batch store of --batch-store.")
+            sys.exit(1)
+
+        if self.options.from_batch_store and self.options.batch_format != "binary":
+            logger.error("Only the binary batchfiles could be read by regions for --from-batch-store.")
+            sys.exit(1)
+
+        if self.options.batch_store:
+            # The batchfiles of all the processes, shards and reruns are shared in one place.
+            self.options.batch_store = utils.safe_makedir(os.path.realpath(self.options.batch_store))
+
         # Loading positions if not been provided we'll load all the genome
         regions = utils.load_target_position(self.reference_file, args.positions, args.regions)
-        self.regions_for_each_process = generate_regions_by_process_num(
-            regions, process_num=self.nCPU, convert_to_2d=False)
+        if self.options.work_dir and self.options.shard_size <= 0:
+            logger.warning("--shard-size is not set for --work-dir, we will use 1000000 bp per shard.")
+            self.options.shard_size = 1000000
+
+        if self.options.shard_size > 0:
+            # Cut the regions into many small shards for the workers of shard scheduler
+            self.regions_for_each_process = generate_region_shards(regions, self.options.shard_size)
+            logger.info("Cut the regions into %d shards (<= %d bp) for %d workers." % (
+                len(self.regions_for_each_process), self.options.shard_size, self.nCPU))
+        else:
+            self.regions_for_each_process = generate_regions_by_process_num(
+                regions, process_num=self.nCPU, convert_to_2d=False)
 
         # ``samples_id`` has the same size and order as ``aligne_files``
-        self.sample_id = get_sample_names(self.alignfiles, True if args.filename_has_samplename else False)
+        if not args.sample_name_cache:
+            args.sample_name_cache = os.path.join(os.path.dirname(os.path.realpath(self.outcvg)),
+                                                  ".basevar.sample_names.tsv")
+
+        self.sample_id = get_sample_names(self.alignfiles, True if args.filename_has_samplename else False,
+                                          nCPU=self.nCPU, cache_file=args.sample_name_cache)
 
         cdef int sample_num = len(self.sample_id)
         if self.options.batch_count > sample_num:
@@ -65,6 +109,11 @@ class BaseTypeRunner(object):
         Run variant caller
         """
         sys.stderr.write('[INFO] Start call variants by BaseType ... %s\n' % time.asctime())
+        if self.options.work_dir:
+            return self.basevar_caller_by_scatter()
+
+        if self.options.shard_size > 0:
+            return self.basevar_caller_by_shards()
 
         cdef list out_vcf_names = []
         cdef list out_cvg_names = []
@@ -74,12 +123,12 @@ class BaseTypeRunner(object):
         # Always create process manager even if nCPU==1, so that we can
         # listen signals from main thread
         for i in range(self.nCPU):
-            sub_cvg_file = self.outcvg + '.temp_%d_%d' % (i + 1, self.nCPU)
+            sub_cvg_file = self.outcvg + '.temp_%d_%d%s' % (i + 1, self.nCPU, _temp_suffix(self.outcvg))
             out_cvg_names.append(sub_cvg_file)
             successful_marker_files.append(sub_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY")
 
             if self.outvcf:
-                sub_vcf_file = self.outvcf + '.temp_%d_%d' % (i + 1, self.nCPU)
+                sub_vcf_file = self.outvcf + '.temp_%d_%d%s' % (i + 1, self.nCPU, _temp_suffix(self.outvcf))
                 out_vcf_names.append(sub_vcf_file)
             else:
                 sub_vcf_file = None
@@ -132,7 +181,8 @@ class BaseTypeRunner(object):
 
         # Final output if all the processes are ending successful!
         if all_process_success:
-            utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf)
+            utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf,
+                                     reference_file=self.reference_file)
             logger.info("All the processes are done successful.")
         else:
             logger.error("The program is fail in [%s] processes. Abort!" % ",".join(map(str, fail_process_num)))
@@ -140,6 +190,106 @@ class BaseTypeRunner(object):
 
         return all_process_success
 
+    def basevar_caller_by_shards(self):
+        """
+        Run variant caller by a pool of workers, which pick up the small shards of
+        regions one by one from a queue.
+        """
+        cdef list out_vcf_names = []
+        cdef list out_cvg_names = []
+        cdef list shard_jobs = []
+
+        cdef int shard_num = len(self.regions_for_each_process)
+        cdef int i
+        for i in range(shard_num):
+            sub_cvg_file = self.outcvg + '.temp_shard_%d_%d%s' % (i + 1, shard_num, _temp_suffix(self.outcvg))
+            out_cvg_names.append(sub_cvg_file)
+
+            if self.outvcf:
+                sub_vcf_file = self.outvcf + '.temp_shard_%d_%d%s' % (i + 1, shard_num, _temp_suffix(self.outvcf))
+                out_vcf_names.append(sub_vcf_file)
+            else:
+                sub_vcf_file = None
+
+            tmp_dir, name = os.path.split(os.path.realpath(sub_cvg_file))
+            cache_dir = tmp_dir + "/Batchfiles.%s.WillBeDeletedWhenJobsFinish" % name
+
+            if self.options.smartrerun and os.path.isfile(sub_cvg_file) and (not os.path.exists(cache_dir)):
+                # `sub_cvg_file and sub_vcf_file` of this shard has been finish successfully.
+                continue
+
+            cache_dir = utils.safe_makedir(cache_dir)
+            shard_jobs.append((i,
+                               (self.sample_id, self.alignfiles, self.reference_file,
+                                self.regions_for_each_process[i]),
+                               dict(out_cvg_file=sub_cvg_file,
+                                    out_vcf_file=sub_vcf_file,
+                                    cache_dir=cache_dir,
+                                    options=self.options),
+                               sub_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY"))
+
+        logger.info("%d/%d shards are waiting for %d workers." % (len(shard_jobs), shard_num, self.nCPU))
+        failed_shards = shard_runner(BaseVarProcess, shard_jobs, self.nCPU, max_retries=self.options.shard_retries)
+
+        for _, _, _, marker_file in shard_jobs:
+            if os.path.exists(marker_file):
+                os.remove(marker_file)
+
+        if failed_shards:
+            logger.error("The program is fail in shards [%s] after %d retries. Abort!" % (
+                ",".join(map(str, [i + 1 for i in failed_shards])), self.options.shard_retries))
+            sys.exit(1)
+
+        # The shards are already in order, just concatenate them together.
+        for out_final_file, sub_file_list in zip([self.outcvg, self.outvcf], [out_cvg_names, out_vcf_names]):
+            if out_final_file:
+                fast_merge_files(sub_file_list, out_final_file, True)
+
+        logger.info("All the %d shards are done successful." % shard_num)
+        return True
+
+    def basevar_caller_by_scatter(self):
+        """
+        Run variant caller as one of the workers which share the shards in ``work_dir``.
+        These workers could run on different hosts, and the one which finishes the
+        last shard will gather the outputs of all the shards.
+        """
+        if os.path.exists(os.path.join(self.options.work_dir, "gather.done")):
+            logger.info("All the shards in %s have been gathered." % self.options.work_dir)
+            return True
+
+        shard_queue = ShardQueue(self.options.work_dir, self.regions_for_each_process, len(self.sample_id))
+
+        cdef list processes = []
+        for i in range(self.nCPU):
+            processes.append(CallerProcess(ScatterWorker,
+                                           shard_queue,
+                                           self.sample_id,
+                                           self.alignfiles,
+                                           self.reference_file,
+                                           self.options))
+        process_runner(processes)
+
+        failed_shards = shard_queue.failed_shards(self.options.shard_retries)
+        if failed_shards:
+            logger.error("The program is fail in shards [%s] after %d retries, remove the *.fail files in %s "
+                         "and run it again. Abort!" % (",".join(map(str, failed_shards)), self.options.shard_retries,
+                                                       shard_queue.shard_dir))
+            sys.exit(1)
+
+        pending_shards = shard_queue.pending_shards(self.options.shard_retries)
+        if pending_shards:
+            logger.info("This worker is done. %d shards are still running by other workers, and the last "
+                        "one will gather the output of all the shards." % len(pending_shards))
+            return True
+
+        if shard_queue.gather(self.outcvg, outvcf=self.outvcf):
+            logger.info("All the %d shards are done and gathered successful." % len(self.regions_for_each_process))
+        else:
+            logger.info("All the shards are done and have been gathered by another worker.")
+
+        return True
+
     def basevar_caller_singleprocess(self):
         """
         Run variant caller --------- Just for Testting, when we done, please delete this function!!!!!!
@@ -187,7 +337,8 @@ class BaseTypeRunner(object):
         # bp.run()
 
         # Final output
-        utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf)
+        utils.output_cvg_and_vcf(out_cvg_names, out_vcf_names, self.outcvg, outvcf=self.outvcf,
+                                 reference_file=self.reference_file)
         return True
 
 
@@ -234,20 +385,12 @@ class MergeRunner(object):
             self.inputfiles += utils.load_file_list(args.infilelist)
 
         self.outputfile = args.outputfile
+        self.reference_file = args.referencefile
 
     def run(self):
-        # utils.output_file(self.inputfiles, self.outputfile)
-
-        # A new merge methods!
-        if self.outputfile.endswith(".gz"):
-            fast_merge_files(self.inputfiles, self.outputfile, False)
-
-            # Column indices are 0-based. Note: this is different from the tabix command line
-            # utility where column indices start at 1.
-            tabix_index(self.outputfile, force=True, seq_col=0, start_col=1, end_col=1)
-        else:
-            fast_merge_files(self.inputfiles, self.outputfile, False)
-
+        # The records of each input file must be in order, the chromosomes are in the order of
+        # reference if it's provided, or the order we meet them in the input files.
+        utils.output_file(self.inputfiles, self.outputfile, reference_file=self.reference_file)
         return
 
 
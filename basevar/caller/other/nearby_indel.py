@@ -13,7 +13,7 @@ import numpy as np
 
 from basevar.caller.vqsr import vcfutils
 from basevar.io.openfile import Open
-from basevar.io.BGZF.tabix import TabixFile, tabix_index
+from basevar.io.BGZF.tabix import TabixFile
 
 class NearbyIndel(object):
 
@@ -75,7 +75,8 @@ class NearbyIndel(object):
         if self.output_file_name == "-":
             OUT = sys.stdout
         else:
-            OUT = Open(self.output_file_name, 'wb', isbgz=True if self.output_file_name.endswith(".gz") else False)
+            OUT = Open(self.output_file_name, 'wb', isbgz=True if self.output_file_name.endswith(".gz") else False,
+                       tabix=True)
 
         for k, h in sorted(h_info.header.items(), key=lambda d: d[0]):
             OUT.write("\n".join(h) + "\n")
@@ -120,8 +121,4 @@ class NearbyIndel(object):
         self._close_input_file()
         OUT.close()
 
-        if self.output_file_name.endswith(".gz"):
-            # create tabix index
-            tabix_index(self.output_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-
         return self
@@ -0,0 +1,37 @@
+"""Header for popgroup.pyx
+"""
+from libc.stdint cimport uint8_t, uint32_t
+
+from basevar.caller.batch cimport BatchInfo
+
+cdef extern from "stdlib.h" nogil:
+    void *calloc(size_t, size_t)
+    void free(void *)
+
+cdef extern from "string.h":
+    void *memset(void *s, int c, size_t n)
+    void *memcpy(void *dest, const void *src, size_t n)
+
+
+cdef class PopGroup:
+    cdef readonly list groups
+    cdef readonly int group_num
+    cdef readonly int sample_num
+
+    cdef int *sample_group  # group index of each sample, -1 for not in any group
+    cdef int *group_size
+    cdef int *group_offset  # the first sample of each group in ``group_base_codes``
+    cdef int *group_cursor
+
+    # Counts of base codes of each position, one row for each group and the last
+    # row is for all the samples: (group_num + 1) x (BASE_CODE_OTHER + 1)
+    cdef uint32_t *counts
+    cdef dict indels  # row => {indel: count}, just for the rows which have indels
+
+    # Base codes and qualities of the samples, gathered group by group
+    cdef uint8_t *group_base_codes
+    cdef uint8_t *group_base_quals
+
+    cdef void count(self, BatchInfo batchinfo)
+    cdef void gather(self, BatchInfo batchinfo)
+    cdef uint32_t *row(self, int g)
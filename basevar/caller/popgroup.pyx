@@ -0,0 +1,122 @@
+# cython: profile=True
+"""
+Population groups of samples.
+
+All the groups are handled in one pass over the samples of each position, instead
+of one pass for each group.
+"""
+from basevar.caller.batch cimport BASE_CODE_INDEL
+
+DEF CODE_NUM = 7  # BASE_CODE_OTHER + 1
+
+
+cdef class PopGroup:
+    """Index of population groups for ``sample_num`` samples.
+
+    ``popgroup``: group_id => [a list samples_index], see ``utils.load_popgroup_info``.
+    A sample could just be in one group.
+    """
+    def __cinit__(self, dict popgroup, int sample_num):
+        self.groups = popgroup.keys() if popgroup else []
+        self.group_num = len(self.groups)
+        self.sample_num = sample_num
+
+        self.sample_group = <int*>(calloc(sample_num + 1, sizeof(int)))
+        self.group_size = <int*>(calloc(self.group_num + 1, sizeof(int)))
+        self.group_offset = <int*>(calloc(self.group_num + 1, sizeof(int)))
+        self.group_cursor = <int*>(calloc(self.group_num + 1, sizeof(int)))
+        self.counts = <uint32_t*>(calloc((self.group_num + 1) * CODE_NUM, sizeof(uint32_t)))
+        self.group_base_codes = <uint8_t*>(calloc(sample_num + 1, sizeof(uint8_t)))
+        self.group_base_quals = <uint8_t*>(calloc(sample_num + 1, sizeof(uint8_t)))
+        if self.sample_group == NULL or self.group_size == NULL or self.group_offset == NULL or \
+                self.group_cursor == NULL or self.counts == NULL or self.group_base_codes == NULL or \
+                self.group_base_quals == NULL:
+            raise StandardError, "Could not allocate memory for PopGroup"
+
+        cdef int i, g
+        for i in range(sample_num):
+            self.sample_group[i] = -1
+
+        for g in range(self.group_num):
+            for i in popgroup[self.groups[g]]:
+                self.sample_group[i] = g
+
+            self.group_size[g] = len(popgroup[self.groups[g]])
+            self.group_offset[g + 1] = self.group_offset[g] + self.group_size[g]
+
+        self.indels = {}
+
+    def __dealloc__(self):
+        if self.sample_group != NULL:
+            free(self.sample_group)
+
+        if self.group_size != NULL:
+            free(self.group_size)
+
+        if self.group_offset != NULL:
+            free(self.group_offset)
+
+        if self.group_cursor != NULL:
+            free(self.group_cursor)
+
+        if self.counts != NULL:
+            free(self.counts)
+
+        if self.group_base_codes != NULL:
+            free(self.group_base_codes)
+
+        if self.group_base_quals != NULL:
+            free(self.group_base_quals)
+
+    cdef uint32_t *row(self, int g):
+        """Counts of base codes in group ``g``, or all the samples if ``g`` is ``group_num``."""
+        return self.counts + g * CODE_NUM
+
+    cdef void count(self, BatchInfo batchinfo):
+        """Count the base codes (and indels) of all the groups in one pass."""
+        memset(self.counts, 0, (self.group_num + 1) * CODE_NUM * sizeof(uint32_t))
+        if self.indels:
+            self.indels = {}
+
+        cdef uint32_t *total = self.row(self.group_num)
+        cdef dict indel_depth
+        cdef bytes indel
+        cdef uint8_t code
+        cdef int i, g
+        for i in range(batchinfo.size):
+
+            code = batchinfo.base_codes[i]
+            g = self.sample_group[i] if i < self.sample_num else -1
+            total[code] += 1
+            if g >= 0:
+                self.counts[g * CODE_NUM + code] += 1
+
+            if code >= BASE_CODE_INDEL:
+                # Indel, or the base which is not in [A, C, G, T]
+                indel = batchinfo.get_base(i)
+                indel_depth = self.indels.setdefault(self.group_num, {})
+                indel_depth[indel] = indel_depth.get(indel, 0) + 1
+                if g >= 0:
+                    indel_depth = self.indels.setdefault(g, {})
+                    indel_depth[indel] = indel_depth.get(indel, 0) + 1
+
+        return
+
+    cdef void gather(self, BatchInfo batchinfo):
+        """Gather the base codes and qualities of samples group by group in one pass, the
+        samples of group ``g`` are in ``[group_offset[g], group_offset[g] + group_size[g])``.
+        """
+        memcpy(self.group_cursor, self.group_offset, (self.group_num + 1) * sizeof(int))
+
+        cdef int i, g, k
+        for i in range(min(batchinfo.size, self.sample_num)):
+            g = self.sample_group[i]
+            if g < 0:
+                continue
+
+            k = self.group_cursor[g]
+            self.group_base_codes[k] = batchinfo.base_codes[i]
+            self.group_base_quals[k] = batchinfo.sample_base_quals[i]
+            self.group_cursor[g] += 1
+
+        return
@@ -0,0 +1,284 @@
+# cython: profile=True
+"""
+Scatter/gather of basetype over a shared directory.
+
+Several ``basevar basetype`` workers, which could be on different hosts, share the
+same job by claiming shards through lock files in ``work_dir``. No scheduler service
+is needed, everything is on the (shared) filesystem:
+
+    <work_dir>/manifest.txt             The shards of this job, it must be the same for all workers
+    <work_dir>/shards/<i>.lock          Shard ``i`` has been claimed, "hostname pid" inside
+    <work_dir>/shards/<i>.done          Shard ``i`` is done successfully
+    <work_dir>/shards/<i>.fail          Number of failed attempts of shard ``i``
+    <work_dir>/shards/<i>.cvg[.vcf]     Output of shard ``i``
+    <work_dir>/gather.lock              The final merge of all the shards is running
+    <work_dir>/gather.done              The final merge of all the shards is done
+
+The worker which finds all the shards are done will gather the outputs of shards.
+"""
+import os
+import sys
+import errno
+import socket
+
+from basevar.log import logger
+from basevar import utils
+from basevar.utils cimport fast_merge_files
+
+from basevar.caller.basetypeprocess cimport BaseVarProcess
+
+
+class ShardQueue(object):
+    """A queue of shards on the filesystem, which could be shared by different hosts."""
+
+    def __init__(self, work_dir, shards, sample_num):
+        """
+        ``shards``: [[[chrid, start, end], ...], ...], all the workers should have the same shards.
+        """
+        self.work_dir = os.path.realpath(work_dir)
+        self.shard_dir = os.path.join(self.work_dir, "shards")
+        self.shards = shards
+        self.host = socket.gethostname()
+
+        utils.safe_makedir(self.shard_dir)
+        self._check_manifest(sample_num)
+
+    def _check_manifest(self, sample_num):
+        """Create the manifest if it's not exists, or make sure that we have the same shards with it."""
+        manifest = os.path.join(self.work_dir, "manifest.txt")
+
+        lines = ["##fileformat=BaseVarShardManifest_v1.0", "##SampleNumber=%d" % sample_num,
+                 "#SHARD\tREGIONS"]
+        for i, shard in enumerate(self.shards):
+            lines.append("%d\t%s" % (i, ",".join(["%s:%d-%d" % (c, s, e) for c, s, e in shard])))
+
+        text = "\n".join(lines) + "\n"
+        if not os.path.exists(manifest):
+            # ``os.link`` is atomic even on NFS, only the first worker could create the manifest.
+            tmp_manifest = "%s.%s.%d" % (manifest, self.host, os.getpid())
+            with open(tmp_manifest, "w") as OUT:
+                OUT.write(text)
+
+            try:
+                os.link(tmp_manifest, manifest)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp_manifest)
+
+        with open(manifest) as I:
+            if I.read() != text:
+                logger.error("The shards of this worker are different from %s. Please make sure all the "
+                             "workers are using the same parameters, or use another work directory." % manifest)
+                sys.exit(1)
+
+        return
+
+    def _create_exclusively(self, path, content):
+        """Create ``path`` only if it does not exist, return False if someone else has done it."""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+
+        os.write(fd, content)
+        os.close(fd)
+        return True
+
+    def shard_file(self, shard_index, suffix):
+        return os.path.join(self.shard_dir, "%d.%s" % (shard_index, suffix))
+
+    def is_done(self, shard_index):
+        return os.path.exists(self.shard_file(shard_index, "done"))
+
+    def failed_times(self, shard_index):
+        fail_file = self.shard_file(shard_index, "fail")
+        if not os.path.exists(fail_file):
+            return 0
+
+        with open(fail_file) as I:
+            return int(I.read().strip() or 0)
+
+    def _remove_stale_lock(self, lock_file):
+        """Remove the lock of a worker which is dead on this host, return the pid of the dead
+        worker if it's removed by us. We can't tell whether a worker on the other hosts is
+        still alive or not, so those locks should be removed by hand if the host is crashed.
+        """
+        try:
+            with open(lock_file) as I:
+                host, pid = I.read().split()
+        except (IOError, ValueError):
+            return None
+
+        if host != self.host:
+            return None
+
+        try:
+            os.kill(int(pid), 0)
+            return None  # still alive
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                return None
+
+        # Only one worker could rename the stale lock successfully
+        stale_lock = "%s.stale.%d" % (lock_file, os.getpid())
+        try:
+            os.rename(lock_file, stale_lock)
+        except OSError:
+            return None
+
+        os.remove(stale_lock)
+        return pid
+
+    def _release_stale_lock(self, shard_index):
+        pid = self._remove_stale_lock(self.shard_file(shard_index, "lock"))
+        # The worker may be dead after it's done the shard, ``.done`` is created before it exits.
+        if pid is not None and not self.is_done(shard_index):
+            logger.warning("Shard %d is left by a dead worker (pid: %s), release it." % (shard_index, pid))
+            self._add_failed_times(shard_index)
+
+        return
+
+    def _add_failed_times(self, shard_index):
+        failed_times = self.failed_times(shard_index) + 1
+        with open(self.shard_file(shard_index, "fail"), "w") as OUT:
+            OUT.write("%d\n" % failed_times)
+
+        return failed_times
+
+    def claim(self, max_retries):
+        """Claim a shard which is not done yet, return None if there's no shard for us."""
+        for i in range(len(self.shards)):
+            if self.is_done(i) or self.failed_times(i) > max_retries:
+                continue
+
+            if os.path.exists(self.shard_file(i, "lock")):
+                self._release_stale_lock(i)
+
+            if self._create_exclusively(self.shard_file(i, "lock"), "%s %d\n" % (self.host, os.getpid())):
+                if self.is_done(i):
+                    # It's done by the worker whose lock is released as a stale one above.
+                    continue
+
+                if self.failed_times(i) > max_retries:
+                    # It's been released as a stale lock after the checking above
+                    os.remove(self.shard_file(i, "lock"))
+                    continue
+
+                return i
+
+        return None
+
+    def mark_done(self, shard_index):
+        # Keep the lock file, so that nobody could claim this shard again.
+        self._create_exclusively(self.shard_file(shard_index, "done"), "%s %d\n" % (self.host, os.getpid()))
+        return
+
+    def mark_failed(self, shard_index):
+        failed_times = self._add_failed_times(shard_index)
+        os.remove(self.shard_file(shard_index, "lock"))
+        return failed_times
+
+    def pending_shards(self, max_retries):
+        """The shards which are not done yet but still have a chance."""
+        return [i for i in range(len(self.shards))
+                if not self.is_done(i) and self.failed_times(i) <= max_retries]
+
+    def failed_shards(self, max_retries):
+        return [i for i in range(len(self.shards))
+                if not self.is_done(i) and self.failed_times(i) > max_retries]
+
+    def gather(self, outcvg, outvcf=None):
+        """Merge the output of all the shards into the final files, and only one worker
+        could do this. Return False if the shards have been gathered by someone else.
+
+        ``gather.lock`` is only held while merging, ``gather.done`` marks the gathering is done.
+        """
+        gather_lock = os.path.join(self.work_dir, "gather.lock")
+        gather_done = os.path.join(self.work_dir, "gather.done")
+        if os.path.exists(gather_done):
+            return False
+
+        if os.path.exists(gather_lock):
+            pid = self._remove_stale_lock(gather_lock)
+            if pid is not None:
+                logger.warning("The gathering is left by a dead worker (pid: %s), gather again." % pid)
+
+        if not self._create_exclusively(gather_lock, "%s %d\n" % (self.host, os.getpid())):
+            return False
+
+        try:
+            if os.path.exists(gather_done):
+                # Done by the worker which held the lock just before us.
+                return False
+
+            shard_num = len(self.shards)
+            for out_final_file, suffix in zip([outcvg, outvcf], ["cvg.gz", "vcf.gz"]):
+                if out_final_file:
+                    # The shards are already in order, just concatenate them together.
+                    fast_merge_files([self.shard_file(i, suffix) for i in range(shard_num)], out_final_file, False)
+
+            with open(gather_done, "w") as OUT:
+                OUT.write("%s %d\n" % (self.host, os.getpid()))
+
+        finally:
+            # ``gather.done`` is written before the lock is released, or the other workers
+            # could gather the shards again if it's failed.
+            os.remove(gather_lock)
+
+        return True
+
+
+class ScatterWorker(object):
+    """A worker which keeps claiming shards from ``ShardQueue`` and runs BaseVarProcess for them."""
+
+    def __init__(self, shard_queue, samples, align_files, ref_file, options):
+        self.shard_queue = shard_queue
+        self.samples = samples
+        self.align_files = align_files
+        self.ref_file = ref_file
+        self.options = options
+
+    def run(self):
+        cdef int max_retries = self.options.shard_retries
+        cdef bint is_success
+        while True:
+            shard_index = self.shard_queue.claim(max_retries)
+            if shard_index is None:
+                break
+
+            logger.info("Claim shard %d in %s" % (shard_index, self.shard_queue.work_dir))
+            # BGZF shards could be gathered by concatenating their blocks, see ``concat_bgzf_files``.
+            sub_cvg_file = self.shard_queue.shard_file(shard_index, "cvg.gz")
+            sub_vcf_file = self.shard_queue.shard_file(shard_index, "vcf.gz") if self.options.outvcf else None
+            cache_dir = utils.safe_makedir(self.shard_queue.shard_file(
+                shard_index, "Batchfiles.WillBeDeletedWhenJobsFinish"))
+            marker_file = sub_cvg_file + ".PROCESS.AND_VCF_DONE_SUCCESSFULLY"
+
+            is_success = False
+            try:
+                BaseVarProcess(self.samples,
+                               self.align_files,
+                               self.ref_file,
+                               self.shard_queue.shards[shard_index],
+                               out_cvg_file=sub_cvg_file,
+                               out_vcf_file=sub_vcf_file,
+                               cache_dir=cache_dir,
+                               options=self.options).run()
+                is_success = os.path.exists(marker_file)
+
+            except (Exception, SystemExit), e:
+                logger.error("Shard %d fail: %s" % (shard_index, e))
+
+            if is_success:
+                os.remove(marker_file)
+                self.shard_queue.mark_done(shard_index)
+                logger.info("Shard %d done." % shard_index)
+            else:
+                failed_times = self.shard_queue.mark_failed(shard_index)
+                logger.warning("Shard %d fail %d time(s)." % (shard_index, failed_times))
+
+        return
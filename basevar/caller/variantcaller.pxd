@@ -7,11 +7,15 @@ cdef extern from "stdlib.h" nogil:
 
 cdef extern from "string.h" nogil:
     char *strsep(char ** string_ptr, const char *delimiter)
+    void *memset(void *s, int c, size_t n)
+
+from libc.stdint cimport uint8_t, uint32_t
 
 from basevar.io.fasta cimport FastaFile
+from basevar.caller.popgroup cimport PopGroup
 
-cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af,
-                             cvg_file_handle, vcf_file_handle)
+cdef bint variants_discovery(bytes chrid, list batchfiles, PopGroup popgroup, float min_af,
+                             cvg_file_handle, vcf_file_handle, list regions=*)
 cdef bint variant_discovery_in_regions(FastaFile fa,
                                        list align_files,
                                        list regions,
@@ -9,19 +9,30 @@ from basevar.utils import vcf_header_define, cvg_header_define
 
 from basevar.io.fasta cimport FastaFile
 from basevar.io.openfile import Open
-from basevar.io.bam cimport load_data_from_bamfile
+from basevar.io.bam cimport load_data_from_bamfile, SamfilePool, get_samfile_pool
 from basevar.io.htslibWrapper cimport Samfile
+from basevar.io.writer cimport RecordWriter
 
-from basevar.caller.algorithm cimport strand_bias
-from basevar.caller.algorithm cimport ref_vs_alt_ranksumtest
+from basevar.caller.algorithm cimport SiteAnnotation, RANKSUM_MAPQ, RANKSUM_BASEQ, RANKSUM_READPOS
 
-from basevar.caller.basetype cimport BaseType
+from basevar.caller.basetype cimport BaseType, qual_to_pvalue
 from basevar.caller.batch cimport BatchGenerator, BatchInfo, PositionBatchCigarArray
+from basevar.caller.batch cimport BASE_CODE_N, BASE_CODE_A, BASE_CODE_C, BASE_CODE_G, BASE_CODE_T, \
+    BASE_CODE_INDEL, BASE_CODE_OTHER, decode_base
+from basevar.caller.batchfile cimport BatchFileReader, is_binary_batchfile
+from basevar.caller.popgroup cimport PopGroup
 
 cdef int INITIAL_CIGAR_ARRAY_SIZE = 10000
 cdef int QUAL_THRESHOLD = 60
 cdef list BASE = ['A', 'C', 'G', 'T']
 
+# The BP field of VCF for each base quality: str(round(p-value, 6)), it's
+# much faster than formating the float of each sample in each position.
+cdef list _QUAL_PVALUE_STR_LIST = [str(round(qual_to_pvalue(q), 6)) for q in range(256)]
+cdef const char *QUAL_PVALUE_STR[256]
+for _q in range(256):
+    QUAL_PVALUE_STR[_q] = _QUAL_PVALUE_STR_LIST[_q]
+
 def output_header(fa_file_name, sample_ids, pop_group_sample_dict, out_cvg_handle, out_vcf_handle=None):
     info, group = [], []
     if pop_group_sample_dict:
@@ -39,13 +50,27 @@ def output_header(fa_file_name, sample_ids, pop_group_sample_dict, out_cvg_handl
 
     return
 
-cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float min_af,
-                             cvg_file_handle, vcf_file_handle):
+cdef bint variants_discovery(bytes chrid, list batchfiles, PopGroup popgroup, float min_af,
+                             cvg_file_handle, vcf_file_handle, list regions=None):
     """Function for variants discovery.
+
+    ``regions``: [[start, end], ...] 1-base and sorted, only the positions in them are called
+        if it's not None, the binary batchfiles seek to each region by their block index.
     """
+    if batchfiles and is_binary_batchfile(batchfiles[0]):
+        return _variants_discovery_by_binary_batchfiles(chrid, batchfiles, popgroup, min_af,
+                                                        cvg_file_handle, vcf_file_handle, regions)
+
+    if regions is not None:
+        logger.error("Only the binary batchfiles could be read by regions, but we get %s" % batchfiles[0])
+        sys.exit(1)
+
     cdef list sampleinfos = []
     cdef list batch_files_hd = [Open(f, 'rb') for f in batchfiles]
     cdef bint is_empty = True
+    cdef SiteAnnotation site_annotation = SiteAnnotation()
+    cdef RecordWriter cvg_writer = RecordWriter(cvg_file_handle)
+    cdef RecordWriter vcf_writer = RecordWriter(vcf_file_handle) if vcf_file_handle else None
     cdef bint eof = False
     cdef bint is_error = False
 
@@ -112,7 +137,11 @@ cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float
         is_empty = False
 
         # Calling varaints position one by one and output files.
-        _basetypeprocess(batchinfo, popgroup, min_af, cvg_file_handle, vcf_file_handle)
+        _basetypeprocess(batchinfo, popgroup, site_annotation, min_af, cvg_writer, vcf_writer)
+
+    cvg_writer.flush()
+    if vcf_writer is not None:
+        vcf_writer.flush()
 
     for fh in batch_files_hd:
         fh.close()
@@ -122,10 +151,116 @@ cdef bint variants_discovery(bytes chrid, list batchfiles, dict popgroup, float
     return is_empty
 
 
+cdef int _move_readers(list readers, long int position):
+    """Move all the readers to the next record, or seek to ``position`` if it's not
+    negative, return the number of readers which hit the end.
+    """
+    cdef BatchFileReader reader
+    cdef int eof_num = 0
+    for reader in readers:
+        if not (reader.seek(position) if position >= 0 else reader.next_record()):
+            eof_num += 1
+
+    return eof_num
+
+
+cdef bint _variants_discovery_by_binary_batchfiles(bytes chrid, list batchfiles, PopGroup popgroup, float min_af,
+                                                  cvg_file_handle, vcf_file_handle, list regions=None):
+    """Variants discovery from binary batchfiles (BaseVarBatchFile_v2.0), all the data of
+    each position are filled into ``BatchInfo`` directly without any text parsing.
+    """
+    cdef list readers = [BatchFileReader(f) for f in batchfiles]
+    cdef int reader_num = len(readers)
+
+    cdef BatchFileReader reader, first_reader
+    cdef int total_sample_num = 0
+    for reader in readers:
+        if reader.chrom != chrid:
+            logger.error("Chromosome [%s and %s] in batchfile %s not match with each other!" % (
+                reader.chrom, chrid, reader.filename))
+            sys.exit(1)
+
+        total_sample_num += reader.sample_num
+
+    cdef BatchInfo batchinfo = BatchInfo(chrid, size=total_sample_num)
+    cdef bint is_empty = True
+    cdef SiteAnnotation site_annotation = SiteAnnotation()
+    cdef RecordWriter cvg_writer = RecordWriter(cvg_file_handle)
+    cdef RecordWriter vcf_writer = RecordWriter(vcf_file_handle) if vcf_file_handle else None
+    cdef int eof_num = 0
+    cdef int start_index = 0
+    cdef int n = 0, i = 0
+    cdef long int region_end = -1
+
+    # Read the whole files if there's no regions.
+    for region in (regions if regions is not None else [None]):
+
+        if region is not None:
+            eof_num = _move_readers(readers, region[0])
+            region_end = region[1]
+        else:
+            eof_num = _move_readers(readers, -1)
+
+        while True:
+
+            # hit the end of files
+            if eof_num > 0:
+                if eof_num != reader_num:
+                    logger.warning(
+                        "%s\n[ERROR]Error happen when 'variants_discovery', they don't have the same "
+                        "positions in above files." % "\n".join(batchfiles))
+                break
+
+            first_reader = readers[0]
+            if region is not None and first_reader.position > region_end:
+                break
+
+            batchinfo.position = first_reader.position
+            batchinfo.ref_base = chr(first_reader.ref_base)
+            batchinfo.set_empty()
+
+            if n % 10000 == 0:
+                logger.info("Have been loading %d lines when hit position %s:%d" %
+                            (n if n > 0 else 1, chrid, batchinfo.position))
+            n += 1
+
+            start_index = 0
+            for i in range(reader_num):
+                reader = readers[i]
+                if reader.position != first_reader.position or reader.ref_base != first_reader.ref_base:
+                    logger.error("Position [%d and %d] or ref-base [%s and %s] in batchfiles %s and %s "
+                                 "not match with each other!\n" % (
+                        reader.position, first_reader.position, chr(reader.ref_base),
+                        chr(first_reader.ref_base), reader.filename, first_reader.filename))
+                    sys.exit(1)
+
+                reader.fill_batchinfo(batchinfo, start_index)
+                start_index += reader.sample_num
+
+            # ignore if coverage=0
+            if batchinfo.depth > 0:
+                # Not empty
+                is_empty = False
+
+                # Calling varaints position one by one and output files.
+                _basetypeprocess(batchinfo, popgroup, site_annotation, min_af, cvg_writer, vcf_writer)
+
+            eof_num = _move_readers(readers, -1)
+
+    cvg_writer.flush()
+    if vcf_writer is not None:
+        vcf_writer.flush()
+
+    for reader in readers:
+        reader.close()
+
+    return is_empty
+
+
 cdef void _fetch_baseinfo_by_position_from_batchfiles(list infolines, int *batch_count, BatchInfo batchinfo):
 
-    # reset depth
-    batchinfo.depth = 0
+    # reset depth and indels
+    batchinfo.set_empty()
 
     cdef char *c_t4
     cdef char *c_t5
@@ -155,7 +290,7 @@ cdef void _fetch_baseinfo_by_position_from_batchfiles(list infolines, int *batch
 
                 # if catch segmentation fault then the problem would probably be here!
                 batchinfo.mapqs[index] = atoi(strsep(&c_t4, ","))
-                batchinfo.sample_bases[index] = strsep(&c_t5, ",")  # must all be all upper charater in batchfile!
+                batchinfo.set_base(index, strsep(&c_t5, ","))  # must all be all upper charater in batchfile!
                 batchinfo.sample_base_quals[index] = atoi(strsep(&c_t6, ","))
                 batchinfo.read_pos_rank[index] = atoi(strsep(&c_t7, ","))
                 batchinfo.strands[index] = strsep(&c_t8, ",")[0] # It's char not string
@@ -163,16 +298,8 @@ cdef void _fetch_baseinfo_by_position_from_batchfiles(list infolines, int *batch
                 # move to the next
                 index += 1
         else:
-            for n in range(batch_count[i]):
-
-                batchinfo.mapqs[index] = 0
-                batchinfo.sample_bases[index] = "N"
-                batchinfo.sample_base_quals[index] = 0
-                batchinfo.read_pos_rank[index] = 0
-                batchinfo.strands[index] = "."
-
-                # move to the next
-                index += 1
+            # all of them are empty, which have been set by ``set_empty()``
+            index += batch_count[i]
 
     return
 
@@ -233,15 +360,18 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
     cdef list batch_generators = []
 
     cdef long int _pos
+    cdef char *ref_seq
     for chrom, start, end in regions:
 
         batch_generators.append(BatchGenerator(chrom, start, end, fa, options.batch_count, options))
         positions_batch_cigar = []
 
+        # `ref_seq[i]` is the reference base of `start + i`
+        ref_seq = fa.get_sequence_ptr(chrom, start-1, end)
         for _pos in range(start, end+1):
             # Position in positions_batch_cigar must be the same as which in `BatchGenerator.batch_heap`
             positions_batch_cigar.append(PositionBatchCigarArray(
-                chrom, _pos, fa.get_character(chrom, _pos-1), min(sample_size, INITIAL_CIGAR_ARRAY_SIZE))
+                chrom, _pos, ref_seq[_pos-start:_pos-start+1], min(sample_size, INITIAL_CIGAR_ARRAY_SIZE))
             )
 
         # The size of ``regions_batch_cigar`` will be the same as ``batch_generators``
@@ -250,6 +380,7 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
 
     logger.info("Done for allocating memory to ``PositionBatchCigarArray`` and ``BatchGenerator`` array.")
 
+    cdef SamfilePool samfile_pool = get_samfile_pool(options)
     cdef Samfile reader
 
     cdef int i = 0, k = 0, n = 0
@@ -259,8 +390,7 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
     start_time = time.time()
     for i in range(sample_size):
 
-        reader = Samfile(align_files[i])  # Match samples[i]
-        reader.open("r", True)
+        reader = samfile_pool.get(align_files[i])  # Match samples[i]
         for k ,(chrom, start, end) in enumerate(regions):
 
             try:
@@ -272,8 +402,6 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
                 logger.error("Exception in region %s:%s-%s. Error: %s" % (chrom, start, end, e))
                 sys.exit(1)
 
-        reader.close()
-
         if buffer_sample_index + 1 == options.batch_count:
             # Compress a batch data into ``PositionBatchCigarArray`` will rest depth to be 0
             push_data_into_position_cigar_array(regions_batch_cigar, batch_generators, -1)
@@ -303,7 +431,8 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
         open(out_cvg_file_name, "w")
 
     output_header(fa.filename, samples, popgroup, CVG, out_vcf_handle=VCF)
-    cdef bint is_empty = _variants_discovery(regions_batch_cigar, popgroup, options.min_af, CVG, VCF)
+    cdef bint is_empty = _variants_discovery(regions_batch_cigar, PopGroup(popgroup, sample_size),
+                                             options.min_af, CVG, VCF)
 
     CVG.close()
     if VCF:
@@ -312,7 +441,7 @@ cdef bint variant_discovery_in_regions(FastaFile fa,
     return is_empty
 
 
-cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min_af, CVG, VCF):
+cdef bint _variants_discovery(list regions_batch_cigar, PopGroup popgroup, float min_af, CVG, VCF):
     """Function for variants discovery.
     
     Parameter:
@@ -325,6 +454,9 @@ cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min
     cdef PositionBatchCigarArray position_batch_cigar_array
     cdef BatchInfo batch_info
     cdef bint is_empty = True
+    cdef SiteAnnotation site_annotation = SiteAnnotation()
+    cdef RecordWriter cvg_writer = RecordWriter(CVG)
+    cdef RecordWriter vcf_writer = RecordWriter(VCF) if VCF else None
     cdef int n = 0, i = 0, j = 0
     for i in range(how_many_regions):
 
@@ -344,209 +476,158 @@ cdef bint _variants_discovery(list regions_batch_cigar, dict popgroup, float min
             is_empty = False
 
             # Calling varaints position one by one and output files.
-            _basetypeprocess(batch_info, popgroup, min_af, CVG, VCF)
+            _basetypeprocess(batch_info, popgroup, site_annotation, min_af, cvg_writer, vcf_writer)
+
+    cvg_writer.flush()
+    if vcf_writer is not None:
+        vcf_writer.flush()
 
     return is_empty
 
-cdef void _basetypeprocess(BatchInfo batchinfo, dict popgroup, float min_af, cvg_file_handle, vcf_file_handle):
+cdef void _basetypeprocess(BatchInfo batchinfo, PopGroup popgroup, SiteAnnotation site_annotation, float min_af,
+                           RecordWriter cvg_writer, RecordWriter vcf_writer):
     """
     
     :param batchinfo: 
     :param popgroup: 
+    :param site_annotation: reused by all the positions
     :param min_af: 
-    :param cvg_file_handle: 
-    :param vcf_file_handle: 
+    :param cvg_writer: 
+    :param vcf_writer: None if we don't need VCF
     :return: 
     """
-    _out_cvg_file(batchinfo, popgroup, cvg_file_handle)
+    # strand counts of this position, for both CVG and VCF
+    site_annotation.reset(batchinfo.base_codes, batchinfo.strands, batchinfo.mapqs,
+                          batchinfo.sample_base_quals, batchinfo.read_pos_rank, batchinfo.size)
+    _out_cvg_file(batchinfo, popgroup, site_annotation, cvg_writer)
 
     cdef dict popgroup_bt = {}
     cdef bint is_variant = True
 
     cdef BaseType bt, group_bt
-    cdef char ** group_sample_bases
-    cdef int *group_sample_base_quals
-    cdef int group_sample_size
-    cdef int i = 0
-    if vcf_file_handle:
+    cdef int g = 0
+    if vcf_writer is not None:
 
         bt = BaseType()
-        bt.cinit(batchinfo.ref_base.upper(), batchinfo.sample_bases, batchinfo.sample_base_quals,
+        bt.cinit(batchinfo.ref_base.upper(), batchinfo.base_codes, batchinfo.sample_base_quals,
                  batchinfo.size, min_af)
 
         is_variant = bt.lrt(None)  # do not need to set specific_base_combination
         if is_variant:
 
             popgroup_bt = {}
-            for group, index in popgroup.items():
-
-                group_sample_size = len(index)
-                group_sample_bases = <char**> (calloc(group_sample_size, sizeof(char*)))
-                if group_sample_bases == NULL:
-                    logger.error("Fail allocate memory for ``group_sample_bases`` in _basetypeprocess.")
-                    sys.exit(1)
-
-                group_sample_base_quals = <int*> (calloc(group_sample_size, sizeof(int)))
-                if group_sample_base_quals == NULL:
-                    logger.error("Fail allocate memory for ``group_sample_base_quals`` in _basetypeprocess.")
-                    sys.exit(1)
-
-                # for i in index:
-                for i in range(group_sample_size):
-                    group_sample_bases[i] = batchinfo.sample_bases[index[i]]
-                    group_sample_base_quals[i] = batchinfo.sample_base_quals[index[i]]
+            if popgroup.group_num:
+                # base codes and qualities of all the groups are gathered in one pass
+                popgroup.gather(batchinfo)
 
+            for g in range(popgroup.group_num):
                 group_bt = BaseType()
-                group_bt.cinit(batchinfo.ref_base.upper(), group_sample_bases, group_sample_base_quals,
-                               group_sample_size, min_af)
+                group_bt.cinit(batchinfo.ref_base.upper(),
+                               popgroup.group_base_codes + popgroup.group_offset[g],
+                               popgroup.group_base_quals + popgroup.group_offset[g],
+                               popgroup.group_size[g],
+                               min_af)
 
                 group_bt.lrt([batchinfo.ref_base.upper()] + bt.alt_bases)
-                popgroup_bt[group] = group_bt
-
-                free(group_sample_bases)
-                free(group_sample_base_quals)
+                popgroup_bt[popgroup.groups[g]] = group_bt
 
-            _out_vcf_line(batchinfo, bt, popgroup_bt, vcf_file_handle)
+            _out_vcf_line(batchinfo, bt, popgroup_bt, site_annotation, vcf_writer)
     return
 
-cdef list _base_depth_and_indel(char ** bases, int size):
-    # coverage info for each position
-    cdef dict base_depth = {b: 0 for b in BASE}
-    cdef dict indel_depth = {}
 
-    cdef int i = 0
-    for i in range(size):
-
-        # The size of `base[i]` would be 1 except indel!
-        if bases[i][0] == 'N':
-            continue
-
-        if bases[i] in base_depth:
-            # ignore all bases('*') which not match ``cmm.BASE``
-            base_depth[bases[i]] += 1
-        else:
-            # Indel
-            indel_depth[bases[i]] = indel_depth.get(bases[i], 0) + 1
-
-    cdef bytes indels = bytes(','.join(
-        [k + '|' + str(v) for k, v in indel_depth.items()]
-    ) if indel_depth else ".")
-
-    return [base_depth, indels]
-
-cdef void _out_cvg_file(BatchInfo batchinfo, dict popgroup, out_file_handle):
-    """output coverage information into `out_file_handle`"""
-    # coverage info for each position
-    cdef dict base_depth
-    cdef bytes indels
-    base_depth, indels = _base_depth_and_indel(batchinfo.sample_bases, batchinfo.size)
-
-    # base depth and indels for each subgroup
-    cdef char ** group_sample_bases
-    cdef int group_sample_size
-    cdef dict group_cvg = {}
-    cdef bytes group
-    cdef list index
-
-    # Here is one of the two parts which most time consuming!
-    cdef int i = 0
-    cdef dict sub_bd
-    cdef bytes sub_inds
-    for group, index in popgroup.items():
-
-        group_sample_size = len(index)
-        group_sample_bases = <char**> (calloc(group_sample_size, sizeof(char*)))
-        if group_sample_bases == NULL:
-            logger.error("Fail allocate memory for ``group_sample_bases`` in _out_cvg_file.")
-            sys.exit(1)
+cdef bytes _indel_string(dict indel_depth):
+    return bytes(','.join([k + '|' + str(v) for k, v in indel_depth.items()]) if indel_depth else ".")
 
-        for i in range(group_sample_size):
-            group_sample_bases[i] = batchinfo.sample_bases[index[i]]
 
-        sub_bd, sub_inds = _base_depth_and_indel(group_sample_bases, group_sample_size)
-        group_cvg[group] = [sub_bd, sub_inds]
+cdef void _out_cvg_file(BatchInfo batchinfo, PopGroup popgroup, SiteAnnotation site_annotation,
+                        RecordWriter writer):
+    """output coverage information into `writer`"""
+    # coverage info of each group and all the samples for each position, in one pass.
+    popgroup.count(batchinfo)
 
-        free(group_sample_bases)
+    cdef uint32_t *counts = popgroup.row(popgroup.group_num)
+    cdef int depth = counts[BASE_CODE_A] + counts[BASE_CODE_C] + counts[BASE_CODE_G] + counts[BASE_CODE_T]
+    if depth == 0:
+        return
 
+    # Strand bias of REF and the most covered ALT, the result could be shared with the VCF line.
+    cdef bytes ref_base = batchinfo.ref_base
     cdef double fs, sor
     cdef int ref_fwd, ref_rev, alt_fwd, alt_rev
-    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = 0, -1, 0, 0, 0, 0
-
-    # Here is the other part which most time consuming!
-    cdef bytes ref_base = batchinfo.ref_base
-    cdef bytes b1, b2
-    if sum(base_depth.values()) > 0:
-        # could we stop sorting ?
-        base_sorted = sorted(base_depth.items(), key=lambda x: x[1], reverse=True)
-        b1, b2 = base_sorted[0][0], base_sorted[1][0]
-
-        # This is very efficient.
-        fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias(
-            ref_base.upper(),  # reference
-            [b1 if b1 != ref_base.upper() else b2],  # alt-allele
-            batchinfo.sample_bases,
-            batchinfo.strands,
-            batchinfo.size
-        )
-
-    cdef list group_info
-    if sum(base_depth.values()):
-
-        group_info = []
-        if group_cvg:
-            for k in group_cvg.keys():
-                depth, indel = group_cvg[k]
-                indel = [indel] if indel != "." else []
-                s = ':'.join(map(str, [depth[b] for b in BASE]) + indel)
-                group_info.append(s)
-
-        out_file_handle.write(
-            '\t'.join(
-                [batchinfo.chrid, str(batchinfo.position), ref_base, str(sum(base_depth.values()))] +
-                [str(base_depth[b]) for b in BASE] +
-                [indels] +
-                [str("%.3f" % fs), str("%.3f" % sor), ','.join(map(str, [ref_fwd, ref_rev, alt_fwd, alt_rev]))] +
-                group_info
-            ) + '\n'
-        )
-
+    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = site_annotation.strand_bias(
+        ref_base.upper(), [site_annotation.major_alt_base(ref_base.upper())])
+
+    cdef int code
+    writer.write_bytes(batchinfo.chrid)
+    writer.write_char('\t')
+    writer.write_int(batchinfo.position)
+    writer.write_char('\t')
+    writer.write_bytes(ref_base)
+    writer.write_char('\t')
+    writer.write_int(depth)
+    for code in range(BASE_CODE_A, BASE_CODE_T + 1):
+        writer.write_char('\t')
+        writer.write_int(counts[code])
+
+    writer.write_char('\t')
+    writer.write_bytes(_indel_string(popgroup.indels.get(popgroup.group_num)))
+    writer.write_char('\t')
+    writer.write_float(fs, 3)
+    writer.write_char('\t')
+    writer.write_float(sor, 3)
+    writer.write_char('\t')
+    writer.write_int(ref_fwd)
+    writer.write_char(',')
+    writer.write_int(ref_rev)
+    writer.write_char(',')
+    writer.write_int(alt_fwd)
+    writer.write_char(',')
+    writer.write_int(alt_rev)
+
+    # A:C:G:T[:indels] of each group
+    cdef int g
+    for g in range(popgroup.group_num):
+        counts = popgroup.row(g)
+        writer.write_char('\t')
+        for code in range(BASE_CODE_A, BASE_CODE_T + 1):
+            if code > BASE_CODE_A:
+                writer.write_char(':')
+            writer.write_int(counts[code])
+
+        if g in popgroup.indels:
+            writer.write_char(':')
+            writer.write_bytes(_indel_string(popgroup.indels[g]))
+
+    writer.write_char('\n')
     return
 
-cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out_file_handle):
-    """output vcf lines into `out_file_handle`"""
+cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, SiteAnnotation site_annotation,
+                        RecordWriter writer):
+    """output vcf lines into `writer`"""
 
     cdef dict alt_gt = {b: './' + str(k + 1) for k, b in enumerate(bt.alt_bases)}
-    cdef list samples = []
     cdef int k
-    cdef char *b
-    # for k, b in enumerate(bases):
-    for k in range(batchinfo.size):
-
-        b = batchinfo.sample_bases[k]
-        # For sample FORMAT
-        if b[0] not in ['N', '-', '+']:
-            # For the base which not in bt.alt_bases()
-            if b not in alt_gt:
-                alt_gt[b] = './.'
-
-            gt = '0/.' if b == batchinfo.ref_base.upper() else alt_gt[b]
-
-            samples.append(gt + ':' + b + ':' + chr(batchinfo.strands[k]) + ':' +
-                           str(round(bt.qual_pvalue[k], 6)))
-        else:
-            samples.append('./.')  # 'N' base or indel
+    cdef bytes b
+    cdef uint8_t code
+    cdef bytes ref_upper = batchinfo.ref_base.upper()
+
+    # "GT:AB:" of A/C/G/T in this site, index by base code
+    cdef list gt_base_prefix = [None] * (BASE_CODE_T + 1)
+    cdef const char *gt_base_prefix_str[BASE_CODE_T + 1]
+    for code in range(BASE_CODE_A, BASE_CODE_T + 1):
+        b = decode_base(code)
+        # For the base which not in bt.alt_bases(), it's './.'
+        gt_base_prefix[code] = ('0/.' if b == ref_upper else alt_gt.get(b, './.')) + ':' + b + ':'
+        gt_base_prefix_str[code] = gt_base_prefix[code]
 
     # Rank Sum Test for mapping qualities of REF versus ALT reads
-    mq_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                         batchinfo.mapqs, batchinfo.size)
+    mq_rank_sum = site_annotation.ranksum(batchinfo.ref_base.upper(), bt.alt_bases, RANKSUM_MAPQ)
 
     # Rank Sum Test for variant appear position among read of REF versus ALT
-    read_pos_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                               batchinfo.read_pos_rank, batchinfo.size)
+    read_pos_rank_sum = site_annotation.ranksum(batchinfo.ref_base.upper(), bt.alt_bases, RANKSUM_READPOS)
 
     # Rank Sum Test for base quality of REF versus ALT
-    base_q_rank_sum = ref_vs_alt_ranksumtest(batchinfo.ref_base.upper(), bt.alt_bases, batchinfo.sample_bases,
-                                             batchinfo.sample_base_quals, batchinfo.size)
+    base_q_rank_sum = site_annotation.ranksum(batchinfo.ref_base.upper(), bt.alt_bases, RANKSUM_BASEQ)
 
     # Variant call confidence normalized by depth of sample reads
     # supporting a variant.
@@ -555,13 +636,8 @@ cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out
 
     # Strand bias by fisher exact test and Strand bias estimated by the
     # Symmetric Odds Ratio test
-    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = strand_bias(
-        batchinfo.ref_base.upper(),
-        bt.alt_bases,
-        batchinfo.sample_bases,
-        batchinfo.strands,
-        batchinfo.size
-    )
+    fs, sor, ref_fwd, ref_rev, alt_fwd, alt_rev = site_annotation.strand_bias(batchinfo.ref_base.upper(),
+                                                                              bt.alt_bases)
 
     # base=>[CAF, allele depth], CAF = Allele frequency by read count
     caf = {b: ['%f' % round(bt.depth[b] / float(bt.total_depth), 6),
@@ -589,10 +665,33 @@ cdef void _out_vcf_line(BatchInfo batchinfo, BaseType bt, dict pop_group_bt, out
                                     for bb in bt.alt_bases]))
             info[group] = af
 
-    out_file_handle.write('\t'.join([batchinfo.chrid, str(batchinfo.position), '.', batchinfo.ref_base,
-                                     ','.join(bt.alt_bases), str(bt.var_qual),
-                                     '.' if bt.var_qual > QUAL_THRESHOLD else 'LowQual',
-                                     ';'.join([kk + '=' + vv for kk, vv in sorted(
-                                         info.items(), key=lambda x: x[0])]),
-                                     'GT:AB:SO:BP'] + samples) + '\n')
+    writer.write_bytes(<bytes>'\t'.join([batchinfo.chrid, str(batchinfo.position), '.', batchinfo.ref_base,
+                                  ','.join(bt.alt_bases), str(bt.var_qual),
+                                  '.' if bt.var_qual > QUAL_THRESHOLD else 'LowQual',
+                                  ';'.join([kk + '=' + vv for kk, vv in sorted(
+                                      info.items(), key=lambda x: x[0])]),
+                                  'GT:AB:SO:BP']))
+
+    # FORMAT of samples, GT:AB:SO:BP
+    for k in range(batchinfo.size):
+
+        writer.write_char('\t')
+        code = batchinfo.base_codes[k]
+        if code == BASE_CODE_N or code == BASE_CODE_INDEL:
+            writer.write_str('./.')  # 'N' base or indel
+            continue
+
+        if code <= BASE_CODE_T:
+            writer.write_str(gt_base_prefix_str[code])
+        else:
+            # The base which is not in [A, C, G, T]
+            b = batchinfo.get_base(k)
+            writer.write_bytes(('0/.' if b == ref_upper else alt_gt.get(b, './.')) + ':' + b + ':')
+
+        writer.write_char(batchinfo.strands[k])
+        writer.write_char(':')
+        # The same as str(round(bt.qual_pvalue[k], 6))
+        writer.write_str(QUAL_PVALUE_STR[batchinfo.sample_base_quals[k]])
+
+    writer.write_char('\n')
     return
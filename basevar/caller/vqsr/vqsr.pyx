@@ -14,7 +14,6 @@ from basevar.caller.vqsr import variant_data_manager as vdm
 from basevar.caller.vqsr import variant_recalibrator as vror
 
 from basevar.io.openfile import Open
-from basevar.io.BGZF.tabix import tabix_index
 
 def run_VQSR(opt):
     # record the sites of training data
@@ -69,8 +68,8 @@ def run_VQSR(opt):
                'This variant was used to build the positive training set of good variants')
 
     logger.info("Outputting to %s ..." % opt.output_vcf_file_name)
-    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True) if opt.output_vcf_file_name.endswith(".gz") else \
-        open(opt.output_vcf_file_name, "w")
+    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True, tabix=True) \
+        if opt.output_vcf_file_name.endswith(".gz") else open(opt.output_vcf_file_name, "w")
 
     for k, h in sorted(h_info.header.items(), key=lambda d: d[0]):
         OUT.write("\n".join(h) + "\n")
@@ -144,9 +143,6 @@ def run_VQSR(opt):
 
     OUT.close()
 
-    if opt.output_vcf_file_name.endswith(".gz"):
-        tabix_index(opt.output_vcf_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-
     logger.info('Finish Outputting %d lines.\n' % n)
 
     ## Output Summary
@@ -213,8 +209,8 @@ def apply_VQSR(opt):
                 "bad variants. " % (vqlod_cutoff, opt.truth_sensitivity_level, float(false_num) / false_set_num))
 
     logger.info("Outputting to %s ..." % opt.output_vcf_file_name)
-    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True) if opt.output_vcf_file_name.endswith(".gz") else \
-        open(opt.output_vcf_file_name, "w")
+    OUT = Open(opt.output_vcf_file_name, "wb", isbgz=True, tabix=True) \
+        if opt.output_vcf_file_name.endswith(".gz") else open(opt.output_vcf_file_name, "w")
 
     cdef int pass_variant_num = 0
     with Open(opt.vcf_infile, 'r') as I:
@@ -243,8 +239,4 @@ def apply_VQSR(opt):
     logger.info("There are a total of %d variants, %d of which are PASS base on the VQSLOD "
                 "cutoff." % (total_variant_num, pass_variant_num))
 
-    if opt.output_vcf_file_name.endswith(".gz"):
-        # create tabix index
-        tabix_index(opt.output_vcf_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-
     return
@@ -2,12 +2,19 @@
 # cython: profile=True
 # adds doc-strings for sphinx
 import io
+import os
 from cpython cimport PyBytes_FromStringAndSize
 
 
+import struct
+from libc.stdlib cimport atol, realloc
+from libc.string cimport memchr, memcmp, memcpy
+
 from basevar.io.htslibWrapper cimport BGZF, bgzf_open, bgzf_close, bgzf_write, bgzf_read, \
     bgzf_index_build_init, bgzf_flush, bgzf_index_dump, bgzf_seek, bgzf_tell, bgzf_getline, \
-    int64_t, kstring_t, free
+    int64_t, uint8_t, uint64_t, kstring_t, free, bgzf_mt, bgzf_thread_pool, hts_tpool, hts_tpool_init, \
+    hts_idx_t, hts_idx_init, hts_idx_push, hts_idx_finish, hts_idx_set_meta, hts_idx_save_as, \
+    hts_idx_destroy, HTS_FMT_TBI
 
 
 from basevar.io.libcutils cimport force_bytes
@@ -19,10 +26,57 @@ DEF SEEK_SET = 0
 DEF SEEK_CUR = 1
 DEF SEEK_END = 2
 
-__all__ = ["BGZFile"]
+# The number of blocks processed by each thread when a BGZFile has its own threads.
+DEF BGZF_MT_SUB_BLOCKS = 256
+
+# The tabix index of ``BGZFile(..., tabix=True)``, the same as
+# ``tabix_index(seq_col=0, start_col=1, end_col=1)``: (preset, sc, bc, ec, meta_char, line_skip)
+DEF TBX_MIN_SHIFT = 14
+DEF TBX_N_LVLS = 5
+TBX_CONF = (0, 1, 2, 2, ord("#"), 0)
+
+__all__ = ["BGZFile", "set_thread_pool", "thread_pool_size"]
 
 BUFFER_SIZE = io.DEFAULT_BUFFER_SIZE
 
+# The worker threads shared by all the BGZFile in this process. The threads do not
+# survive ``fork()``, so the pool is created lazily in each process.
+cdef int _THREAD_NUM = 0
+cdef hts_tpool *_THREAD_POOL = NULL
+cdef object _THREAD_POOL_PID = None
+
+
+def set_thread_pool(int thread_num):
+    """Set the number of the compression/decompression worker threads shared by all
+    the BGZFile in the process, ``thread_num`` < 2 means no worker thread.
+
+    It should be called before the files are opened, e.g. just after parsing the
+    command line, the pool is then created in each (child) process when it's first used.
+    """
+    global _THREAD_NUM
+    _THREAD_NUM = thread_num if thread_num > 1 else 0
+    return
+
+
+def thread_pool_size():
+    """The number of the worker threads shared by the BGZFile, 0 for no threads."""
+    return _THREAD_NUM
+
+
+cdef hts_tpool *_shared_thread_pool():
+    global _THREAD_POOL, _THREAD_POOL_PID
+    if _THREAD_NUM == 0:
+        return NULL
+
+    cdef object pid = os.getpid()
+    if _THREAD_POOL == NULL or _THREAD_POOL_PID != pid:
+        # The pool inherited from the parent process has no threads in this process,
+        # just leave it and create a new one.
+        _THREAD_POOL = hts_tpool_init(_THREAD_NUM)
+        _THREAD_POOL_PID = pid
+
+    return _THREAD_POOL
+
 
 cdef class BGZFile(object):
     """The BGZFile class simulates most of the methods of a file object with
@@ -34,7 +88,26 @@ cdef class BGZFile(object):
     cdef BGZF* bgzf
     cdef readonly object name, index
 
-    def __init__(self, filename, mode=None, index=None):
+    # For building the tabix index while writing
+    cdef readonly bint tabix
+    cdef bint tbx_on_write  # False if the index is built by ``tabix_index`` after closing
+    cdef hts_idx_t *tbx_idx
+    cdef uint64_t tbx_header_end  # the offset after the header lines
+    cdef dict tbx_tids
+    cdef list tbx_names
+    cdef kstring_t tbx_chrom  # the chromosome of last record
+    cdef int tbx_tid
+    cdef kstring_t tbx_pending  # a record which is not ended by '\n' in the last ``write()``
+
+    def __cinit__(self):
+        self.bgzf = NULL
+        self.tbx_idx = NULL
+        self.tbx_chrom.l = self.tbx_chrom.m = 0
+        self.tbx_chrom.s = NULL
+        self.tbx_pending.l = self.tbx_pending.m = 0
+        self.tbx_pending.s = NULL
+
+    def __init__(self, filename, mode=None, index=None, threads=None, tabix=False):
         """Constructor for the BGZFile class.
 
         The mode argument can be any of 'r', 'rb', 'a', 'ab', 'w', 'wb', 'x', or
@@ -42,6 +115,21 @@ cdef class BGZFile(object):
         is the mode of fileobj if discernible; otherwise, the default is 'rb'.
         A mode of 'r' is equivalent to one of 'rb', and similarly for 'w' and
         'wb', 'a' and 'ab', and 'x' and 'xb'.
+
+        The threads argument is the number of worker threads to compress or
+        decompress the blocks. By default (None) the file uses the thread pool
+        of the process (see ``set_thread_pool``); 0 or 1 means the blocks are
+        processed in the calling thread, and a larger number gives the file its
+        own threads.
+
+        If tabix is True, the file is written with its tabix index (``<filename>.tbi``),
+        the records are sorted tab-separated lines with the chromosome and the 1-based
+        position in the first two columns (e.g. CVG and VCF), and the lines begin with '#'
+        at the top are the header. The virtual offset and bin of each record are recorded
+        while they are written, and the index is saved when the file is closed, there's
+        no need to read the whole file again by ``tabix_index``. But the virtual offsets
+        are not known by ``bgzf_tell`` when the blocks are compressed by the worker threads,
+        so the index of a file with threads is built by ``tabix_index`` after it's closed.
         """
         if mode and ('t' in mode or 'U' in mode):
             raise ValueError("Invalid mode: {!r}".format(mode))
@@ -56,12 +144,132 @@ cdef class BGZFile(object):
         self.index = encode_filename(index) if index is not None else None
 
         self.bgzf = bgzf_open(self.name, mode)
+        if self.bgzf == NULL:
+            raise IOError('Could not open %s' % filename)
+
+        cdef hts_tpool *pool = _shared_thread_pool() if threads is None else NULL
+        self.tabix = tabix and self.bgzf.is_write
+        self.tbx_on_write = self.tabix and pool == NULL and (threads is None or threads < 2)
+        self.tbx_header_end = 0
+        self.tbx_tids = {}
+        self.tbx_names = []
+        self.tbx_tid = -1
+
+        if threads is None:
+            if pool != NULL and bgzf_thread_pool(self.bgzf, pool, 0) < 0:
+                raise IOError('Error attaching the thread pool to BGZFile')
+
+        elif threads > 1 and bgzf_mt(self.bgzf, threads, BGZF_MT_SUB_BLOCKS) < 0:
+            raise IOError('Error creating threads for BGZFile')
 
         if self.bgzf.is_write and index is not None and bgzf_index_build_init(self.bgzf) < 0:
             raise IOError('Error building bgzf index')
 
     def __dealloc__(self):
         self.close()
+        if self.tbx_idx != NULL:
+            hts_idx_destroy(self.tbx_idx)
+            self.tbx_idx = NULL
+
+        free(self.tbx_chrom.s)
+        free(self.tbx_pending.s)
+
+    cdef int _write_line(self, const char *line, size_t length) except -1:
+        """Write a line (with its '\n' if there's one) and add it into the tabix index."""
+        if bgzf_write(self.bgzf, line, length) < 0:
+            raise IOError('BGZFile write failed')
+
+        cdef size_t l = length - 1 if length > 0 and line[length-1] == '\n' else length
+        if l == 0 or line[0] == '#':
+            if self.tbx_idx == NULL:
+                # Still in the header
+                self.tbx_header_end = bgzf_tell(self.bgzf)
+            return 0
+
+        cdef const char *tab = <const char*>memchr(line, '\t', l)
+        if tab == NULL:
+            raise IOError('Could not find the position for tabix index in: %s' % line[:l])
+
+        cdef size_t chrom_len = tab - line
+        cdef bytes chrom
+        if chrom_len != self.tbx_chrom.l or memcmp(line, self.tbx_chrom.s, chrom_len) != 0:
+            chrom = line[:chrom_len]
+            if chrom not in self.tbx_tids:
+                self.tbx_tids[chrom] = len(self.tbx_names)
+                self.tbx_names.append(chrom)
+
+            self.tbx_tid = self.tbx_tids[chrom]
+            if chrom_len + 1 > self.tbx_chrom.m:
+                self.tbx_chrom.m = chrom_len + 1
+                self.tbx_chrom.s = <char*>realloc(self.tbx_chrom.s, self.tbx_chrom.m)
+
+            memcpy(self.tbx_chrom.s, line, chrom_len)
+            self.tbx_chrom.l = chrom_len
+
+        if self.tbx_idx == NULL:
+            self.tbx_idx = hts_idx_init(0, HTS_FMT_TBI, self.tbx_header_end, TBX_MIN_SHIFT, TBX_N_LVLS)
+            if self.tbx_idx == NULL:
+                raise IOError('Could not create the tabix index of %s' % self.name)
+
+        # [pos-1, pos) in 0-base, the end offset of record is the current offset.
+        cdef long int pos = atol(tab + 1)
+        if hts_idx_push(self.tbx_idx, self.tbx_tid, max(0, pos - 1), max(1, pos),
+                        bgzf_tell(self.bgzf), 1) < 0:
+            raise IOError('Could not index %s, the records must be sorted by chromosome and position. '
+                          'The record: %s' % (self.name, line[:l]))
+
+        return 0
+
+    cdef int _write_records(self, const char *data, size_t length) except -1:
+        """Write the lines one by one for the tabix index, the last line without
+        '\n' is kept in ``tbx_pending`` until the next ``write()`` or ``close()``.
+        """
+        cdef const char *end = data + length
+        cdef const char *newline
+        cdef size_t n
+        while data < end:
+            newline = <const char*>memchr(data, '\n', end - data)
+            n = (newline + 1 - data) if newline != NULL else (end - data)
+            if self.tbx_pending.l + n + 1 > self.tbx_pending.m:
+                self.tbx_pending.m = self.tbx_pending.l + n + 1
+                self.tbx_pending.s = <char*>realloc(self.tbx_pending.s, self.tbx_pending.m)
+
+            if newline == NULL:
+                memcpy(self.tbx_pending.s + self.tbx_pending.l, data, n)
+                self.tbx_pending.l += n
+            elif self.tbx_pending.l > 0:
+                memcpy(self.tbx_pending.s + self.tbx_pending.l, data, n)
+                self._write_line(self.tbx_pending.s, self.tbx_pending.l + n)
+                self.tbx_pending.l = 0
+            else:
+                self._write_line(data, n)
+
+            data += n
+
+        return 0
+
+    cdef int _save_tabix_index(self) except -1:
+        """Finish the tabix index after the data are flushed, it's saved after the file is closed."""
+        if self.tbx_pending.l > 0:
+            self._write_line(self.tbx_pending.s, self.tbx_pending.l)
+            self.tbx_pending.l = 0
+
+        if bgzf_flush(self.bgzf) < 0:
+            raise IOError('Error flushing BGZFile object')
+
+        if self.tbx_idx == NULL:
+            # No record in the file
+            self.tbx_idx = hts_idx_init(0, HTS_FMT_TBI, self.tbx_header_end, TBX_MIN_SHIFT, TBX_N_LVLS)
+            if self.tbx_idx == NULL:
+                raise IOError('Could not create the tabix index of %s' % self.name)
+
+        hts_idx_finish(self.tbx_idx, bgzf_tell(self.bgzf))
+
+        # The meta data of tabix: the configure, the length of names and the names ended by '\0'
+        cdef bytes names = b"".join([name + b"\0" for name in self.tbx_names])
+        cdef bytes meta = struct.pack("<7i", *(TBX_CONF + (len(names),))) + names
+        hts_idx_set_meta(self.tbx_idx, len(meta), <uint8_t*><char*>meta, 1)
+        return 0
 
     def write(self, data):
         if not self.bgzf:
@@ -78,7 +286,9 @@ cdef class BGZFile(object):
             data = memoryview(data)
             length = data.nbytes
 
-        if length > 0 and bgzf_write(self.bgzf, <char *>data, length) < 0:
+        if self.tbx_on_write:
+            self._write_records(<char *>data, length)
+        elif length > 0 and bgzf_write(self.bgzf, <char *>data, length) < 0:
             raise IOError('BGZFile write failed')
 
         return length
@@ -127,6 +337,9 @@ cdef class BGZFile(object):
         if not self.bgzf:
             return
 
+        if self.tbx_on_write:
+            self._save_tabix_index()
+
         if self.bgzf.is_write and bgzf_flush(self.bgzf) < 0:
             raise IOError('Error flushing BGZFile object')
 
@@ -139,6 +352,17 @@ cdef class BGZFile(object):
         if ret < 0:
             raise IOError('Error closing BGZFile object')
 
+        if self.tbx_idx != NULL:
+            ret = hts_idx_save_as(self.tbx_idx, self.name, self.name + b".tbi", HTS_FMT_TBI)
+            hts_idx_destroy(self.tbx_idx)
+            self.tbx_idx = NULL
+            if ret < 0:
+                raise IOError('Could not save the tabix index of %s' % self.name)
+
+        elif self.tabix:
+            from basevar.io.BGZF.tabix import tabix_index
+            tabix_index(self.name, force=True, seq_col=0, start_col=1, end_col=1)
+
     def __enter__(self):
         return self
 
@@ -152,6 +376,10 @@ cdef class BGZFile(object):
         if self.bgzf.is_write and bgzf_flush(self.bgzf) < 0:
             raise IOError('Error flushing BGZFile object')
 
+        if self.bgzf.is_write and self.tbx_on_write and self.tbx_idx == NULL:
+            # The header ends at the new block now.
+            self.tbx_header_end = bgzf_tell(self.bgzf)
+
     def fileno(self):
         """Invoke the underlying file object's fileno() method.
 
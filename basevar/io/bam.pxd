@@ -3,12 +3,40 @@
 Author: Shujia Huang
 Date: 2019-06-03 00:28:50
 """
-from basevar.io.htslibWrapper cimport Samfile
+from basevar.io.htslibWrapper cimport Samfile, ReadIterator, samFile, hts_itr_t, bam1_t
+from basevar.io.read cimport BamReadBuffer
 from basevar.caller.batch cimport BatchGenerator
 
-cdef list get_sample_names(list bamfiles, bint filename_has_samplename)
+cdef class SamfilePool:
+    cdef int max_open_files
+    cdef int open_files
+    cdef object handles  # OrderedDict, filename => Samfile, the least recently used first
+    cdef readonly long int hits
+    cdef readonly long int misses
+    cdef readonly long int evictions
+
+    cdef Samfile get(self, bytes filename)
+    cdef void _evict(self)
+    cdef void close(self)
+
+
+cdef class SampleRecords:
+    cdef ReadIterator iterator
+    cdef bam1_t **records
+    cdef int size
+    cdef int capacity
+    cdef int max_size
+    cdef bint is_error
+    cdef object ready  # threading.Event, set when all the records are fetched
+
+    cdef void _fetch(self, samFile *fp, hts_itr_t *itr, bam1_t *b) nogil
+
+
+cdef SamfilePool get_samfile_pool(options)
+cdef list get_sample_names(list bamfiles, bint filename_has_samplename, int nCPU=*, basestring cache_file=*)
 cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start, long int end,
                        char* refseq, options)
+cdef void uncompress_sample_reads(BamReadBuffer sample_read_buffer, char *refseq, long int refstart, options)
 cdef bint load_data_from_bamfile(Samfile bam_reader,
                                  bytes sample_id,
                                  bytes chrom,
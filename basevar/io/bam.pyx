@@ -3,20 +3,361 @@
 """
 import os
 import sys
+import time
+import resource
+import threading
+import multiprocessing
+from collections import OrderedDict
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from libc.stdlib cimport realloc, free
+from libc.string cimport strlen
 
 from basevar.log import logger
 from basevar.utils cimport c_max
 from basevar.io.read cimport BamReadBuffer
-from basevar.io.htslibWrapper cimport Samfile, ReadIterator, cAlignedRead
+from basevar.io.htslibWrapper cimport Samfile, ReadIterator, cAlignedRead, samFile, hts_itr_t, bam1_t, \
+    bam_dup1, bam_destroy1, sam_itr_next, compress_read
+
+cdef extern from "string.h" nogil:
+    size_t strnlen(const char *s, size_t maxlen)
 from basevar.caller.batch cimport BatchGenerator
 
+# The budget of file descriptors for the pool if it can't be gotten from RLIMIT_NOFILE
+DEF DEFAULT_MAX_OPEN_FILES = 1024
+DEF INITIAL_RECORD_NUM = 4096
+
+# The statistics of the sequences and qualities of the reads which are kept in memory.
+DEF READ_NUM = 0
+DEF RAW_BYTES = 1  # Uncompressed
+DEF STORED_BYTES = 2  # As they are stored, it's the same as ``RAW_BYTES`` if we don't compress reads.
+DEF UNCOMPRESS_SECONDS = 3
+cdef double READ_STATISTICS[4]
+READ_STATISTICS[:] = [0, 0, 0, 0]
+
+
+def read_statistics():
+    """Return the statistics of the reads which are loaded since the last ``reset_read_statistics``.
+
+    ``reads``: The number of reads.
+    ``raw_bytes``/``stored_bytes``: The memory of sequences and qualities before and after compressing.
+    ``uncompress_seconds``: The time of uncompressing the reads.
+    """
+    return {"reads": READ_STATISTICS[READ_NUM],
+            "raw_bytes": READ_STATISTICS[RAW_BYTES],
+            "stored_bytes": READ_STATISTICS[STORED_BYTES],
+            "uncompress_seconds": READ_STATISTICS[UNCOMPRESS_SECONDS]}
+
+
+def reset_read_statistics():
+    cdef int i
+    for i in range(4):
+        READ_STATISTICS[i] = 0
+
+    return
+
 cdef bint is_indexable(filename):
     return filename.lower().endswith((".bam", ".cram"))
 
 
-cdef list get_sample_names(list bamfiles, bint filename_has_samplename):
-    """Getting sample name in BAM/CRMA files from RG tag and return."""
+cdef int _open_file_cost(bytes filename):
+    """The number of file descriptors kept by an opened alignment file, CRAM
+    keeps the reference file opened as well."""
+    return 2 if filename.lower().endswith(".cram") else 1
+
+
+cdef class SamfilePool:
+    """A pool of the opened BAM/CRAM files and their index.
+
+    The files are kept open across the regions and chromosomes, so the index of
+    each file is loaded just once. The least recently used files are closed when
+    the file descriptors are more than ``max_open_files``.
+    """
+    def __cinit__(self, int max_open_files):
+        self.max_open_files = max_open_files
+        self.open_files = 0
+        self.handles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __dealloc__(self):
+        self.close()
+
+    cdef Samfile get(self, bytes filename):
+        """Return the opened ``Samfile`` of ``filename`` with its index loaded."""
+        cdef Samfile reader = self.handles.pop(filename, None)
+        if reader is not None:
+            self.hits += 1
+            # Move to the end as the most recently used one.
+            self.handles[filename] = reader
+            return reader
+
+        self.misses += 1
+        cdef int cost = _open_file_cost(filename)
+        while self.handles and self.open_files + cost > self.max_open_files:
+            self._evict()
+
+        # ``Samfile`` doesn't copy the filename, the key of ``handles`` keeps it alive.
+        reader = Samfile(filename)
+        reader.open("r", True)  # load_index
+
+        self.handles[filename] = reader
+        self.open_files += cost
+        return reader
+
+    cdef void _evict(self):
+        cdef Samfile reader
+        filename, reader = self.handles.popitem(last=False)
+        reader.close()
+        self.open_files -= _open_file_cost(filename)
+        self.evictions += 1
+        return
+
+    cdef void close(self):
+        while self.handles:
+            self._evict()
+
+        return
+
+    def statistics(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "open_files": self.open_files}
+
+
+cdef class SampleRecords:
+    """The raw alignment records of one sample in a region, which are decompressed
+    and decoded by a decoder thread without GIL, then converted into ``cAlignedRead``
+    in the main thread.
+    """
+    def __cinit__(self, ReadIterator iterator, int max_size):
+        self.iterator = iterator
+        self.records = NULL
+        self.size = 0
+        self.capacity = 0
+        self.max_size = max_size
+        self.is_error = False
+        self.ready = threading.Event()
+
+    def __dealloc__(self):
+        cdef int i
+        if self.records != NULL:
+            for i in range(self.size):
+                if self.records[i] != NULL:
+                    bam_destroy1(self.records[i])
+
+            free(self.records)
+            self.records = NULL
+
+    def fetch(self):
+        """Fetch all the records of the sample, it's called by the decoder threads."""
+        cdef samFile *fp = self.iterator.the_samfile
+        cdef hts_itr_t *itr = self.iterator.the_iterator
+        cdef bam1_t *b = self.iterator.b
+        with nogil:
+            self._fetch(fp, itr, b)
+
+        self.ready.set()
+        return
+
+    cdef void _fetch(self, samFile *fp, hts_itr_t *itr, bam1_t *b) nogil:
+        cdef bam1_t **records
+        while self.size <= self.max_size and sam_itr_next(fp, itr, b) >= 0:
+            if self.size == self.capacity:
+                self.capacity = INITIAL_RECORD_NUM if self.capacity == 0 else 2 * self.capacity
+                records = <bam1_t**>(realloc(self.records, self.capacity * sizeof(bam1_t*)))
+                if records == NULL:
+                    self.is_error = True
+                    return
+
+                self.records = records
+
+            self.records[self.size] = bam_dup1(b)
+            if self.records[self.size] == NULL:
+                self.is_error = True
+                return
+
+            self.size += 1
+
+        return
+
+
+def _decoder_worker(jobs):
+    """The decoder thread, it fetches the records of ``SampleRecords`` in ``jobs`` until getting None."""
+    while True:
+        sample_records = jobs.get()
+        if sample_records is None:
+            break
+
+        sample_records.fetch()
+
+    return
+
+
+# One pool of decoder threads in each process, the threads are not inherited by the children.
+cdef object _DECODER_JOBS = None
+cdef object _DECODER_JOBS_PID = None
+cdef int _DECODER_THREAD_NUM = 0
+
+
+cdef object get_decoder_jobs(int thread_num):
+    """Return the job queue of the decoder threads of current process, the threads are started
+    by the first call and they're kept until the process exits, so we don't have to create
+    them for each ``load_bamdata``.
+    """
+    global _DECODER_JOBS, _DECODER_JOBS_PID, _DECODER_THREAD_NUM
+
+    cdef object pid = os.getpid()
+    if _DECODER_JOBS is None or _DECODER_JOBS_PID != pid:
+        _DECODER_JOBS = Queue()
+        _DECODER_JOBS_PID = pid
+        _DECODER_THREAD_NUM = 0
+
+    while _DECODER_THREAD_NUM < thread_num:
+        t = threading.Thread(target=_decoder_worker, args=(_DECODER_JOBS,))
+        t.daemon = True  # Don't block the exit of the process.
+        t.start()
+        _DECODER_THREAD_NUM += 1
+
+    return _DECODER_JOBS
+
+
+# One pool in each process, the opened files should not be shared with the children.
+cdef SamfilePool _SAMFILE_POOL = None
+cdef object _SAMFILE_POOL_PID = None
+
+
+cdef int _max_open_files(options):
+    if options.max_open_files > 0:
+        return options.max_open_files
+
+    # Keep half of the file descriptors for the others, e.g. batchfiles and outputs.
+    cdef long int soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY or soft_limit <= 0:
+        return DEFAULT_MAX_OPEN_FILES
+
+    return max(1, soft_limit / 2)
+
+
+cdef SamfilePool get_samfile_pool(options):
+    """Return the ``SamfilePool`` of current process."""
+    global _SAMFILE_POOL, _SAMFILE_POOL_PID
+
+    cdef object pid = os.getpid()
+    if _SAMFILE_POOL is None or _SAMFILE_POOL_PID != pid:
+        _SAMFILE_POOL = SamfilePool(_max_open_files(options))
+        _SAMFILE_POOL_PID = pid
+
+    return _SAMFILE_POOL
+
+
+def samfile_pool_statistics():
+    """The hits, misses and evictions of the ``SamfilePool`` in current process."""
+    if _SAMFILE_POOL is None or _SAMFILE_POOL_PID != os.getpid():
+        return {"hits": 0, "misses": 0, "evictions": 0, "open_files": 0}
+
+    return _SAMFILE_POOL.statistics()
+
+
+cdef bytes _sample_name_in_header(bytes header_text):
+    """Return SM of the first @RG line in the header text, or None if there's no @RG.
+
+    It just scans the @RG lines instead of building the whole header dict.
+    """
+    cdef bytes sample = None
+    cdef int rg_num = 0
+    cdef bytes line
+    cdef int i
+    for line in header_text.split("\n"):
+        if not line.startswith("@RG\t"):
+            continue
+
+        rg_num += 1
+        if sample is None:
+            i = line.find("\tSM:")
+            sample = line[i + 4:].split("\t", 1)[0] if i >= 0 else b""
+
+    if rg_num > 1:
+        logger.debug("Found multiple read group tags in header")
+
+    return sample
+
+
+def read_sample_name(bamfile):
+    """Read the sample name of an alignment file from the SM tag of @RG.
+
+    Return (sample name, None) or (None, error message). It's picklable, so
+    the headers could be read by a pool of processes.
+    """
+    cdef Samfile bf = Samfile(bamfile)
+    try:
+        bf.open("r", False)  # we don't need the index here
+        if not bf._is_open() or bf.the_header == NULL:
+            return None, "Could not open %s or read its header." % bamfile
+
+        sample = _sample_name_in_header(bf.text)
+    except StandardError, e:
+        return None, "Error in BAM header sample parsing of %s. The error is\n%s\n" % (bamfile, e)
+    finally:
+        bf.close()
+
+    if sample is None:
+        return None, "%s: missing @RG in the header." % bamfile
+    elif not sample:
+        return None, "%s: missing SM in @RG of the header." % bamfile
+
+    return sample, None
+
+
+cdef tuple _file_stamp(basestring filename):
+    """The size and modification time of a file, a changed file gets a new stamp."""
+    st = os.stat(filename)
+    return str(st.st_size), "%.6f" % st.st_mtime
+
+
+cdef dict _load_sample_name_cache(basestring cache_file):
+    """Load the cache file: {realpath: (size, mtime, sample)}"""
+    cdef dict cache = {}
+    if not cache_file or not os.path.isfile(cache_file):
+        return cache
+
+    with open(cache_file) as I:
+        for line in I:
+            col = line.rstrip("\n").split("\t")
+            if len(col) == 4:
+                cache[col[0]] = (col[1], col[2], col[3])
+
+    return cache
+
+
+cdef void _dump_sample_name_cache(basestring cache_file, dict cache):
+    """Write the cache into a temporary file and rename it, so the cache file is never broken."""
+    tmp_file = cache_file + ".%d.tmp" % os.getpid()
+    try:
+        with open(tmp_file, "w") as OUT:
+            for path, (size, mtime, sample) in sorted(cache.items()):
+                OUT.write("\t".join([path, size, mtime, sample]) + "\n")
 
+        os.rename(tmp_file, cache_file)
+
+    except (IOError, OSError), e:
+        # The cache is just for speeding up, don't stop the program.
+        logger.warning("Could not write the sample name cache %s: %s" % (cache_file, e))
+
+    return
+
+
+cdef list get_sample_names(list bamfiles, bint filename_has_samplename, int nCPU=1, basestring cache_file=None):
+    """Getting sample name in BAM/CRMA files from RG tag and return.
+
+    The names are kept in ``cache_file`` with the size and modification time of
+    the files, only the new or changed files are read again, by ``nCPU`` processes.
+    """
     logger.info("Getting all the samples' name.")
     if filename_has_samplename:
         logger.info("getting sample name by filename because you set "
@@ -25,54 +366,97 @@ cdef list get_sample_names(list bamfiles, bint filename_has_samplename):
     cdef int file_num = len(bamfiles)
     cdef list sample_names = []
     cdef bytes filename
-    cdef dict the_header
     cdef int i = 0
-    for i in range(file_num):
-
-        if i % 1000 == 0 and i > 0:
-            logger.info("loading %d/%d alignment files ..." % (i, file_num))
-
-        if filename_has_samplename:
+    if filename_has_samplename:
+        for i in range(file_num):
             filename = os.path.basename(bamfiles[i])
 
             # sample id should be the first element separate by ".",
             # e.g: "CL100045504_L02_61.sorted.rmdup.realign.BQSR.bam", "CL100045504_L02_61" is sample id.
             sample_names.append(filename.split(".")[0])
 
-        else:
+        logger.info("Finish loading all %d samples' names\n" % file_num)
+        return sample_names
 
-            # This may take a very long time to get sampleID from BAM header if there's a lot of bamfile.
-            if not is_indexable(bamfiles[i]):
-                logger.error("Input file %s is not a BAM or CRAM file" % bamfiles[i])
-                sys.exit(1)
+    cdef dict cache = _load_sample_name_cache(cache_file)
+    cdef list paths = []
+    cdef list stamps = []
+    cdef list missing = []
+    for i in range(file_num):
+        if not is_indexable(bamfiles[i]):
+            logger.error("Input file %s is not a BAM or CRAM file" % bamfiles[i])
+            sys.exit(1)
+
+        paths.append(os.path.realpath(bamfiles[i]))
+        stamps.append(_file_stamp(bamfiles[i]))
+        if paths[i] not in cache or cache[paths[i]][:2] != stamps[i]:
+            missing.append(i)
+
+    logger.info("%d samples' name are found in the cache, %d alignment files need to be "
+                "read." % (file_num - len(missing), len(missing)))
+
+    cdef list results
+    if nCPU > 1 and len(missing) > 1:
+        # This may take a very long time to get sampleID from BAM header if there's a lot of bamfile.
+        pool = multiprocessing.Pool(processes=min(nCPU, len(missing)))
+        try:
+            results = pool.map(read_sample_name, [bamfiles[i] for i in missing],
+                               chunksize=max(1, len(missing) / (4 * nCPU)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for i in missing:
+            results.append(read_sample_name(bamfiles[i]))
+            if len(results) % 1000 == 0:
+                logger.info("loading %d/%d alignment files ..." % (len(results), len(missing)))
+
+    for i, (sample, error) in zip(missing, results):
+        if error is not None:
+            logger.error(error)
+            sys.exit(1)
+
+        cache[paths[i]] = stamps[i] + (sample,)
+
+    sample_names = [cache[path][2] for path in paths]
+    if missing and cache_file:
+        _dump_sample_name_cache(cache_file, cache)
 
-            bf = Samfile(bamfiles[i])
-            bf.open("r", True)  # load_index
+    logger.info("Finish loading all %d samples' names\n" % file_num)
+    return sample_names
 
-            try:
+cdef inline void _add_read(BamReadBuffer sample_read_buffer, cAlignedRead *the_read, bint is_compress_read,
+                          char *refseq, long int refstart, long int refend, int qual_bin_size):
+    """Add the read into buffer and compress it if ``is_compress_read``."""
+    sample_read_buffer.add_read_to_buffer(the_read)
+    if the_read == NULL:
+        return
 
-                # header info need to be calculate in bf.header function.
-                the_header = bf.header
-                if len(the_header["RG"]) > 1:
-                    logger.debug("Found multiple read group tags in file %s" % bamfiles[i])
+    READ_STATISTICS[READ_NUM] += 1
+    READ_STATISTICS[RAW_BYTES] += 2 * (the_read.r_len + 1)
+    if not is_compress_read:
+        READ_STATISTICS[STORED_BYTES] += 2 * (the_read.r_len + 1)
+        return
 
-                if "RG" not in the_header:
-                    logger.error("%s: missing @RG in the header." % bamfiles[i])
-                    bf.close()
-                    raise StandardError, ("%s: missing @RG in the header." % bamfiles[i])
+    # The read has been checked and trimmed in ``add_read_to_buffer``, compress it now.
+    compress_read(the_read, refseq, refstart, refend, qual_bin_size)
+    READ_STATISTICS[STORED_BYTES] += strlen(the_read.seq) + strlen(the_read.qual) + 2
+    return
 
-                sample_names.append(the_header['RG'][0]['SM'])
-                bf.clear_header()
 
-            except StandardError, e:
-                logger.error("Error in BAM header sample parsing. The error is\n%s\n" % e)
-                bf.close()
-                sys.exit(1)
+cdef void uncompress_sample_reads(BamReadBuffer sample_read_buffer, char *refseq, long int refstart, options):
+    """Uncompress the reads of a sample which are loaded by ``load_bamdata``, ``refseq`` and
+    ``refstart`` must be the same as ``load_bamdata``. It does nothing if we don't compress reads.
+    """
+    if not options.is_compress_read:
+        return
 
-            bf.close()
+    start_time = time.time()
+    sample_read_buffer.uncompress_reads(refseq, refstart, options.qual_bin_size)
+    READ_STATISTICS[UNCOMPRESS_SECONDS] += time.time() - start_time
+    return
 
-    logger.info("Finish loading all %d samples' names\n" % file_num)
-    return sample_names
 
 cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start, long int end,
                        char* refseq, options):
@@ -89,8 +473,13 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
     
     This function could just work for unique sample with only one BAM file. You should merge your 
     bamfiles first if there are multiple BAM files for one sample.
+
+    ``refseq`` is the reference sequence from ``start`` (0-base) to ``end`` + ``options.r_len`` at least,
+    the reads are compressed against it if ``options.is_compress_read``, then they have to be uncompressed
+    by ``uncompress_sample_reads`` before using.
     """
 
+    cdef SamfilePool samfile_pool = get_samfile_pool(options)
     cdef Samfile reader
     cdef ReadIterator reader_iter
     cdef cAlignedRead* the_read
@@ -99,6 +488,10 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
     cdef int qual_bin_size = options.qual_bin_size
     cdef int max_read_thd = options.max_reads
 
+    # [refstart, refend) of ``refseq``, it may be shorter at the end of chromosome.
+    cdef long int refstart = start
+    cdef long int refend = start + (strnlen(refseq, end - start + options.r_len) if is_compress_read else 0)
+
     cdef int total_reads = 0
     cdef int sample_num = len(samples)
     cdef BamReadBuffer sample_read_buffer
@@ -106,12 +499,15 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
     cdef list population_read_buffers = []
 
     region = "%s:%s-%s" % (chrom, start, end)
+    if options.decoder_threads > 1 and sample_num > 1:
+        return _load_bamdata_by_threads(samfile_pool, bamfiles, samples, chrom, start, end, <bytes>region,
+                                        refseq, refstart, refend, options)
+
     cdef int i
     for i in range(sample_num):
         # assuming the sample is already unique in ``samples``
 
-        reader = Samfile(bamfiles[samples[i]])
-        reader.open("r", True)
+        reader = samfile_pool.get(bamfiles[samples[i]])
 
         # set initial size for BamReadBuffer
         sample_read_buffer = BamReadBuffer(chrom, start, end, options)
@@ -130,23 +526,16 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
         while reader_iter.cnext():
 
             the_read = reader_iter.get(0, NULL)
-            # if is_compress_read:
-            #     compress_read(the_read, refseq, start, end, qual_bin_size)
-
-            sample_read_buffer.add_read_to_buffer(the_read)
+            _add_read(sample_read_buffer, the_read, is_compress_read, refseq, refstart, refend, qual_bin_size)
 
             total_reads += 1
             if total_reads > max_read_thd:
                 logger.error("Too many reads (%s) in region %s. Quitting now. Either reduce --buffer-size or "
                              "increase --max_reads." % (total_reads, region))
-
-                reader.close()
                 sys.exit(1)
 
             # Todo: we skip all the broken mate reads here, it's that necessary or we should keep them for assembler?
 
-        reader.close()
-
         # ``population_read_buffers`` will keep the same order as ``samples``,
         # which means will keep the same order as input.
         population_read_buffers.append(sample_read_buffer)
@@ -154,6 +543,97 @@ cdef list load_bamdata(dict bamfiles, list samples, bytes chrom, long int start,
     # return buffers as the same order of input samples/bamfiles
     return population_read_buffers
 
+cdef SampleRecords _sample_records(SamfilePool samfile_pool, bytes bamfile, bytes sample, bytes region,
+                                   int max_size):
+    """The ``SampleRecords`` of ``sample`` in ``region``, None if there's no data."""
+    cdef Samfile reader = samfile_pool.get(bamfile)
+    try:
+        return SampleRecords(reader.fetch(region), max_size)
+    except Exception as e:
+        logger.warning(e.message)
+        logger.warning("No data could be retrieved for sample %s in file %s in "
+                       "region %s" % (sample, reader.filename, region))
+        return None
+
+
+cdef list _load_bamdata_by_threads(SamfilePool samfile_pool, dict bamfiles, list samples, bytes chrom,
+                                   long int start, long int end, bytes region, char *refseq,
+                                   long int refstart, long int refend, options):
+    """The same as ``load_bamdata``, but the records of the samples are decompressed and decoded
+    by ``options.decoder_threads`` threads at the same time, and then they're added into
+    ``BamReadBuffer`` in the order of ``samples``.
+    """
+    cdef int thread_num = options.decoder_threads
+    cdef int max_read_thd = options.max_reads
+    cdef bint is_compress_read = options.is_compress_read
+    cdef int qual_bin_size = options.qual_bin_size
+    cdef int sample_num = len(samples)
+
+    # The samples which are fetched ahead of the current one, their files have to be kept
+    # opened in ``samfile_pool`` (a CRAM file costs 2 file descriptors).
+    cdef int lookahead = max(1, min(2 * thread_num, samfile_pool.max_open_files / 2 - 1))
+
+    jobs = get_decoder_jobs(thread_num)
+
+    cdef list sample_records_list = [None] * sample_num
+    cdef SampleRecords sample_records
+    cdef ReadIterator reader_iter
+    cdef bam1_t *b
+    cdef cAlignedRead *the_read
+    cdef BamReadBuffer sample_read_buffer
+    cdef list population_read_buffers = []
+    cdef int total_reads = 0
+    cdef int next_job = 0
+    cdef int i, j
+    for i in range(sample_num):
+
+        while next_job < sample_num and next_job <= i + lookahead:
+            sample_records = _sample_records(samfile_pool, bamfiles[samples[next_job]], samples[next_job],
+                                             region, max_read_thd)
+            if sample_records is not None:
+                sample_records_list[next_job] = sample_records
+                jobs.put(sample_records)
+
+            next_job += 1
+
+        sample_read_buffer = BamReadBuffer(chrom, start, end, options)
+        sample_read_buffer.sample = samples[i]
+
+        sample_records = sample_records_list[i]
+        if sample_records is not None:
+
+            sample_records.ready.wait()
+            if sample_records.is_error:
+                logger.error("Could not allocate memory for the reads of sample %s in region %s." % (
+                    samples[i], region))
+                sys.exit(1)
+
+            # ``ReadIterator.get()`` converts the record in ``b``
+            reader_iter = sample_records.iterator
+            b = reader_iter.b
+            for j in range(sample_records.size):
+                reader_iter.b = sample_records.records[j]
+                the_read = reader_iter.get(0, NULL)
+                _add_read(sample_read_buffer, the_read, is_compress_read, refseq, refstart, refend, qual_bin_size)
+
+                bam_destroy1(sample_records.records[j])
+                sample_records.records[j] = NULL
+
+                total_reads += 1
+                if total_reads > max_read_thd:
+                    logger.error("Too many reads (%s) in region %s. Quitting now. Either reduce --buffer-size or "
+                                 "increase --max_reads." % (total_reads, region))
+                    sys.exit(1)
+
+            reader_iter.b = b
+            sample_records_list[i] = None
+
+        # keep the same order as ``samples``
+        population_read_buffers.append(sample_read_buffer)
+
+    return population_read_buffers
+
+
 cdef bint load_data_from_bamfile(Samfile bam_reader,
                                  bytes sample_id,
                                  bytes chrom,
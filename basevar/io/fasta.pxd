@@ -10,18 +10,37 @@ cdef class FastaIndex:
     cpdef dict target_length
 
 
+cdef class SequenceTuple:
+    cdef public bytes seq_name
+    cdef public long int seq_length
+    cdef public long int start_position
+    cdef public long int line_length
+    cdef public long int full_line_length
+
+
 cdef class FastaFile:
     cdef bytes filename
     cdef object the_file
     cdef FastaIndex the_index
 
+    # The whole fasta file mapped in memory, NULL if the file is compressed.
+    cdef char *data
+    cdef size_t data_size
+
     cdef dict references
     cdef bytes cache
     cdef bytes cache_ref_name
     cdef long int cache_start_pos
     cdef long int cache_end_pos
 
+    # The newline-free caches of the recent contigs: seq_name => (start, end, sequence)
+    cdef object caches
+    cdef int max_cache_contigs
+
     cpdef void close(self)
+    cdef bint _use_cache(self, bytes seq_name, long int begin_pos, long int end_pos)
+    cdef bytes _read_sequence(self, SequenceTuple seq_tuple, long int begin_pos, long int end_pos)
     cdef bytes get_character(self, bytes seq_name, long int pos)
     cdef bytes get_sequence(self, bytes seq_name, long int begin_pos, long int end_pos)
+    cdef char *get_sequence_ptr(self, bytes seq_name, long int begin_pos, long int end_pos) except NULL
     cdef void set_cache_sequence(self, bytes seq_name, long int begin_pos, long int end_pos)
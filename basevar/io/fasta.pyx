@@ -4,6 +4,14 @@ FastaFile is a utility class used for reading the Fasta file format,
 and facilitating access to reference sequences.
 """
 import sys
+from collections import OrderedDict
+
+from libc.string cimport memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.unistd cimport close as c_close
+from posix.stat cimport struct_stat, fstat
+from posix.mman cimport mmap, munmap, PROT_READ, MAP_SHARED, MAP_FAILED
 
 from basevar.log import logger
 from basevar.io.openfile import Open
@@ -16,12 +24,6 @@ cdef extern from "stdlib.h":
 cdef class SequenceTuple:
     """Structure for storing data from line of fasta index file.
     """
-    cdef public bytes seq_name
-    cdef public long int seq_length
-    cdef public long int start_position
-    cdef public long int line_length
-    cdef public long int full_line_length
-
     def __init__(self, bytes seq_name, long int seq_length, long int start_position,
                  long int line_length, long int full_line_length):
         """Constructor
@@ -82,24 +84,63 @@ cdef class FastaIndex:
         return
 
 
+cdef inline long int _file_offset(SequenceTuple seq_tuple, long int pos):
+    """The offset in fasta file of the base at ``pos`` (0-base), by the line geometry in .fai"""
+    return seq_tuple.start_position + pos + (
+            seq_tuple.full_line_length - seq_tuple.line_length) * (pos // seq_tuple.line_length)
+
+
 cdef class FastaFile:
     """
     Utility for reading sequence from Fasta files.
+
+    An uncompressed fasta file is mapped in memory, the bases are read from the
+    mapped pages directly instead of seek and read, and the mapping is shared by
+    the forked processes. The newline-free caches of ``max_cache_contigs`` recent
+    contigs are kept, see ``set_cache_sequence``.
     """
-    def __init__(self, fastafile, indexfile, mode="rb", parseNCBI=True):
+    def __init__(self, fastafile, indexfile, mode="rb", parseNCBI=True, int max_cache_contigs=4):
         """
         Constructor. Takes file-name and index file-name
         """
         self.filename = fastafile
-        self.the_file = Open(fastafile, mode)
         self.the_index = FastaIndex(indexfile, mode=mode, is_ncbi=parseNCBI)
 
+        self.data = NULL
+        self.data_size = 0
+        cdef struct_stat st
+        cdef void *addr
+        cdef int fd = -1
+        if not self.filename.endswith((".gz", ".bgz")):
+            fd = c_open(self.filename, O_RDONLY)
+
+        if fd >= 0:
+            if fstat(fd, &st) == 0 and st.st_size > 0:
+                addr = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0)
+                if addr != MAP_FAILED:
+                    self.data = <char*>addr
+                    self.data_size = st.st_size
+
+            # The mapping is still there after the file is closed.
+            c_close(fd)
+
+        # Compressed fasta or we could not map it.
+        self.the_file = Open(fastafile, mode) if self.data == NULL else None
+
         self.references = self.the_index.references
         self.cache_ref_name = None
         self.cache_start_pos = -1
         self.cache_end_pos = -1
         self.cache = None
 
+        self.caches = OrderedDict()
+        self.max_cache_contigs = max(1, max_cache_contigs)
+
+    def __dealloc__(self):
+        if self.data != NULL:
+            munmap(self.data, self.data_size)
+            self.data = NULL
+
     def get_total_sequence_length(self):
         """
         Return the accumulated lengths of all sequences in the
@@ -118,34 +159,79 @@ cdef class FastaFile:
         """
         Wrapper function to close self.theFile
         """
-        self.the_file.close()
+        if self.data != NULL:
+            munmap(self.data, self.data_size)
+            self.data = NULL
+            self.data_size = 0
+
+        if self.the_file is not None:
+            self.the_file.close()
+
+    cdef bint _use_cache(self, bytes seq_name, long int begin_pos, long int end_pos):
+        """Return True if [begin_pos, end_pos) of ``seq_name`` is cached, and make
+        that cache be the current one.
+        """
+        if self.cache is not None and seq_name == self.cache_ref_name:
+            return self.cache_start_pos <= begin_pos and end_pos <= self.cache_end_pos
+
+        cdef tuple item = self.caches.pop(seq_name, None)
+        if item is None:
+            return False
+
+        # Move to the end as the most recently used one.
+        self.caches[seq_name] = item
+        if not (item[0] <= begin_pos and end_pos <= item[1]):
+            return False
+
+        self.cache_ref_name = seq_name
+        self.cache_start_pos, self.cache_end_pos, self.cache = item
+        return True
+
+    cdef bytes _read_sequence(self, SequenceTuple seq_tuple, long int begin_pos, long int end_pos):
+        """The newline-free sequence of [begin_pos, end_pos) in 0-base, they should
+        have been checked by the caller.
+        """
+        cdef long int file_start = _file_offset(seq_tuple, begin_pos)
+        cdef long int file_end = _file_offset(seq_tuple, end_pos)
+        if self.data == NULL:
+            self.the_file.seek(file_start)
+            return self.the_file.read(file_end - file_start).replace("\n", "")
+
+        if file_end > self.data_size:
+            raise IndexError, ("Cannot return sequence from %s to %s of %s, the fasta "
+                               "index doesn't match the file." % (begin_pos, end_pos, seq_tuple.seq_name))
+
+        # Copy line by line, the line geometry tells us where the newlines are.
+        cdef bytes seq = PyBytes_FromStringAndSize(NULL, end_pos - begin_pos)
+        cdef char *buf = PyBytes_AS_STRING(seq)
+        cdef long int pos = begin_pos
+        cdef long int n
+        while pos < end_pos:
+            n = min(seq_tuple.line_length - pos % seq_tuple.line_length, end_pos - pos)
+            memcpy(buf, self.data + _file_offset(seq_tuple, pos), n)
+            buf += n
+            pos += n
+
+        return seq
 
     cdef bytes get_character(self, bytes seq_name, long int pos):
         """
         Returns the character at the specified (0-indexed means 0-base system) position
         of the specified sequence.
         """
-        if self.cache is not None:
-            if self.cache_start_pos <= pos < self.cache_end_pos:
-                # logger.debug("Getting %s:%s-%s from cache. cache index = %s:%s" % (
-                #     seq_name, pos, pos, pos - self.cache_start_pos, pos - self.cache_start_pos))
-
-                return self.cache[pos - self.cache_start_pos]
+        if self._use_cache(seq_name, pos, pos + 1):
+            return self.cache[pos - self.cache_start_pos:pos - self.cache_start_pos + 1]
 
         cdef SequenceTuple seq_tuple = self.references[seq_name]
-        cdef long int seq_length = seq_tuple.seq_length
-        cdef long int seq_start_position = seq_tuple.start_position
-        cdef long int line_length = seq_tuple.line_length
-        cdef long int full_line_length = seq_tuple.full_line_length
-
-        if pos >= seq_length or pos < 0:
+        if pos >= seq_tuple.seq_length or pos < 0:
             # it's empty
             return <char*> ""
 
-        filepos = seq_start_position + pos + (full_line_length - line_length) * (
-            <long int>((<double>pos)/line_length))
-        self.the_file.seek(filepos)
+        cdef long int filepos = _file_offset(seq_tuple, pos)
+        if self.data != NULL:
+            return self.data[filepos:filepos+1] if filepos < self.data_size else <char*> ""
 
+        self.the_file.seek(filepos)
         try:
             return self.the_file.read(1)
         except Exception:
@@ -154,6 +240,9 @@ cdef class FastaFile:
 
     cdef void set_cache_sequence(self, bytes seq_name, long int begin_pos, long int end_pos):
         """cache a sequence in memery make the program much faster
+
+        The caches of the other contigs are kept as well, until there are more than
+        ``max_cache_contigs`` of them.
         """
         if seq_name not in self.references:
             logger.error("Invalid contig name %s. Make sure your FASTA reference file and query regions "
@@ -165,33 +254,21 @@ cdef class FastaFile:
 
         # it's 0-base system
         begin_pos = max(0, begin_pos)
-        end_pos = min(seq_length - 1, end_pos)
-
-        cdef long int seq_start_pos = seq_tuple.start_position
-        cdef long int line_length = seq_tuple.line_length
-        cdef long int full_line_length = seq_tuple.full_line_length
-        cdef long int desired_sequence_start_pos = seq_start_pos + begin_pos + (
-                full_line_length - line_length) * <long int> ((<double> begin_pos) / line_length)
-        cdef long int desired_sequence_end_pos = seq_start_pos + end_pos + (
-                full_line_length - line_length) * <long int> ((<double> end_pos) / line_length)
-
-        # 0-base
-        cdef long int desired_seq_length = (end_pos - begin_pos)
-        cdef long int desired_sequence_length_infile = (desired_sequence_end_pos - desired_sequence_start_pos)
+        end_pos = min(seq_length, end_pos)
 
         if end_pos < begin_pos:
             raise IndexError, "Cannot have beginPos = %s, endPos = %s" % (begin_pos, end_pos)
 
-        if end_pos > seq_length or begin_pos < 0:
-            raise IndexError, ("Cannot return sequence from %s to %s. Reference sequence "
-                               "length = %s" % (begin_pos, end_pos, seq_length))
-
-        self.the_file.seek(desired_sequence_start_pos)
-        self.cache = self.the_file.read(desired_sequence_length_infile).replace("\n", "")
+        self.cache = self._read_sequence(seq_tuple, begin_pos, end_pos)
         self.cache_ref_name = seq_name
         self.cache_start_pos = begin_pos
         self.cache_end_pos = end_pos
 
+        self.caches.pop(seq_name, None)
+        self.caches[seq_name] = (begin_pos, end_pos, self.cache)
+        while len(self.caches) > self.max_cache_contigs:
+            self.caches.popitem(last=False)
+
     cdef bytes get_sequence(self, bytes seq_name, long int begin_pos, long int end_pos):
         """
         Returns the character sequence between the the specified (0-indexed) start
@@ -199,11 +276,9 @@ cdef class FastaFile:
         sequence includes the character at beginPos, but not the one at endPos. This is done
         in order to make down-stream sequence handling easier.
         """
-        if self.cache is not None:
-            if begin_pos >= self.cache_start_pos and end_pos < self.cache_end_pos:
-                # logger.debug("Getting %s:%s-%s from cache. cache index = %s:%s" % (
-                #     seq_name, begin_pos, end_pos, begin_pos - self.cache_start_pos, end_pos - self.cache_start_pos))
-                return self.cache[begin_pos - self.cache_start_pos:end_pos - self.cache_start_pos]
+        # The same as reading from file, the last base of the contig is not returned.
+        if self._use_cache(seq_name, begin_pos, end_pos + 1):
+            return self.cache[begin_pos - self.cache_start_pos:end_pos - self.cache_start_pos]
 
         cdef SequenceTuple seq_tuple = self.references[seq_name]
         cdef long int seq_length = seq_tuple.seq_length
@@ -212,18 +287,6 @@ cdef class FastaFile:
         begin_pos = max(0, begin_pos)
         end_pos = min(seq_length - 1, end_pos)
 
-        cdef long int seq_start_pos = seq_tuple.start_position
-        cdef long int line_length = seq_tuple.line_length
-        cdef long int full_line_length = seq_tuple.full_line_length
-        cdef long int desired_sequence_start_pos = seq_start_pos + begin_pos + (
-                full_line_length - line_length) * <long int> ((<double> begin_pos) / line_length)
-        cdef long int desired_sequence_end_pos = seq_start_pos + end_pos + (
-                full_line_length - line_length) * <long int> ((<double> end_pos) / line_length)
-
-        # 0-base
-        cdef long int desired_seq_length = (end_pos - begin_pos)
-        cdef long int desired_sequence_length_infile = (desired_sequence_end_pos - desired_sequence_start_pos)
-
         if end_pos < begin_pos:
             raise IndexError, "Cannot have beginPos = %s, endPos = %s" % (begin_pos, end_pos)
 
@@ -231,9 +294,22 @@ cdef class FastaFile:
             raise IndexError, ("Cannot return sequence from %s to %s. Reference sequence "
                                "length = %s" % (begin_pos, end_pos, seq_length))
 
-        self.the_file.seek(desired_sequence_start_pos)
-        cdef bytes seq = self.the_file.read(desired_sequence_length_infile)
-        return seq.replace("\n", "")
+        return self._read_sequence(seq_tuple, begin_pos, end_pos)
+
+    cdef char *get_sequence_ptr(self, bytes seq_name, long int begin_pos, long int end_pos) except NULL:
+        """
+        Returns the C pointer to the newline-free sequence from ``begin_pos`` (0-base) of
+        ``seq_name``. [begin_pos, end_pos) is cached by ``set_cache_sequence`` if it's not in
+        the caches. The pointer is valid until the cache of this contig is replaced.
+        """
+        if not self._use_cache(seq_name, begin_pos, end_pos):
+            if not (0 <= begin_pos <= end_pos <= self.references[seq_name].seq_length):
+                raise IndexError, ("Cannot return sequence from %s to %s of %s. Reference sequence "
+                                   "length = %s" % (begin_pos, end_pos, seq_name,
+                                                    self.references[seq_name].seq_length))
+            self.set_cache_sequence(seq_name, begin_pos, end_pos)
+
+        return PyBytes_AS_STRING(self.cache) + (begin_pos - self.cache_start_pos)
 
     property filename:
         """The filename of the `reference` sequences file. """
@@ -177,6 +177,22 @@ cdef extern from "htslib/hfile.h" nogil:
     int hflush(hFILE *fp)
 
 
+cdef extern from "htslib/thread_pool.h" nogil:
+
+    ctypedef struct hts_tpool
+
+    # Creates a worker pool with n worker threads.
+    # @return    pool pointer on success; NULL on failure
+    hts_tpool *hts_tpool_init(int n)
+
+    # Returns the number of requested threads for a pool.
+    int hts_tpool_size(hts_tpool *p)
+
+    # Destroys a thread pool. The threads are joined into the main thread
+    # so they will finish their current work load.
+    void hts_tpool_destroy(hts_tpool *p)
+
+
 cdef extern from "htslib/bgzf.h" nogil:
 
     ctypedef struct bgzf_mtaux_t
@@ -343,6 +359,16 @@ cdef extern from "htslib/bgzf.h" nogil:
     #  @param n_sub_blks  #blocks processed by each thread; a value 64-256 is recommended
     int bgzf_mt(BGZF *fp, int n_threads, int n_sub_blks)
 
+    #  Enable multi-threading (for both reading and writing) with a shared
+    #  thread pool, the pool could be shared by many BGZF files.
+    #
+    #  @param fp          BGZF file handler
+    #  @param pool        The thread pool (see hts_tpool_init)
+    #  @param qsize       The size of the job queue. If 0 this is twice the
+    #                     number of threads in the pool.
+    #  @return            0 on success; -1 on failure
+    int bgzf_thread_pool(BGZF *fp, hts_tpool *pool, int qsize)
+
 
     # Compress a single BGZF block.
     #
@@ -952,6 +978,7 @@ cdef extern from "htslib/sam.h":
     bam_hdr_t *bam_hdr_init()
     bam_hdr_t *sam_hdr_read(samFile *fp)
     bam1_t *bam_init1()
+    bam1_t *bam_dup1(const bam1_t *bsrc) nogil
     int sam_read1(samFile *fp, bam_hdr_t *h, bam1_t *b)
     bint bam_is_rev(const bam1_t *b)
     bint bam_is_mrev(const bam1_t *b)
@@ -3,13 +3,14 @@
 """
 from warnings import warn
 from libc.errno cimport errno
-from posix.unistd cimport dup
+from libc.string cimport strcmp
+from posix.unistd cimport dup, getpid
 
 from basevar.io.libcutils cimport encode_filename
 from basevar.io.libcutils cimport force_str, charptr_to_str
 
 
-__all__ = ['HTSFile', 'Samfile', 'ReadIterator', 'destroy_read']
+__all__ = ['HTSFile', 'Samfile', 'ReadIterator', 'destroy_read', 'set_cram_reference']
 
 
 # defines imported from samtools
@@ -44,6 +45,15 @@ cdef dict VALID_HEADER_FIELDS = {
 
 
 cdef int COMPRESS_COUNT = 40
+cdef int MAX_QUAL_RUN = 127
+
+# The reference fasta for decoding all the CRAM files, see ``set_cram_reference``.
+cdef bytes _CRAM_REFERENCE = None
+# A CRAM handle of this process which holds the loaded reference (``refs_t``)
+# and the header we share the reference with.
+cdef samFile *_CRAM_REFERENCE_HOLDER = NULL
+cdef bam_hdr_t *_CRAM_REFERENCE_HEADER = NULL
+cdef int _CRAM_REFERENCE_PID = -1
 
 
 ########################################################################
@@ -473,6 +483,81 @@ cdef class HTSFile(object):
         raise NotImplementedError()
 
 
+def set_cram_reference(basestring reference_file):
+    """Decode all the CRAM files of this process by ``reference_file``.
+
+    The reference is loaded into one ``refs_t`` of htslib by the first CRAM file
+    we open, and then shared by the other CRAM files with the same contigs in
+    their header, so the reference sequence of a chromosome is loaded only once
+    instead of once for each file. The CRAM files never look up the reference by
+    M5 in ``REF_PATH`` or ``REF_CACHE`` either.
+    """
+    global _CRAM_REFERENCE
+    _release_cram_reference()
+    _CRAM_REFERENCE = <bytes>reference_file if reference_file else None
+    return
+
+
+cdef void _release_cram_reference():
+    global _CRAM_REFERENCE_HOLDER, _CRAM_REFERENCE_HEADER, _CRAM_REFERENCE_PID
+    if _CRAM_REFERENCE_HEADER != NULL:
+        bam_hdr_destroy(_CRAM_REFERENCE_HEADER)
+        _CRAM_REFERENCE_HEADER = NULL
+
+    if _CRAM_REFERENCE_HOLDER != NULL:
+        sam_close(_CRAM_REFERENCE_HOLDER)
+        _CRAM_REFERENCE_HOLDER = NULL
+
+    _CRAM_REFERENCE_PID = -1
+    return
+
+
+cdef bint _same_contigs(bam_hdr_t *h1, bam_hdr_t *h2):
+    """The reference ids of CRAM are the index of contigs in header."""
+    cdef int i = 0
+    if h1.n_targets != h2.n_targets:
+        return False
+
+    for i in range(h1.n_targets):
+        if h1.target_len[i] != h2.target_len[i] or strcmp(h1.target_name[i], h2.target_name[i]) != 0:
+            return False
+
+    return True
+
+
+cdef void _share_cram_reference(samFile *fp, bam_hdr_t *header):
+    """Let the CRAM file ``fp`` use the reference of this process."""
+    global _CRAM_REFERENCE_HOLDER, _CRAM_REFERENCE_HEADER, _CRAM_REFERENCE_PID
+    if _CRAM_REFERENCE is None:
+        return
+
+    if _CRAM_REFERENCE_PID != getpid():
+        # A forked process: the holder of parent is a copy, the file offset of the
+        # reference fasta is shared with parent, so we can't read by it.
+        _release_cram_reference()
+        _CRAM_REFERENCE_PID = getpid()
+
+    if _CRAM_REFERENCE_HOLDER == NULL:
+        _CRAM_REFERENCE_HOLDER = sam_open(fp.fn, "r")
+        if _CRAM_REFERENCE_HOLDER == NULL:
+            raise IOError("Could not open file `%s`. Check that file/path exists." % fp.fn)
+
+        if hts_set_fai_filename(<htsFile *>_CRAM_REFERENCE_HOLDER, _CRAM_REFERENCE) < 0:
+            raise IOError("Could not load the reference `%s` for CRAM file `%s`." % (_CRAM_REFERENCE, fp.fn))
+
+        _CRAM_REFERENCE_HEADER = sam_hdr_read(_CRAM_REFERENCE_HOLDER)
+
+    if _CRAM_REFERENCE_HEADER != NULL and _same_contigs(_CRAM_REFERENCE_HEADER, header):
+        if hts_set_opt(<htsFile *>fp, CRAM_OPT_SHARED_REF, cram_get_refs(<htsFile *>_CRAM_REFERENCE_HOLDER)) == 0:
+            return
+
+    # Different contigs in header, this file loads the reference by itself.
+    if hts_set_fai_filename(<htsFile *>fp, _CRAM_REFERENCE) < 0:
+        raise IOError("Could not load the reference `%s` for CRAM file `%s`." % (_CRAM_REFERENCE, fp.fn))
+
+    return
+
+
 cdef class Samfile:
     """The class for SAM/BAM/CRAM file.
 
@@ -578,6 +663,10 @@ cdef class Samfile:
         if self.samfile == NULL:
             raise IOError("Could not open file `%s`. Check that file/path exists." % self.filename)
 
+        if self._is_cram() and load_index:
+            # Only the files we fetch reads from need the reference.
+            _share_cram_reference(self.samfile, self.the_header)
+
         if self._is_bam() or self._is_cram():
             # returns NULL if there is no index or index could not be opened
             if load_index and self.index == NULL:
@@ -979,7 +1068,8 @@ cdef void compress_qual(cAlignedRead* read, int qual_bin_size):
             last_char = qual[i]
             last_count = 1
         else:
-            if qual[i] == last_char:
+            # The count is a (signed) char, never let it overflow.
+            if qual[i] == last_char and last_count < MAX_QUAL_RUN:
                 last_count += 1
             else:
                 new_qual[new_qual_index] = last_count
@@ -1072,7 +1162,9 @@ cdef void compress_read(cAlignedRead* read, char* refseq, int refstart, int refe
     if Read_IsCompressed(read):
         return
 
-    if read.seq != NULL:
+    # ``refseq`` is [refstart, refend) of the reference, the sequence of a read which is not inside it is
+    # kept as it is, ``uncompress_seq`` will get the same sequence back, because all the bases > COMPRESS_COUNT.
+    if read.seq != NULL and refstart <= read.pos and read.pos + read.r_len <= refend:
         compress_seq(read, refseq + (read.pos - refstart))
 
     if read.qual != NULL:
@@ -0,0 +1,40 @@
+"""Header for merge.pyx
+"""
+from basevar.io.htslibWrapper cimport htsFile, kstring_t
+
+cdef extern from "stdlib.h" nogil:
+    void *calloc(size_t, size_t)
+    void *realloc(void *, size_t)
+    void free(void *)
+    long int atol(const char *)
+
+cdef extern from "string.h" nogil:
+    void *memcpy(void *dest, const void *src, size_t n)
+    int memcmp(const void *s1, const void *s2, size_t n)
+    void *memchr(const void *s, int c, size_t n)
+
+
+cdef struct MergeSource:
+    htsFile *fp
+    kstring_t line  # current line, without '\n'
+    kstring_t chrom  # the chromosome of current line
+    long int rank  # the order of ``chrom``
+    long int pos
+
+
+cdef class SortedFilesMerger:
+    cdef list filenames
+    cdef dict contig_rank
+    cdef bint fixed_contigs  # True if ``contig_rank`` is from .fai, then unknown contigs are errors
+
+    cdef MergeSource *sources
+    cdef int source_num
+    cdef int *heap
+    cdef int heap_size
+
+    cdef bint _next_line(self, int index)
+    cdef void _parse_line(self, int index)
+    cdef bint _less(self, int a, int b)
+    cdef void _sift_down(self, int i)
+    cdef void _sift_up(self, int i)
+    cdef void close(self)
@@ -0,0 +1,623 @@
+# cython: profile=True
+"""
+A streaming k-way merge of the sorted text records (e.g. CVG and VCF lines).
+
+The records of each input file are in order of (chromosome, position), the first
+two columns. The lines are read by htslib (plain, gzip or bgzip files) and only
+these two columns are parsed, so the merge never splits the whole line in Python.
+
+If the BGZF files are already in order one after another (e.g. the shards of genome),
+they are concatenated block by block without decompressing, see ``concat_bgzf_files``.
+"""
+import os
+import sys
+import heapq
+import struct
+
+from basevar.log import logger
+from basevar.io.openfile import Open
+from basevar.io.BGZF.bgzf import BGZFile
+from basevar.io.writer cimport RecordWriter
+from basevar.io.htslibWrapper cimport htsFile, kstring_t, hts_open, hts_close, hts_getline
+
+
+def load_contig_order(basestring fai_file):
+    """The order of contigs in the reference index (.fai): {contig: rank}"""
+    cdef dict contig_rank = {}
+    with Open(fai_file, 'rb') as I:
+        for line in I:
+            if line.strip():
+                contig_rank[line.split("\t", 1)[0].strip()] = len(contig_rank)
+
+    return contig_rank
+
+
+cdef list _file_contigs(basestring filename):
+    """The chromosomes in ``filename`` in order, they're loaded from the tabix index if there's one."""
+    if os.path.isfile(filename + ".tbi"):
+        return list(load_tabix_index(filename + ".tbi")[1])
+
+    cdef htsFile *fp = hts_open(<bytes>filename, "r")
+    if fp == NULL:
+        raise IOError("Could not open file `%s`. Check that file/path exists." % filename)
+
+    cdef list contigs = []
+    cdef kstring_t line
+    line.l = line.m = 0
+    line.s = NULL
+
+    cdef char *tab
+    cdef size_t chrom_len
+    cdef bytes chrom = None
+    while hts_getline(fp, ord("\n"), &line) >= 0:
+        if line.l == 0 or line.s[0] == "#":
+            continue
+
+        tab = <char*>memchr(line.s, ord("\t"), line.l)
+        if tab == NULL:
+            continue
+
+        chrom_len = tab - line.s
+        if chrom is not None and <size_t>len(chrom) == chrom_len and memcmp(<char*>chrom, line.s, chrom_len) == 0:
+            continue
+
+        chrom = line.s[:chrom_len]
+        contigs.append(chrom)
+
+    free(line.s)
+    hts_close(fp)
+    return contigs
+
+
+def load_files_contig_order(list filenames):
+    """The order of chromosomes which are consistent with all the files: {contig: rank}
+
+    The chromosomes are in order of the first time we meet them if the files don't tell
+    their order, e.g. [chr1, chr2] and [chr3] are in order of chr1, chr2 and chr3, and
+    [chr1, chr3] and [chr2, chr3] are in order of chr1, chr2 and chr3.
+    """
+    cdef dict first_seen = {}
+    cdef dict next_contigs = {}
+    cdef dict in_degree = {}
+    cdef list contigs
+    for filename in filenames:
+        contigs = _file_contigs(filename)
+        for chrom in contigs:
+            if chrom not in first_seen:
+                first_seen[chrom] = len(first_seen)
+                next_contigs[chrom] = set()
+                in_degree[chrom] = 0
+
+        for a, b in zip(contigs[:-1], contigs[1:]):
+            if b not in next_contigs[a]:
+                next_contigs[a].add(b)
+                in_degree[b] += 1
+
+    cdef dict contig_rank = {}
+    cdef list heap = [(first_seen[c], c) for c, n in in_degree.items() if n == 0]
+    heapq.heapify(heap)
+    while heap:
+        _, chrom = heapq.heappop(heap)
+        contig_rank[chrom] = len(contig_rank)
+        for b in next_contigs[chrom]:
+            in_degree[b] -= 1
+            if in_degree[b] == 0:
+                heapq.heappush(heap, (first_seen[b], b))
+
+    if len(contig_rank) != len(first_seen):
+        logger.error("The chromosomes are not in the same order in the input files: %s. You must keep "
+                     "increasing order in all your input files." % ", ".join(
+                         sorted([c for c in first_seen if c not in contig_rank], key=lambda c: first_seen[c])))
+        sys.exit(1)
+
+    return contig_rank
+
+
+cdef class SortedFilesMerger:
+    """Merge the sorted files into one sorted stream.
+
+    The chromosomes are in the order of ``contig_rank``, which should be loaded from
+    the .fai of reference by ``load_contig_order``. If ``contig_rank`` is None, it's
+    built from the order of chromosomes in all the files before merging, see
+    ``load_files_contig_order``.
+    """
+    def __cinit__(self, list filenames, dict contig_rank=None):
+        self.filenames = filenames
+        self.fixed_contigs = contig_rank is not None
+        self.contig_rank = dict(contig_rank) if contig_rank is not None else load_files_contig_order(filenames)
+
+        self.source_num = len(filenames)
+        self.heap_size = 0
+        self.sources = <MergeSource*>(calloc(max(1, self.source_num), sizeof(MergeSource)))
+        self.heap = <int*>(calloc(max(1, self.source_num), sizeof(int)))
+        if self.sources == NULL or self.heap == NULL:
+            raise StandardError, "Could not allocate memory for SortedFilesMerger"
+
+        cdef int i
+        cdef bytes filename
+        for i in range(self.source_num):
+            filename = <bytes>filenames[i]
+            self.sources[i].fp = hts_open(filename, "r")
+            if self.sources[i].fp == NULL:
+                raise IOError("Could not open file `%s`. Check that file/path exists." % filename)
+
+    def __dealloc__(self):
+        self.close()
+
+    cdef void close(self):
+        cdef int i
+        if self.sources != NULL:
+            for i in range(self.source_num):
+                if self.sources[i].fp != NULL:
+                    hts_close(self.sources[i].fp)
+
+                free(self.sources[i].line.s)
+                free(self.sources[i].chrom.s)
+
+            free(self.sources)
+            self.sources = NULL
+
+        if self.heap != NULL:
+            free(self.heap)
+            self.heap = NULL
+
+        self.heap_size = 0
+        return
+
+    cdef bint _next_line(self, int index):
+        """Read the next non-empty line of source ``index``, return False at the end of file."""
+        cdef MergeSource *src = &self.sources[index]
+        cdef int ret
+        while True:
+            ret = hts_getline(src.fp, ord("\n"), &src.line)
+            if ret < -1:
+                logger.error("Error while reading %s" % self.filenames[index])
+                sys.exit(1)
+            elif ret == -1:
+                return False
+
+            if src.line.l > 0 and src.line.s[src.line.l-1] == "\r":
+                src.line.l -= 1
+                src.line.s[src.line.l] = "\0"
+
+            if src.line.l > 0:
+                return True
+
+    cdef void _parse_line(self, int index):
+        """Parse the chromosome and position of the current line of source ``index``,
+        the rank of chromosome is only looked up when the chromosome changes.
+        """
+        cdef MergeSource *src = &self.sources[index]
+        cdef char *tab = <char*>memchr(src.line.s, ord("\t"), src.line.l)
+        if tab == NULL:
+            logger.error("Could not find the position in `%s` of %s" % (src.line.s, self.filenames[index]))
+            sys.exit(1)
+
+        cdef size_t chrom_len = tab - src.line.s
+        cdef long int pos = atol(tab + 1)
+        cdef bytes chrom
+        if chrom_len != src.chrom.l or memcmp(src.line.s, src.chrom.s, chrom_len) != 0:
+            chrom = src.line.s[:chrom_len]
+            if chrom not in self.contig_rank:
+                logger.error("Chromosome %s in %s is not in the %s." % (
+                    chrom, self.filenames[index], "reference" if self.fixed_contigs else "input files"))
+                sys.exit(1)
+
+            if src.chrom.s != NULL and self.contig_rank[chrom] < src.rank:
+                logger.error("%s is behind %s in %s, which is not in the order of reference. You must keep "
+                             "increasing order in all your input files." % (chrom, src.chrom.s[:src.chrom.l],
+                                                                             self.filenames[index]))
+                sys.exit(1)
+
+            if chrom_len + 1 > src.chrom.m:
+                src.chrom.m = chrom_len + 1
+                src.chrom.s = <char*>(realloc(src.chrom.s, src.chrom.m))
+
+            memcpy(src.chrom.s, src.line.s, chrom_len)
+            src.chrom.s[chrom_len] = "\0"
+            src.chrom.l = chrom_len
+            src.rank = self.contig_rank[chrom]
+
+        elif pos < src.pos:
+            logger.error("Previous position (%d) > the following position (%d) of %s in %s. You must keep "
+                         "increasing order in all your input files." % (src.pos, pos, src.chrom.s[:src.chrom.l],
+                                                                         self.filenames[index]))
+            sys.exit(1)
+
+        src.pos = pos
+        return
+
+    cdef bint _less(self, int a, int b):
+        """Order by (chromosome, position), and the order of files for the same position."""
+        cdef MergeSource *x = &self.sources[a]
+        cdef MergeSource *y = &self.sources[b]
+        if x.rank != y.rank:
+            return x.rank < y.rank
+        if x.pos != y.pos:
+            return x.pos < y.pos
+        return a < b
+
+    cdef void _sift_down(self, int i):
+        cdef int child
+        cdef int item = self.heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= self.heap_size:
+                break
+
+            if child + 1 < self.heap_size and self._less(self.heap[child+1], self.heap[child]):
+                child += 1
+
+            if not self._less(self.heap[child], item):
+                break
+
+            self.heap[i] = self.heap[child]
+            i = child
+
+        self.heap[i] = item
+        return
+
+    cdef void _sift_up(self, int i):
+        cdef int parent
+        cdef int item = self.heap[i]
+        while i > 0:
+            parent = (i - 1) / 2
+            if not self._less(item, self.heap[parent]):
+                break
+
+            self.heap[i] = self.heap[parent]
+            i = parent
+
+        self.heap[i] = item
+        return
+
+    def merge(self, RecordWriter writer):
+        """Write the header of the first file and then all the records in order into ``writer``."""
+        cdef int i
+        cdef MergeSource *src
+        for i in range(self.source_num):
+            src = &self.sources[i]
+            while self._next_line(i):
+                if src.line.s[0] != "#":
+                    self._parse_line(i)
+                    self.heap[self.heap_size] = i
+                    self.heap_size += 1
+                    self._sift_up(self.heap_size - 1)
+                    break
+
+                # Keep the header of first file.
+                if i == 0:
+                    writer.write(src.line.s, src.line.l)
+                    writer.write_char("\n")
+
+        while self.heap_size > 0:
+            i = self.heap[0]
+            src = &self.sources[i]
+            writer.write(src.line.s, src.line.l)
+            writer.write_char("\n")
+
+            if self._next_line(i):
+                self._parse_line(i)
+            else:
+                self.heap_size -= 1
+                self.heap[0] = self.heap[self.heap_size]
+
+            if self.heap_size > 0:
+                self._sift_down(0)
+
+        writer.flush()
+        return
+
+
+# The empty BGZF block at the end of a BGZF file.
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+# The bin of meta data (offsets and counts of records) in a tabix index with 5 levels.
+TBX_META_BIN = 37450
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+cdef inline long long _shift_offset(unsigned long long voffset, long long delta):
+    """Move the compressed offset (the upper 48 bits) of a virtual offset by ``delta``."""
+    return <long long>((((voffset >> 16) + delta) << 16) | (voffset & 0xffff))
+
+
+def load_tabix_index(basestring tbi_file):
+    """Load a .tbi file: (conf, names, refs, n_no_coor).
+
+    ``conf`` is (preset, sc, bc, ec, meta_char, line_skip), ``refs`` is a list of
+    ({bin: [[chunk_begin, chunk_end], ...]}, [linear offset, ...]) for each name
+    and ``n_no_coor`` is None if it's not in the index.
+    """
+    with BGZFile(tbi_file, 'rb') as I:
+        data = I.read()
+
+    if data[:4] != b"TBI\x01":
+        raise IOError("%s is not a tabix index" % tbi_file)
+
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    conf = struct.unpack_from("<6i", data, 8)
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36+l_nm].split(b"\0")[:n_ref]
+
+    cdef long offset = 36 + l_nm
+    cdef list refs = []
+    cdef dict bins
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+            chunks = struct.unpack_from("<%dQ" % (2 * n_chunk), data, offset + 8)
+            bins[bin_id] = [list(chunks[i:i+2]) for i in range(0, 2 * n_chunk, 2)]
+            offset += 8 + 16 * n_chunk
+
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        refs.append((bins, list(struct.unpack_from("<%dQ" % n_intv, data, offset + 4))))
+        offset += 4 + 8 * n_intv
+
+    n_no_coor = struct.unpack_from("<Q", data, offset)[0] if offset + 8 <= len(data) else None
+    return conf, names, refs, n_no_coor
+
+
+def save_tabix_index(basestring tbi_file, conf, list names, list refs, n_no_coor=None):
+    """Write the index loaded by ``load_tabix_index`` into ``tbi_file``."""
+    cdef bytes l_names = b"".join([n + b"\0" for n in names])
+    cdef list data = [b"TBI\x01", struct.pack("<i", len(names)), struct.pack("<6i", *conf),
+                      struct.pack("<i", len(l_names)), l_names]
+    for bins, intervals in refs:
+        data.append(struct.pack("<i", len(bins)))
+        for bin_id in sorted(bins):
+            chunks = bins[bin_id]
+            data.append(struct.pack("<Ii", bin_id, len(chunks)))
+            data.append(struct.pack("<%dQ" % (2 * len(chunks)), *[v for c in chunks for v in c]))
+
+        data.append(struct.pack("<i", len(intervals)))
+        data.append(struct.pack("<%dQ" % len(intervals), *intervals))
+
+    if n_no_coor is not None:
+        data.append(struct.pack("<Q", n_no_coor))
+
+    with BGZFile(tbi_file, 'wb') as OUT:
+        OUT.write(b"".join(data))
+
+    return
+
+
+cdef tuple _record_position(bytes line):
+    """(chromosome, position) of a record."""
+    chrom, pos = line.split(b"\t", 2)[:2]
+    return chrom, int(pos)
+
+
+cdef class BGZFShard:
+    """The layout of a sorted BGZF file with tabix index for ``concat_bgzf_files``.
+
+    ``header_end`` and ``data_end`` are the compressed offsets of the first record
+    and the end of data (before the EOF block), ``first`` and ``last`` are the
+    (chromosome, position) of the first and the last record, they're None if there's
+    no record in the file.
+    """
+    cdef public basestring filename
+    cdef public object index  # (conf, names, refs, n_no_coor), see ``load_tabix_index``
+    cdef public long long header_end
+    cdef public long long data_end
+    cdef public tuple first
+    cdef public tuple last
+
+    def __init__(self, basestring filename):
+        self.filename = filename
+        self.index = load_tabix_index(filename + ".tbi")
+        self.first = None
+        self.last = None
+
+        cdef long long size = os.path.getsize(filename)
+        with open(filename, "rb") as I:
+            I.seek(max(0, size - len(BGZF_EOF)))
+            self.data_end = size - len(BGZF_EOF) if I.read() == BGZF_EOF else size
+
+        cdef long long voffset
+        with BGZFile(filename, 'rb') as I:
+            voffset = I.tell()
+            line = I.readline()
+            while line.startswith(b"#"):
+                voffset = I.tell()
+                line = I.readline()
+
+            self.header_end = voffset >> 16 if line.strip() else self.data_end
+            if not line.strip():
+                return
+
+            if voffset & 0xffff:
+                raise ValueError("The first record of %s is not at the beginning of a BGZF block." % filename)
+            self.first = _record_position(line)
+
+            # The last offset in the linear index of the last chromosome is in front of the last record.
+            refs = self.index[2]
+            intervals = [v for v in refs[len(refs)-1][1] if v] if refs else []
+            if not intervals:
+                raise ValueError("The tabix index of %s doesn't match the file." % filename)
+
+            last_line = line
+            I.seek(max(voffset, intervals[len(intervals)-1]))
+            for line in I:
+                if line.strip() and not line.startswith(b"#"):
+                    last_line = line
+
+            self.last = _record_position(last_line)
+
+
+cdef bint _is_shards_in_order(list shards, dict contig_rank):
+    """Check the order of the shards by the first and the last records only, the records
+    in each shard are in order already because of their tabix index.
+    """
+    cdef set seen = set()
+    cdef BGZFShard shard
+    cdef tuple prev = None
+    for shard in shards:
+        if shard.first is None:
+            continue
+
+        names = shard.index[1]
+        if contig_rank is not None:
+            if any(n not in contig_rank for n in names):
+                return False
+            if [contig_rank[n] for n in names] != sorted([contig_rank[n] for n in names]):
+                return False
+
+        if prev is not None:
+            if shard.first[0] == prev[0]:
+                if shard.first[1] < prev[1]:
+                    return False
+            elif contig_rank is not None:
+                if contig_rank[shard.first[0]] < contig_rank[prev[0]]:
+                    return False
+            elif shard.first[0] in seen:
+                return False
+
+        seen.update(names)
+        prev = shard.last
+
+    return True
+
+
+cdef void _copy_range(basestring filename, long long start, long long end, OUT):
+    with open(filename, "rb") as I:
+        I.seek(start)
+        while start < end:
+            data = I.read(min(COPY_BUFFER_SIZE, end - start))
+            if not data:
+                raise IOError("Unexpected end of file %s" % filename)
+
+            OUT.write(data)
+            start += len(data)
+
+    return
+
+
+def _merge_tabix_indexes(list shards, list deltas):
+    """Merge the tabix indexes of shards, the offsets of each shard are moved by its delta."""
+    cdef list names = []
+    cdef list refs = []
+    cdef dict tid_of = {}
+    n_no_coor = 0
+    conf = None
+
+    cdef BGZFShard shard
+    cdef long long delta
+    cdef unsigned long long data_begin
+    for shard, delta in zip(shards, deltas):
+        shard_conf, shard_names, shard_refs, shard_no_coor = shard.index
+        conf = conf or shard_conf
+        n_no_coor = None if n_no_coor is None or shard_no_coor is None else n_no_coor + shard_no_coor
+        if shard.first is None:
+            continue
+
+        # The header of shard is dropped in concatenation, so all the offsets which point into
+        # the header (the chunk of first record begins at the end of header in the same block if
+        # the header is not flushed, the empty windows in front of the records) must point to the
+        # first record, or they'll point into the data of previous shard after moving.
+        data_begin = shard.header_end << 16
+        for name, (bins, intervals) in zip(shard_names, shard_refs):
+            intervals = [_shift_offset(max(v, data_begin), delta) for v in intervals]
+            if name not in tid_of:
+                tid_of[name] = len(names)
+                names.append(name)
+                refs.append(({}, []))
+
+            merged_bins, merged_intervals = refs[tid_of[name]]
+            for bin_id, chunks in bins.items():
+                if bin_id == TBX_META_BIN:
+                    # [[offset begin, offset end], [n_mapped, n_unmapped]]
+                    meta = [[_shift_offset(max(chunks[0][0], data_begin), delta),
+                             _shift_offset(max(chunks[0][1], data_begin), delta)],
+                            list(chunks[1])]
+                    if bin_id in merged_bins:
+                        old = merged_bins[bin_id]
+                        meta = [[old[0][0], meta[0][1]], [old[1][0] + meta[1][0], old[1][1] + meta[1][1]]]
+                    merged_bins[bin_id] = meta
+                else:
+                    merged_bins.setdefault(bin_id, []).extend(
+                        [[_shift_offset(max(b, data_begin), delta), _shift_offset(max(e, data_begin), delta)]
+                         for b, e in chunks])
+
+            merged_intervals.extend(intervals[len(merged_intervals):])
+
+    return conf, names, refs, n_no_coor
+
+
+def concat_bgzf_files(list file_names, basestring final_file_name, dict contig_rank=None):
+    """Concatenate the BGZF files which are in order one after another into
+    ``final_file_name`` without decompressing, and merge their tabix indexes.
+
+    Every file must have its tabix index and the records must start at the beginning
+    of a BGZF block (see ``BGZFile.flush`` after writing the header), the header of
+    the first file is kept. Return False and write nothing if the files can't be
+    concatenated, then they should be merged by ``SortedFilesMerger``.
+    """
+    cdef list shards = []
+    try:
+        shards = [BGZFShard(f) for f in file_names]
+    except (IOError, ValueError), e:
+        logger.info("Could not concatenate the BGZF blocks directly, %s" % e)
+        return False
+
+    if not shards or not _is_shards_in_order(shards, contig_rank):
+        return False
+
+    cdef list deltas = []
+    cdef long long position = shards[0].header_end
+    cdef BGZFShard shard
+    with open(final_file_name, "wb") as OUT:
+        _copy_range(shards[0].filename, 0, shards[0].header_end, OUT)
+        for shard in shards:
+            deltas.append(position - shard.header_end)
+            if shard.first is not None:
+                _copy_range(shard.filename, shard.header_end, shard.data_end, OUT)
+                position += shard.data_end - shard.header_end
+
+        OUT.write(BGZF_EOF)
+
+    conf, names, refs, n_no_coor = _merge_tabix_indexes(shards, deltas)
+    save_tabix_index(final_file_name + ".tbi", conf, names, refs, n_no_coor)
+    return True
+
+
+def merge_sorted_files(list file_names, basestring final_file_name, basestring fai_file=None,
+                       bint is_del_raw_file=False):
+    """Merge the sorted CVG/VCF files into ``final_file_name``, the chromosomes are in
+    the order of ``fai_file`` (the index of reference), see ``SortedFilesMerger``.
+
+    ``final_file_name`` is written by BGZF with its tabix index if it ends with .gz,
+    "-" means stdout.
+    """
+    cdef dict contig_rank = load_contig_order(fai_file) if fai_file else None
+    cdef SortedFilesMerger merger
+    if final_file_name.endswith(".gz") and concat_bgzf_files(file_names, final_file_name, contig_rank):
+        logger.info("The BGZF blocks of %d files are in order, concatenate them directly." % len(file_names))
+
+    else:
+        merger = SortedFilesMerger(file_names, contig_rank)
+        if final_file_name == "-":
+            output_file = sys.stdout
+        else:
+            output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False,
+                               tabix=True)
+
+        merger.merge(RecordWriter(output_file))
+        merger.close()
+
+        if final_file_name != "-":
+            output_file.close()
+
+    if is_del_raw_file:
+        for file_name in file_names:
+            os.remove(file_name)
+            if os.path.isfile(file_name + ".tbi"):
+                os.remove(file_name + ".tbi")
+
+    logger.info("Merged %d files into %s." % (len(file_names), final_file_name))
+    return
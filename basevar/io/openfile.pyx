@@ -18,17 +18,23 @@ def _expanded_open(path, mode):
         return open(os.path.expanduser(path), mode)
 
 
-def Open(file_name, mode, compress_level=9, isbgz=True):
+def Open(file_name, mode, compress_level=9, isbgz=True, threads=None, tabix=False):
     """
     Function that allows transparent usage of dictzip, gzip and
     ordinary files
+
+    ``threads`` is the number of BGZF worker threads, see ``BGZFile``.
+    ``tabix`` builds the tabix index while writing a BGZF file, see ``BGZFile``.
     """
     if file_name.endswith(".gz") or file_name.endswith(".GZ"):
         file_dir = os.path.dirname(file_name)
         if not os.path.exists(file_dir):
             file_name = os.path.expanduser(file_name)
 
-        return BGZFile(file_name, mode) if isbgz else gzip.GzipFile(file_name, mode, compress_level)
+        if isbgz:
+            return BGZFile(file_name, mode, threads=threads, tabix=tabix)
+        else:
+            return gzip.GzipFile(file_name, mode, compress_level)
     else:
         return _expanded_open(file_name, mode)
 
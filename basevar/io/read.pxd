@@ -46,6 +46,7 @@ cdef class BamReadBuffer:
                                   long long int refend, char* refseq, int qual_bin_size)
     cdef void recompress_reads_in_current_window(self, long long int refstart, long long int refend,
                                                  char* refseq, int qual_bin_size, int compress_reads)
+    cdef void uncompress_reads(self, char* refseq, long long int refstart, int qual_bin_size)
     cdef void add_read_to_buffer(self, cAlignedRead* the_read)
     cdef int count_improper_pairs(self)
     cdef int count_alignment_gaps(self)
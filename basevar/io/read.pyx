@@ -570,6 +570,20 @@ cdef class BamReadBuffer:
                 uncompress_read(the_start[0], refseq, refstart, refend, qual_bin_size)
                 the_start += 1
 
+    cdef void uncompress_reads(self, char* refseq, long long int refstart, int qual_bin_size):
+        """Uncompress all the good reads, ``refseq`` must be the same as the one which is used
+        by compressing and it starts from ``refstart`` (0-base).
+        """
+        cdef cAlignedRead** the_start = self.reads.array
+        cdef cAlignedRead** the_end = self.reads.array + self.reads.get_size()
+        while the_start != the_end:
+            if Read_IsCompressed(the_start[0]):
+                uncompress_read(the_start[0], refseq, refstart, 0, qual_bin_size)
+
+            the_start += 1
+
+        return
+
     cdef void recompress_reads_in_current_window(self, long long int refstart, long long int refend,
                                                  char* refseq, int qual_bin_size, int is_compress_reads):
         """
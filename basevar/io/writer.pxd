@@ -0,0 +1,29 @@
+"""Header for writer.pyx
+"""
+cdef extern from "stdlib.h" nogil:
+    void *malloc(size_t)
+    void *realloc(void *, size_t)
+    void free(void *)
+
+cdef extern from "string.h" nogil:
+    void *memcpy(void *dest, const void *src, size_t n)
+    size_t strlen(const char *s)
+
+cdef extern from "stdio.h" nogil:
+    int snprintf(char *str, size_t size, const char *format, ...)
+
+
+cdef class RecordWriter:
+    cdef object handle
+    cdef char *buffer
+    cdef size_t size
+    cdef size_t capacity
+
+    cdef void _reserve(self, size_t n)
+    cdef void write(self, const char *s, size_t n)
+    cdef void write_str(self, const char *s)
+    cdef void write_bytes(self, bytes s)
+    cdef void write_char(self, char c)
+    cdef void write_int(self, long int value)
+    cdef void write_float(self, double value, int precision)
+    cdef void flush(self)
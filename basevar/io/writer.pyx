@@ -0,0 +1,112 @@
+# cython: profile=True
+"""
+A buffered writer for the text records (e.g. VCF and CVG lines).
+
+The records are formatted into a C buffer and written into the file handle in
+large blocks, instead of building and writing Python strings for each record.
+"""
+import sys
+
+from basevar.log import logger
+
+DEF DEFAULT_BLOCK_SIZE = 4194304  # 4M
+DEF NUMBER_BUFFER_SIZE = 64
+
+
+cdef class RecordWriter:
+    """Append-only output buffer of ``handle``, which could be any object with ``write()``,
+    e.g. a file object or ``BGZFile``. Call ``flush()`` before closing ``handle``.
+    """
+    def __cinit__(self, handle, size_t block_size=DEFAULT_BLOCK_SIZE):
+        self.handle = handle
+        self.size = 0
+        self.capacity = block_size
+        self.buffer = <char*>(malloc(self.capacity * sizeof(char)))
+        if self.buffer == NULL:
+            raise StandardError, "Could not allocate memory for RecordWriter"
+
+    def __dealloc__(self):
+        if self.buffer != NULL:
+            free(self.buffer)
+            self.buffer = NULL
+
+    cdef void _reserve(self, size_t n):
+        """Make sure there're ``n`` bytes free in the buffer, flush it if it's full."""
+        if self.size + n <= self.capacity:
+            return
+
+        self.flush()
+        if n > self.capacity:
+            # A record which is larger than the block
+            self.capacity = n
+            self.buffer = <char*>(realloc(self.buffer, self.capacity * sizeof(char)))
+            if self.buffer == NULL:
+                logger.error("Could not allocate memory for RecordWriter.")
+                sys.exit(1)
+
+        return
+
+    cdef void write(self, const char *s, size_t n):
+        self._reserve(n)
+        memcpy(self.buffer + self.size, s, n)
+        self.size += n
+        return
+
+    cdef void write_str(self, const char *s):
+        self.write(s, strlen(s))
+        return
+
+    cdef void write_bytes(self, bytes s):
+        self.write(s, len(s))
+        return
+
+    cdef void write_char(self, char c):
+        self._reserve(1)
+        self.buffer[self.size] = c
+        self.size += 1
+        return
+
+    cdef void write_int(self, long int value):
+        cdef char digits[NUMBER_BUFFER_SIZE]
+        cdef int n = 0
+        cdef bint negative = value < 0
+        cdef unsigned long int v = -value if negative else value
+
+        # the digits in reverse order
+        while True:
+            digits[n] = '0' + v % 10
+            n += 1
+            v /= 10
+            if v == 0:
+                break
+
+        self._reserve(n + 1)
+        if negative:
+            self.buffer[self.size] = '-'
+            self.size += 1
+
+        while n > 0:
+            n -= 1
+            self.buffer[self.size] = digits[n]
+            self.size += 1
+
+        return
+
+    cdef void write_float(self, double value, int precision):
+        """The same as ``"%.<precision>f" % value``."""
+        self._reserve(NUMBER_BUFFER_SIZE)
+        cdef int n = snprintf(self.buffer + self.size, NUMBER_BUFFER_SIZE, "%.*f", precision, value)
+        if 0 < n < NUMBER_BUFFER_SIZE:
+            self.size += n
+        else:
+            # A huge number, it should never happen.
+            self.write_bytes(b"%.*f" % (precision, value))
+
+        return
+
+    cdef void flush(self):
+        if self.size > 0:
+            self.handle.write(self.buffer[:self.size])
+            self.size = 0
+
+        return
@@ -12,6 +12,7 @@ import time
 from basevar.log import logger
 from caller.launch import BaseTypeRunner
 from basevar.utils import do_cprofile
+from basevar.io.BGZF.bgzf import set_thread_pool
 
 
 def parser_commandline_args():
@@ -57,6 +58,18 @@ def parser_commandline_args():
                               help='INT simples per batchfile. [500]')
     basetype_cmd.add_argument('--nCPU', dest='nCPU', metavar='INT', type=int, default=1,
                               help='Number of processer to use. [1]')
+    basetype_cmd.add_argument('--shard-size', dest='shard_size', metavar='INT', type=int, default=0,
+                              help='Cut the regions into shards of INT bp and let the --nCPU workers pick them up '
+                                   'one by one, instead of splitting the regions equally for each processer. '
+                                   'This balances the uneven read depth among regions. Recommend 1000000 if set. '
+                                   '[0, not use]')
+    basetype_cmd.add_argument('--work-dir', dest='work_dir', metavar='DIR', type=str, default='',
+                              help='A shared directory for running basetype on many hosts. All the workers, which '
+                                   'are launched by the same command with this option, claim the shards by lock '
+                                   'files in DIR and the last one will gather the outputs. --shard-size will be '
+                                   '1000000 if not set.')
+    basetype_cmd.add_argument('--shard-retries', dest='shard_retries', metavar='INT', type=int, default=2,
+                              help='Times of retrying a failed shard when --shard-size is set. [2]')
     basetype_cmd.add_argument('-m', '--min-af', dest='min_af', type=float, metavar='float', default=0.001,
                               help='Setting prior precision of MAF and skip uneffective caller positions. Usually '
                                    'you can set it to be min(0.001, 100/x), x is the number of your input BAM files.'
@@ -69,6 +82,10 @@ def parser_commandline_args():
                               help="If the name of bamfile is something like 'SampleID.xxxx.bam', "
                                    "you can set this parameter to save a lot of time during get the "
                                    "sample id from BAM header.")
+    basetype_cmd.add_argument('--sample-name-cache', dest='sample_name_cache', metavar='FILE', type=str,
+                              default=None, help='A file to keep the sample names of the alignment files, '
+                                                 'the files are read again only if they have been changed. '
+                                                 '[.basevar.sample_names.tsv in the directory of --output-cvg]')
 
     # special parameter for calculating specific population allele frequence
     basetype_cmd.add_argument("--max-read-length", dest="r_len", action='store', type=int, default=150,
@@ -77,8 +94,8 @@ def parser_commandline_args():
     basetype_cmd.add_argument("--max_reads", dest="max_reads", action='store', type=float, default=5000000,
                               help="Maximium coverage in window. [5000000]")
     basetype_cmd.add_argument("--compress-reads", dest="is_compress_read", type=int, default=0,
-                              help="If this is set to 1, then all reads will be compressed, and decompressd on demand. "
-                                   "This will slow things down, but reduce memory usage. [0]")
+                              help="If this is set to 1, then all reads will be compressed, and decompressed sample "
+                                   "by sample on demand. This will slow things down, but reduce memory usage. [0]")
     basetype_cmd.add_argument("--qual_bin_size", dest="qual_bin_size", type=int, action='store', default=1,
                               help="This sets the granularity used when compressing quality scores. "
                                    "If > 1 then quality compression is lossy. [1]")
@@ -100,8 +117,40 @@ def parser_commandline_args():
                               help="If set to 1, read pairs with insert sizes < one read length will be removed. [1]",
                               action='store', type=int, default=1, required=False)
 
+    basetype_cmd.add_argument('--window-size', dest='window_size', metavar='INT', type=int, default=100000,
+                              help='Number of positions which are loaded into memory at a time when creating '
+                                   'batchfiles, the peak memory is proportional to it and --batch-count. [100000]')
+    basetype_cmd.add_argument('--batch-format', dest='batch_format', choices=['binary', 'text'], default='binary',
+                              help='Format of the temporary batchfiles. The text format is much slower and '
+                                   'just for debugging. [binary]')
+    basetype_cmd.add_argument('--batch-store', dest='batch_store', metavar='DIR', type=str, default='',
+                              help='Keep the batchfiles of each block of samples in DIR after variants discovery. '
+                                   'The later runs with the same --batch-store only create batchfiles for the '
+                                   'new blocks of samples and reuse the others without reading their BAM/CRAM '
+                                   'files again. Append the new files at the end of the input list, and keep '
+                                   'the same regions (--shard-size or --nCPU) and parameters of batchfiles.')
+    basetype_cmd.add_argument('--from-batch-store', dest='from_batch_store', action='store_true',
+                              help='Run variants discovery in the regions (--regions or --positions) directly '
+                                   'from the batchfiles in --batch-store without reading the BAM/CRAM files, e.g. '
+                                   'to try another --min-af or --pop-group. The input files, --batch-count and '
+                                   'the parameters of batchfiles must be the same with the run which created them.')
+    basetype_cmd.add_argument('--pipeline-depth', dest='pipeline_depth', metavar='INT', type=int, default=1,
+                              help='Number of genome windows (5Mb) whose batchfiles could be created ahead of the '
+                                   'variants discovery in each process, it caps the disk usage of the batchfiles. '
+                                   'Set 0 to create batchfiles and discover variants one after the other. [1]')
+
     basetype_cmd.add_argument('--smart-rerun', dest='smartrerun', action='store_true',
-                              help='Rerun process by checking batchfiles.')
+                              help='Rerun process from the checkpoint journal of the finished batchfiles and genome '
+                                   'windows. The finished works are dropped automatically if the inputs or '
+                                   'parameters are changed.')
+    basetype_cmd.add_argument('--decoder-threads', dest='decoder_threads', metavar='INT', type=int, default=1,
+                              help='Number of threads in each process to decompress and decode the alignment '
+                                   'files of a batch at the same time. [1]')
+    basetype_cmd.add_argument('--max-open-files', dest='max_open_files', metavar='INT', type=int, default=0,
+                              help='Max number of file descriptors for the BAM/CRAM files which are kept opened '
+                                   'across regions in each process. 0 for half of the system limit. [0]')
+    basetype_cmd.add_argument('--bgzf-threads', dest='bgzf_threads', metavar='INT', type=int, default=0,
+                              help='Number of bgzip worker threads shared by the .gz files in each process. [0]')
 
     basetype_cmd.add_argument("--verbosity", dest="verbosity", action='store', type=int, default=1,
                               help="Level of logging(1,3). [1]")
@@ -117,6 +166,8 @@ def parser_commandline_args():
                                'must specified at least once. Required')
     vqsr_cmd.add_argument('-O', '--output', dest='output_vcf_file_name', metavar='VCF', type=str, required=True,
                           help='Output VCF file after VQSR.')
+    vqsr_cmd.add_argument('--bgzf-threads', dest='bgzf_threads', metavar='INT', type=int, default=0,
+                          help='Number of bgzip worker threads shared by the .gz files in each process. [0]')
 
     # ApplyVQSR commands
     apply_vqsr_cmd = commands.add_parser('ApplyVQSR', help='Apply a score cutoff to filter variants based '
@@ -127,6 +178,8 @@ def parser_commandline_args():
                                      'annotated with its VQSLOD. Required')
     apply_vqsr_cmd.add_argument('--ts', dest='truth_sensitivity_level', metavar='float', type=float, default=0.95,
                                 help='The truth sensitivity level at which to start filtering. default=0.95')
+    apply_vqsr_cmd.add_argument('--bgzf-threads', dest='bgzf_threads', metavar='INT', type=int, default=0,
+                                help='Number of bgzip worker threads shared by the .gz files in each process. [0]')
 
     # Merge files
     merge_cmd = commands.add_parser('merge', help='Merge bed/vcf files')
@@ -135,6 +188,11 @@ def parser_commandline_args():
     merge_cmd.add_argument('-L', '--file-list', dest='infilelist', metavar='FILE', help='Input files\' list.')
     merge_cmd.add_argument('-O', '--outputfile', dest='outputfile', metavar='FILE', required=True,
                            help='Output file')
+    merge_cmd.add_argument('-R', '--reference', dest='referencefile', metavar='Reference_fasta',
+                           help='Reference fasta file with .fai, the chromosomes are merged in its order. '
+                                'Default is the order of chromosomes in the input files.')
+    merge_cmd.add_argument('--bgzf-threads', dest='bgzf_threads', metavar='INT', type=int, default=0,
+                           help='Number of bgzip worker threads shared by the .gz files in each process. [0]')
 
     # Nearby Indel calculation
     # Add nearby indels for variants
@@ -148,6 +206,8 @@ def parser_commandline_args():
                          type=int, default=16, help='The distance around indels. [16]')
     nbi_cmd.add_argument('-O', '--outputfile', dest='outputfile', metavar='FILE', required=True,
                          help='Output file')
+    nbi_cmd.add_argument('--bgzf-threads', dest='bgzf_threads', metavar='INT', type=int, default=0,
+                         help='Number of bgzip worker threads shared by the .gz files in each process. [0]')
 
     return cmdparse.parse_args()
 
@@ -164,11 +224,9 @@ def basetype(args):
 
     if args.smartrerun:
         sys.stderr.write("************************************************\n"
-                         "******************* WARNING ********************\n"
-                         "************************************************\n"
                          ">>>>>>>> You have setted `smart rerun` <<<<<<<<<\n"
-                         "Please make sure all the parameters are the same\n"
-                         "with your previous commands.\n"
+                         "The finished works of your previous run will be\n"
+                         "reused if the inputs and parameters are the same\n"
                          "************************************************\n\n")
 
     # Make sure you have set at least one bamfile.
@@ -228,6 +286,9 @@ def main():
     args = parser_commandline_args()
     logger.info("... %s starting ...\n" % args.command)
 
+    # One pool of bgzip worker threads for all the files opened in each process.
+    set_thread_pool(args.bgzf_threads)
+
     is_success = runner[args.command](args)
     if is_success:
         logger.info('%s done, %d seconds elapsed.\n' % (
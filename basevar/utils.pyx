@@ -1,6 +1,5 @@
 import sys
 import os
-import heapq
 import time
 
 import cProfile
@@ -8,9 +7,9 @@ import pstats
 
 from basevar.log import logger
 
-from basevar.io.BGZF.tabix import tabix_index
 from basevar.io.fasta cimport FastaFile
-from basevar.io.openfile import Open, FileForQueueing
+from basevar.io.openfile import Open
+from basevar.io.merge import merge_sorted_files, concat_bgzf_files
 
 def do_cprofile(filename, is_do_profiling=False, stdout=False):
     """
@@ -209,6 +208,48 @@ cdef list generate_regions_by_process_num(list regions, int process_num, bint co
     else:
         return regions_for_each_process
 
+cdef list generate_region_shards(list regions, long int shard_size):
+    """Cut ``regions`` into many small shards, each of them is no more than ``shard_size``
+    bp and just in one chromosome. The shards are in the order of the final CVG/VCF files,
+    so the output of the shards could be concatenated together directly.
+
+    ``regions``: [[chrid1, start1, end1], [chrid2, start2, end2], ...] the chromosomes are
+                 in the order of reference (see ``load_target_position``).
+
+    return: [[[chrid, start, end], ...], ...], a list of shards.
+    """
+    cdef list shards = []
+    cdef list shard = []
+    cdef long int shard_bp = 0
+    cdef long int start, end, e
+
+    # Keep the order of chromosomes in ``regions`` and sort the positions in each of them.
+    cdef dict chrom_index = {}
+    for chrid, _, _ in regions:
+        chrom_index.setdefault(chrid, len(chrom_index))
+
+    for _, start, end, chrid in sorted([(chrom_index[r[0]], r[1], r[2], r[0]) for r in regions]):
+
+        if shard and shard[-1][0] != chrid:
+            # never put different chromosomes into one shard
+            shards.append(shard)
+            shard, shard_bp = [], 0
+
+        while start <= end:
+            e = min(end, start + shard_size - shard_bp - 1)
+            shard.append([chrid, start, e])
+            shard_bp += e - start + 1
+            start = e + 1
+
+            if shard_bp >= shard_size:
+                shards.append(shard)
+                shard, shard_bp = [], 0
+
+    if shard:
+        shards.append(shard)
+
+    return shards
+
 def fetch_next(iter_fh):
     """
     re-define the next funtion of fetching info from pysam
@@ -261,10 +302,11 @@ def load_target_position(bytes referencefile, bytes posfile, bytes region_info):
 
             _sites[chrid].append([start, end])
 
-    # sort and merge the regions
+    # sort and merge the regions, the chromosomes are in the order of reference
     # [[chrid1, start1, end1], [chrid2, start2, end2], ...]
+    contig_rank = {c: i for i, c in enumerate(fa.refnames)}
     regions = []
-    for chrid, v in sorted(_sites.items(), key=lambda x: x[0]):
+    for chrid, v in sorted(_sites.items(), key=lambda x: (contig_rank.get(x[0], len(contig_rank)), x[0])):
         for start, end in merge_region(v):
             regions.append([chrid, start, end])
 
@@ -400,16 +442,28 @@ cdef void fast_merge_files(list temp_file_names, basestring final_file_name, bin
     """Merge file which is already in order.
     We don't have to sort anything, just cat them together!
     """
+    cdef int index = 0
+    cdef int total_file_num = len(temp_file_names)
+    cdef basestring file_name
+    cdef dict check_position_in_order = {}
+
+    if final_file_name.endswith(".gz") and concat_bgzf_files(temp_file_names, final_file_name):
+        logger.info("Fast merge %d files by concatenating their BGZF blocks." % len(temp_file_names))
+        if is_del_raw_file:
+            for file_name in temp_file_names:
+                os.remove(file_name)
+                if os.path.isfile(file_name + ".tbi"):
+                    os.remove(file_name + ".tbi")
+
+        return
+
     # Final output file
     if final_file_name == "-":
         output_file = sys.stdout
     else:
-        output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False)
+        output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False,
+                           tabix=True)
 
-    cdef int index = 0
-    cdef int total_file_num = len(temp_file_names)
-    cdef basestring file_name
-    cdef dict check_position_in_order = {}
     for index, file_name in enumerate(temp_file_names):
 
         the_file = Open(file_name, 'rb')
@@ -441,61 +495,11 @@ cdef void fast_merge_files(list temp_file_names, basestring final_file_name, bin
             the_file.close()
             if is_del_raw_file:
                 os.remove(file_name)
+                if os.path.isfile(file_name + ".tbi"):
+                    os.remove(file_name + ".tbi")
 
         logger.info("Fast merge process %d/%d done." % (index+1, total_file_num))
 
-    return
-
-def merge_files(temp_file_names, final_file_name, is_del_raw_file=False):
-    """
-    Merging output VCF/CVG files into a final big one
-    """
-    # Final output file
-    if final_file_name == "-":
-        output_file = sys.stdout
-    else:
-        output_file = Open(final_file_name, 'wb', isbgz=True if final_file_name.endswith(".gz") else False)
-
-    the_heap = []
-
-    # Initialise queue
-    for index, file_name in enumerate(temp_file_names):
-        the_file = Open(file_name, 'rb')
-
-        for line in the_file:
-
-            # End of this file
-            if line[0] == "#":
-                if index == 0:
-                    output_file.write(line.strip() + "\n")
-            else:
-                the_file_for_queueing = FileForQueueing(the_file, line.strip() + "\n", is_del_raw_file=is_del_raw_file)
-                heapq.heappush(the_heap, the_file_for_queueing)
-                break
-
-        # If there are no calls in the temp file, we still want to
-        # remove it.
-        else:
-            the_file.close()
-
-            if is_del_raw_file:
-                os.remove(file_name)
-
-    # Merge-sort the output using a priority queue
-    while len(the_heap) != 0:
-
-        # Get file from heap in right order
-        next_file = heapq.heappop(the_heap)
-        output_file.write(next_file.line.strip() + "\n")
-
-        # Put file back on heap
-        try:
-            next_file.next()
-            heapq.heappush(the_heap, next_file)
-        except StopIteration:
-            continue
-
-    # Close final output file
     if final_file_name != "-":
         output_file.close()
 
@@ -644,23 +648,19 @@ def load_popgroup_info(samples, in_popgroup_file):
 
     return popgroup
 
-def output_cvg_and_vcf(sub_cvg_files, sub_vcf_files, outcvg, outvcf=None):
+def output_cvg_and_vcf(sub_cvg_files, sub_vcf_files, outcvg, outvcf=None, reference_file=None):
     """CVG file and VCF file could use the same tabix strategy."""
     for out_final_file, sub_file_list in zip([outcvg, outvcf], [sub_cvg_files, sub_vcf_files]):
 
         if out_final_file:
-            output_file(sub_file_list, out_final_file, del_raw_file=True)
+            output_file(sub_file_list, out_final_file, del_raw_file=True, reference_file=reference_file)
 
     return
 
-def output_file(sub_files, out_file_name, del_raw_file=False):
-    if out_file_name.endswith(".gz"):
-        merge_files(sub_files, out_file_name, is_del_raw_file=del_raw_file)
-
-        # Column indices are 0-based. Note: this is different from the tabix command line
-        # utility where column indices start at 1.
-        tabix_index(out_file_name, force=True, seq_col=0, start_col=1, end_col=1)
-    else:
-        merge_files(sub_files, out_file_name, is_del_raw_file=del_raw_file)
-
+def output_file(sub_files, out_file_name, del_raw_file=False, reference_file=None):
+    """Merge the sorted ``sub_files``, the chromosomes are in the order of ``reference_file``
+    if it's provided. The tabix index of a .gz file is built while it's written.
+    """
+    merge_sorted_files(sub_files, out_file_name, fai_file=reference_file + ".fai" if reference_file else None,
+                       is_del_raw_file=del_raw_file)
     return
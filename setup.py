@@ -66,11 +66,17 @@ MOD_NAMES = [
     CALLER_PRE + '.io.fasta',
     CALLER_PRE + '.io.bam',
     CALLER_PRE + '.io.read',
+    CALLER_PRE + '.io.writer',
     CALLER_PRE + '.caller.basetype',
     CALLER_PRE + '.caller.batch',
+    CALLER_PRE + '.caller.batchfile',
+    CALLER_PRE + '.caller.popgroup',
     CALLER_PRE + '.caller.batchcaller',
     CALLER_PRE + '.caller.variantcaller',
+    CALLER_PRE + '.caller.coverage',
+    CALLER_PRE + '.caller.journal',
     CALLER_PRE + '.caller.basetypeprocess',
+    CALLER_PRE + '.caller.scatter',
     CALLER_PRE + '.caller.launch',
     CALLER_PRE + '.caller.do',
 
@@ -96,6 +102,7 @@ if __name__ == "__main__":
         CALLER_PRE + '.io.htslibWrapper',
         CALLER_PRE + '.io.BGZF.bgzf',
         CALLER_PRE + '.io.BGZF.tabix',
+        CALLER_PRE + '.io.merge',
     ]
     extensions = [Extension(name=mod, sources=[mod.replace('.', os.path.sep) + '.pyx'], language='c',
                             include_dirs=[TB_INCLUDE_DIR], libraries=['hts']) for mod in htslib_mod]
@@ -0,0 +1,247 @@
+"""Test variants discovery of basetype
+"""
+import os
+import sys
+import gzip
+import math
+import shutil
+import tempfile
+import subprocess
+
+reference = "./data/hg19.NC_012920.fasta"
+bamfile_list = "./data/140k_thalassemia_brca_bam/bam90.list"
+base_dir = "./data/140k_thalassemia_brca_bam"
+regions = "chr11:5246595-5248428,chr17:41197764-41276135"
+
+
+def _basetype(out_dir, *options):
+    """Run ``basevar basetype`` for the BAM files in ``bamfile_list``, return the lines of (CVG, VCF)."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    out_cvg = os.path.join(out_dir, "test.cvg.gz")
+    out_vcf = os.path.join(out_dir, "test.vcf.gz")
+    cmd = [sys.executable, "-c", "from basevar.runner import main; main()", "basetype", "-R", reference,
+           "--output-cvg", out_cvg, "--output-vcf", out_vcf, "--batch-count", "20"]
+
+    with open(bamfile_list) as I:
+        for line in I:
+            cmd += ["-I", os.path.join(base_dir, line.strip())]
+
+    if "--regions" not in options:
+        cmd += ["--regions", regions]
+
+    subprocess.check_call(cmd + list(options))
+
+    outputs = []
+    for file_name in [out_cvg, out_vcf]:
+        with gzip.open(file_name, "rb") as I:
+            outputs.append([line for line in I.read().split(b"\n") if line and not line.startswith(b"##")])
+
+    return outputs
+
+
+def test_batch_format(tmp_dir):
+    """The binary batchfiles must get the same results as the text ones."""
+    cvg, vcf = _basetype(os.path.join(tmp_dir, "binary"), "--batch-format", "binary")
+    text_cvg, text_vcf = _basetype(os.path.join(tmp_dir, "text"), "--batch-format", "text")
+
+    assert len(cvg) > 1 and len(vcf) > 1
+    assert cvg == text_cvg
+    assert vcf == text_vcf
+
+
+def _qual_of_bp():
+    """Map the BP field of VCF back to base quality, the BP which is shared by several
+    qualities is mapped to None.
+    """
+    quals = {}
+    for q in range(256):
+        bp = str(round(1.0 - 10 ** (-q / 10.0), 6))
+        quals[bp] = None if bp in quals else q
+
+    return quals
+
+
+def _em(bases, ind_likelihood, depth):
+    """The EM of allele frequencies for ``bases`` over each individual, the same as em() in em.c."""
+    total_depth = float(sum(depth.values()))
+    freq = {b: depth[b] / total_depth if b in bases else 0.0 for b in "ACGT"}
+
+    def step(freq):
+        marginal, expect = [], {b: 0.0 for b in "ACGT"}
+        for lh in ind_likelihood:
+            m = sum(freq[b] * lh[b] for b in "ACGT")
+            marginal.append(m)
+            for b in "ACGT":
+                expect[b] += freq[b] * lh[b] / m
+
+        return marginal, {b: expect[b] / len(ind_likelihood) for b in "ACGT"}
+
+    marginal, expect = step(freq)
+    for _ in range(100):
+        new_marginal, expect = step(expect)
+        delta = sum(abs(math.log(a) - math.log(b)) for a, b in zip(new_marginal, marginal))
+        marginal = new_marginal
+        if delta < 0.001:
+            break
+
+    return expect
+
+
+def test_weighted_em(tmp_dir):
+    """CM_AF by the EM over (base, quality) classes must be the same as the EM over each individual."""
+    _, vcf = _basetype(tmp_dir)
+    qual_of_bp = _qual_of_bp()
+
+    checked = 0
+    for line in vcf:
+        if line.startswith(b"#"):
+            continue
+
+        col = line.decode().split("\t")
+        ref, alts = col[3].upper(), col[4].split(",")
+        cm_af = [float(af) for af in dict(kv.split("=") for kv in col[7].split(";"))["CM_AF"].split(",")]
+
+        ind_likelihood, depth = [], {b: 0 for b in "ACGT"}
+        for sample in col[9:]:
+            if sample == "./.":
+                continue
+
+            _, base, _, bp = sample.split(":")
+            q = qual_of_bp[bp]
+            if q is None:
+                break
+
+            p = 1.0 - 10 ** (-q / 10.0)
+            ind_likelihood.append({b: p if b == base else (1.0 - p) / 3 for b in "ACGT"})
+            if base in depth:
+                depth[base] += 1
+        else:
+            # The final bases of LRT are ALT or ALT and REF
+            for bases in [alts, alts + [ref]]:
+                freq = _em(bases, ind_likelihood, depth)
+                if all(abs(freq[b] - af) < 1e-5 for b, af in zip(alts, cm_af)):
+                    break
+            else:
+                assert False, "CM_AF=%s is not the EM result in %s:%s" % (cm_af, col[0], col[1])
+
+            checked += 1
+
+    assert checked > 0
+
+
+def _ranksum(ref_values, alt_values):
+    """Phred scale p-value of Mann-Whitney-Wilcoxon Rank Sum Test, None if one of them is empty."""
+    n1, n2 = len(ref_values), len(alt_values)
+    if n1 == 0 or n2 == 0:
+        return None
+
+    # Average rank for the ties
+    values = sorted(ref_values + alt_values)
+    rank = {}
+    for i, v in enumerate(values):
+        rank.setdefault(v, []).append(i + 1)
+
+    r1 = sum(sum(rank[v]) / float(len(rank[v])) for v in ref_values)
+    z = (r1 - n1 * (n1 + n2 + 1) / 2.0) / math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    pvalue = math.erfc(abs(z) / math.sqrt(2))
+    if pvalue == 1.0:
+        return 0.0
+
+    return -10 * math.log10(pvalue) if pvalue > 0 else 10000.0
+
+
+def test_rank_sum(tmp_dir):
+    """BaseQRankSum from the histograms of base quality must be the same as the rank sum
+    test of the base quality of each REF and ALT individual.
+    """
+    _, vcf = _basetype(tmp_dir)
+    qual_of_bp = _qual_of_bp()
+
+    checked = 0
+    for line in vcf:
+        if line.startswith(b"#"):
+            continue
+
+        col = line.decode().split("\t")
+        ref, alts = col[3].upper(), col[4].split(",")
+        base_q_rank_sum = dict(kv.split("=") for kv in col[7].split(";"))["BaseQRankSum"]
+
+        ref_quals, alt_quals = [], []
+        for sample in col[9:]:
+            if sample == "./.":
+                continue
+
+            _, base, _, bp = sample.split(":")
+            if base != ref and base not in alts:
+                continue
+
+            q = qual_of_bp[bp]
+            if q is None:
+                break
+
+            if base == ref:
+                ref_quals.append(q)
+            else:
+                alt_quals.append(q)
+        else:
+            expect = _ranksum(ref_quals, alt_quals)
+            if expect is None:
+                assert base_q_rank_sum == "nan"
+            else:
+                assert abs(float(base_q_rank_sum) - expect) < 1e-3, "BaseQRankSum=%s, expect %.3f in %s:%s" % (
+                    base_q_rank_sum, expect, col[0], col[1])
+
+            checked += 1
+
+    assert checked > 0
+
+
+def _in_regions(lines, regions):
+    """Keep the header and the records of ``lines`` which are in ``regions``."""
+    kept = []
+    for line in lines:
+        if line.startswith(b"#"):
+            kept.append(line)
+            continue
+
+        col = line.split(b"\t")
+        for chrom, start, end in regions:
+            if col[0] == chrom and start <= int(col[1]) <= end:
+                kept.append(line)
+                break
+
+    return kept
+
+
+def test_batch_store(tmp_dir):
+    """Rerunning in some sub-regions from the batch store must get the same records as the
+    first run from the BAM files in these sub-regions.
+    """
+    batch_store = os.path.join(tmp_dir, "batch_store")
+    os.makedirs(batch_store)
+    cvg, vcf = _basetype(os.path.join(tmp_dir, "bam"), "--batch-store", batch_store)
+
+    sub_regions = [(b"chr11", 5247000, 5247500), (b"chr17", 41200001, 41210000)]
+    store_cvg, store_vcf = _basetype(os.path.join(tmp_dir, "store"), "--batch-store", batch_store,
+                                     "--from-batch-store", "--regions",
+                                     ",".join("%s:%d-%d" % (c.decode(), s, e) for c, s, e in sub_regions))
+
+    assert len(store_cvg) > 1
+    assert store_cvg == _in_regions(cvg, sub_regions)
+    assert store_vcf == _in_regions(vcf, sub_regions)
+
+
+if __name__ == "__main__":
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        test_batch_format(tmp_dir)
+        test_batch_store(tmp_dir)
+        test_weighted_em(os.path.join(tmp_dir, "em"))
+        test_rank_sum(os.path.join(tmp_dir, "ranksum"))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print("Done")
@@ -0,0 +1,85 @@
+"""Test the shard scheduler
+"""
+import os
+import time
+import signal
+import shutil
+import tempfile
+
+from basevar.caller.do import shard_runner
+
+
+class _Shard(object):
+    """A shard job which writes its marker file, but it dies or fails on the first ``bad_runs``
+    attempts in the way of ``mode``.
+    """
+
+    def __init__(self, marker_file, mode=None, bad_runs=1):
+        self.marker_file = marker_file
+        self.mode = mode
+        self.bad_runs = bad_runs
+
+    def run(self):
+        with open(self.marker_file + ".attempts", "a") as OUT:
+            OUT.write("%d\n" % os.getpid())
+
+        if self.mode and _attempts(self.marker_file) <= self.bad_runs:
+            if self.mode == "killed":
+                # Killed just after it gets the shard
+                os.kill(os.getpid(), signal.SIGKILL)
+
+            elif self.mode == "killed_in_shard":
+                time.sleep(1)
+                os.kill(os.getpid(), signal.SIGKILL)
+
+            elif self.mode == "exit":
+                os._exit(1)
+
+            else:
+                raise ValueError("shard fail")
+
+        with open(self.marker_file, "w") as OUT:
+            OUT.write("done\n")
+
+
+def _attempts(marker_file):
+    with open(marker_file + ".attempts") as I:
+        return len(I.read().split())
+
+
+def _shard_jobs(tmp_dir, modes):
+    return [(i, (os.path.join(tmp_dir, "shard%d.done" % i),) + mode, {}, os.path.join(tmp_dir, "shard%d.done" % i))
+            for i, mode in enumerate(modes)]
+
+
+def test_retry_killed_workers(tmp_dir):
+    """The shards of the killed or failed workers must be retried and the run terminates."""
+    modes = [(), ("killed",), ("killed_in_shard",), (), ("exit",), ("fail",), ("killed",), ()]
+    shard_jobs = _shard_jobs(tmp_dir, modes)
+
+    assert shard_runner(_Shard, shard_jobs, 3, max_retries=2) == []
+    for (_, _, _, marker_file), mode in zip(shard_jobs, modes):
+        assert os.path.exists(marker_file)
+        assert _attempts(marker_file) == (2 if mode else 1)
+
+
+def test_failed_shards(tmp_dir):
+    """The shard which is still killed after ``max_retries`` is reported."""
+    modes = [(), ("killed", 10), ("killed_in_shard", 2), ()]
+    shard_jobs = _shard_jobs(tmp_dir, modes)
+
+    assert shard_runner(_Shard, shard_jobs, 2, max_retries=1) == [1, 2]
+    assert [_attempts(marker_file) for _, _, _, marker_file in shard_jobs] == [1, 2, 2, 1]
+    assert [os.path.exists(marker_file) for _, _, _, marker_file in shard_jobs] == [True, False, False, True]
+
+
+if __name__ == "__main__":
+
+    for test in [test_retry_killed_workers, test_failed_shards]:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            test(tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    print("Done")
@@ -0,0 +1,80 @@
+"""Test the checkpoint journal of --smart-rerun
+"""
+import os
+import shutil
+import tempfile
+from argparse import Namespace
+
+from basevar.caller.journal import CheckpointJournal, parameter_fingerprint
+
+
+def _write(file_name, data):
+    with open(file_name, "w") as OUT:
+        OUT.write(data)
+
+
+def test_journal(cache_dir):
+    fingerprint = "fingerprint-1"
+    batchfile = os.path.join(cache_dir, "chr1.batch")
+    window_file = os.path.join(cache_dir, "chr1.window1.cvg.gz")
+    _write(batchfile, "batch data")
+    _write(window_file, "window data")
+
+    journal = CheckpointJournal(cache_dir, fingerprint)
+    assert not journal.is_done("batch", "chr1", [batchfile])
+    journal.done("batch", "chr1", [batchfile])
+    journal.done("window", "chr1:1", [window_file], "empty")
+
+    # Resume in a new run, a broken line by the crash is ignored
+    with open(journal.file_name, "a") as OUT:
+        OUT.write("window\tchr1:2\t\t%s\t12" % window_file)
+
+    journal = CheckpointJournal(cache_dir, fingerprint)
+    assert journal.is_done("batch", "chr1", [batchfile])
+    assert journal.is_done("window", "chr1:1", [window_file])
+    assert journal.value("window", "chr1:1") == "empty" and journal.value("batch", "chr1") == ""
+    assert not journal.is_done("window", "chr1:2", [window_file])
+    assert journal.value("window", "chr1:2") is None
+    assert not journal.is_done("batch", "chr1", [batchfile, window_file])
+
+    # The records after the broken line are not lost
+    journal.done("window", "chr1:2", [window_file])
+    assert CheckpointJournal(cache_dir, fingerprint).is_done("window", "chr1:2", [window_file])
+
+    # The output is changed
+    _write(batchfile, "batch DATA")
+    assert not CheckpointJournal(cache_dir, fingerprint).is_done("batch", "chr1", [batchfile])
+
+    # All the works are dropped if the parameters are changed
+    journal = CheckpointJournal(cache_dir, "fingerprint-2")
+    assert not journal.is_done("window", "chr1:1", [window_file])
+    assert not os.path.exists(batchfile) and not os.path.exists(window_file)
+
+    journal.remove()
+    assert not os.path.exists(journal.file_name)
+
+
+def test_parameter_fingerprint():
+    options = Namespace(mapq=10, min_af=0.001, nCPU=4, smartrerun=True)
+    fingerprint = parameter_fingerprint(["s1", "s2"], ["s1.bam", "s2.bam"], "ref.fa", [("chr1", 1, 100)], options)
+
+    # The runtime options don't change the results
+    options.nCPU = 8
+    assert parameter_fingerprint(["s1", "s2"], ["s1.bam", "s2.bam"], "ref.fa", [("chr1", 1, 100)],
+                                 options) == fingerprint
+
+    options.mapq = 20
+    assert parameter_fingerprint(["s1", "s2"], ["s1.bam", "s2.bam"], "ref.fa", [("chr1", 1, 100)],
+                                 options) != fingerprint
+
+
+if __name__ == "__main__":
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        test_journal(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+
+    test_parameter_fingerprint()
+    print("Done")
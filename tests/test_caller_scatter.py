@@ -0,0 +1,145 @@
+"""Test the shards and the gathering shared by several workers in a work directory
+"""
+import os
+import gzip
+import time
+import socket
+import shutil
+import tempfile
+import multiprocessing
+
+from basevar.io.BGZF.bgzf import BGZFile
+from basevar.caller.scatter import ShardQueue
+
+SAMPLE_NUM = 10
+SHARDS = [[["chr1", i * 1000 + 1, (i + 1) * 1000]] for i in range(12)]
+
+
+def _run_workers(target, args, worker_num=4):
+    workers = [multiprocessing.Process(target=target, args=args) for _ in range(worker_num)]
+    for w in workers:
+        w.start()
+
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+
+
+def _claim_shards(work_dir, claims_file):
+    shard_queue = ShardQueue(work_dir, SHARDS, SAMPLE_NUM)
+    while True:
+        shard_index = shard_queue.claim(2)
+        if shard_index is None:
+            break
+
+        with open(claims_file, "a") as OUT:
+            OUT.write("%d %d\n" % (shard_index, os.getpid()))
+
+        time.sleep(0.05)
+        shard_queue.mark_done(shard_index)
+
+
+def _dead_pid():
+    p = multiprocessing.Process(target=time.sleep, args=(0,))
+    p.start()
+    p.join()
+    return p.pid
+
+
+def _write_lock(lock_file, pid):
+    with open(lock_file, "w") as OUT:
+        OUT.write("%s %d\n" % (socket.gethostname(), pid))
+
+
+def test_claim(work_dir):
+    """Each shard is claimed by only one of the workers."""
+    claims_file = os.path.join(work_dir, "claims.txt")
+    _run_workers(_claim_shards, (work_dir, claims_file))
+
+    with open(claims_file) as I:
+        claims = [int(line.split()[0]) for line in I]
+
+    assert sorted(claims) == list(range(len(SHARDS)))
+
+    shard_queue = ShardQueue(work_dir, SHARDS, SAMPLE_NUM)
+    assert shard_queue.pending_shards(2) == [] and shard_queue.claim(2) is None
+
+
+def test_stale_lock(work_dir):
+    """The lock of a dead worker is released and counted as a failure, the one of a live worker is kept."""
+    shard_queue = ShardQueue(work_dir, SHARDS, SAMPLE_NUM)
+    _write_lock(shard_queue.shard_file(0, "lock"), _dead_pid())
+    _write_lock(shard_queue.shard_file(1, "lock"), os.getpid())
+
+    assert shard_queue.claim(2) == 0
+    assert shard_queue.failed_times(0) == 1
+    shard_queue.mark_done(0)
+
+    assert shard_queue.claim(2) == 2
+    assert shard_queue.failed_times(1) == 0
+
+    # The gathering left by a dead worker
+    gather_lock = os.path.join(work_dir, "gather.lock")
+    _write_lock(gather_lock, _dead_pid())
+    _write_shards(shard_queue)
+    assert shard_queue.gather(os.path.join(work_dir, "test.cvg.gz"))
+    assert not os.path.exists(gather_lock)
+
+
+def _write_shards(shard_queue):
+    for i, shard in enumerate(SHARDS):
+        with BGZFile(shard_queue.shard_file(i, "cvg.gz"), "wb", tabix=True) as OUT:
+            OUT.write(b"#CHROM\tPOS\n")
+            OUT.flush()  # The records start at a new block, so that they could be concatenated
+            for chrom, start, end in shard:
+                for pos in range(start, end + 1, 10):
+                    OUT.write(b"%s\t%d\n" % (chrom.encode(), pos))
+
+
+def _gather(work_dir, outcvg, start, results):
+    shard_queue = ShardQueue(work_dir, SHARDS, SAMPLE_NUM)
+    start.wait()
+    results.put(shard_queue.gather(outcvg))
+
+
+def test_gather(work_dir):
+    """Only one of the workers gathers the shards, and no ``gather.lock`` is left."""
+    _write_shards(ShardQueue(work_dir, SHARDS, SAMPLE_NUM))
+
+    outcvg = os.path.join(work_dir, "test.cvg.gz")
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_gather, args=(work_dir, outcvg, start, results)) for _ in range(4)]
+    for w in workers:
+        w.start()
+
+    start.set()
+    gathered = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+
+    assert sorted(gathered) == [False, False, False, True]
+    assert os.path.exists(os.path.join(work_dir, "gather.done"))
+    assert not os.path.exists(os.path.join(work_dir, "gather.lock"))
+
+    with gzip.open(outcvg, "rb") as I:
+        lines = I.read().split(b"\n")
+
+    assert lines[0] == b"#CHROM\tPOS"
+    assert [int(line.split(b"\t")[1]) for line in lines[1:] if line] == [
+        pos for shard in SHARDS for _, s, e in shard for pos in range(s, e + 1, 10)]
+
+    # Nothing to do after it's done.
+    assert not ShardQueue(work_dir, SHARDS, SAMPLE_NUM).gather(outcvg)
+
+
+if __name__ == "__main__":
+
+    for test in [test_claim, test_stale_lock, test_gather]:
+        work_dir = tempfile.mkdtemp()
+        try:
+            test(work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+    print("Done")
@@ -0,0 +1,58 @@
+"""Test BGZFile
+"""
+import os
+import shutil
+import tempfile
+
+from basevar.io.BGZF.bgzf import BGZFile, set_thread_pool
+from basevar.io.BGZF.tabix import tabix_index, TabixFile
+from basevar.io.merge import load_tabix_index
+
+
+def _write_records(file_name, is_flush_header, threads=None):
+    with BGZFile(file_name, "wb", threads=threads, tabix=True) as OUT:
+        OUT.write(b"##fileformat=VCFv4.2\n#CHROM\tPOS\tINFO\n")
+        if is_flush_header:
+            OUT.flush()
+
+        for chrom, step in [(b"chr1", 7), (b"chr2", 131), (b"chr10", 3)]:
+            for pos in range(1, 300000, step):
+                OUT.write(b"%s\t%d\tDP=%d\n" % (chrom, pos, pos % 53))
+
+
+def test_index_on_write(tmp_dir):
+    """The tabix index built while writing must be the same as the one by ``tabix_index``."""
+    for is_flush_header in [False, True]:
+        file_name = os.path.join(tmp_dir, "test.%d.vcf.gz" % is_flush_header)
+        _write_records(file_name, is_flush_header)
+
+        tabix_index(file_name, force=True, seq_col=0, start_col=1, end_col=1, index=file_name + ".rebuild.tbi")
+        assert load_tabix_index(file_name + ".tbi") == load_tabix_index(file_name + ".rebuild.tbi")
+
+
+def test_index_with_threads(tmp_dir):
+    """The file compressed by the worker threads must get its tabix index too."""
+    set_thread_pool(4)
+    try:
+        for threads in [None, 4]:
+            file_name = os.path.join(tmp_dir, "test.threads%s.vcf.gz" % threads)
+            _write_records(file_name, False, threads=threads)
+
+            tbx = TabixFile(file_name)
+            assert len(list(tbx.fetch(b"chr2"))) == len(range(1, 300000, 131))
+            assert [line.split("\t")[1] for line in tbx.fetch(b"chr10", 100, 110)] == ["103", "106", "109"]
+            tbx.close()
+    finally:
+        set_thread_pool(0)
+
+
+if __name__ == "__main__":
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        test_index_on_write(tmp_dir)
+        test_index_with_threads(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print("Done")
@@ -0,0 +1,93 @@
+"""Test merging the sorted files
+"""
+import os
+import shutil
+import tempfile
+
+from basevar.io.BGZF.bgzf import BGZFile
+from basevar.io.BGZF.tabix import TabixFile
+from basevar.io.merge import concat_bgzf_files, merge_sorted_files
+
+HEADER = b"##fileformat=VCFv4.2\n#CHROM\tPOS\tINFO\n"
+
+
+def _write_shard(file_name, records):
+    with BGZFile(file_name, "wb", tabix=True) as OUT:
+        OUT.write(HEADER)
+        # The header must be in its own blocks, see ``concat_bgzf_files``
+        OUT.flush()
+        for chrom, pos in records:
+            OUT.write(b"%s\t%d\tDP=%d\n" % (chrom, pos, pos % 97))
+
+
+def test_concat_bgzf_files(tmp_dir):
+    shards = [[(b"chr1", p) for p in range(100, 60000, 7)],
+              [(b"chr1", p) for p in range(60000, 90000, 11)] + [(b"chr2", p) for p in range(1, 30000, 5)],
+              [],
+              [(b"chr2", p) for p in range(30001, 50000, 3)] + [(b"chrX", p) for p in range(500, 9000, 13)]]
+
+    file_names = []
+    for i, records in enumerate(shards):
+        file_names.append(os.path.join(tmp_dir, "shard%d.vcf.gz" % i))
+        _write_shard(file_names[-1], records)
+
+    final_file = os.path.join(tmp_dir, "merged.vcf.gz")
+    assert concat_bgzf_files(file_names, final_file, {b"chr1": 0, b"chr2": 1, b"chrX": 2})
+
+    all_records = [r for records in shards for r in records]
+    with BGZFile(final_file, "rb") as I:
+        lines = [line for line in I]
+
+    assert b"".join(lines[:2]) == HEADER
+    assert [tuple(line.split(b"\t")[:2]) for line in lines[2:]] == [(c, b"%d" % p) for c, p in all_records]
+
+    # The offsets of each shard in the merged tabix index must point to the records of the shard.
+    tbx = TabixFile(final_file)
+    for records in shards:
+        for chrom, pos in records[:1] + records[-1:]:
+            hits = [line.split("\t")[:2] for line in tbx.fetch(chrom, pos - 1, pos)]
+            assert hits == [[chrom, str(pos)]], (chrom, pos, hits)
+
+    assert len(list(tbx.fetch(b"chr2"))) == sum(1 for c, _ in all_records if c == b"chr2")
+    tbx.close()
+
+    # Shards out of order can't be concatenated.
+    assert not concat_bgzf_files([file_names[1], file_names[0]], final_file)
+
+
+def test_merge_sorted_files(tmp_dir):
+    inputs = [[(b"chr1", 10), (b"chr1", 30), (b"chr2", 5), (b"chr2", 40)],
+              [(b"chr3", 1), (b"chr3", 7)],
+              [(b"chr1", 20), (b"chr1", 30), (b"chr2", 6), (b"chr3", 3)]]
+
+    file_names = []
+    for i, records in enumerate(inputs):
+        file_names.append(os.path.join(tmp_dir, "part%d.cvg" % i))
+        with open(file_names[-1], "wb") as OUT:
+            OUT.write(b"#CHROM\tPOS\tINFO\n")
+            for chrom, pos in records:
+                OUT.write(b"%s\t%d\tfile%d\n" % (chrom, pos, i))
+
+    # Without the reference, the chromosomes are in the order of all the input files.
+    final_file = os.path.join(tmp_dir, "merged.cvg")
+    merge_sorted_files(file_names, final_file)
+    with open(final_file, "rb") as I:
+        lines = I.read().split(b"\n")
+
+    assert lines[0] == b"#CHROM\tPOS\tINFO"
+    assert [tuple(line.split(b"\t")) for line in lines[1:] if line] == [
+        (b"chr1", b"10", b"file0"), (b"chr1", b"20", b"file2"), (b"chr1", b"30", b"file0"), (b"chr1", b"30", b"file2"),
+        (b"chr2", b"5", b"file0"), (b"chr2", b"6", b"file2"), (b"chr2", b"40", b"file0"),
+        (b"chr3", b"1", b"file1"), (b"chr3", b"3", b"file2"), (b"chr3", b"7", b"file1")]
+
+
+if __name__ == "__main__":
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        test_concat_bgzf_files(tmp_dir)
+        test_merge_sorted_files(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print("Done")